@@ -2,5 +2,13 @@
 
 # Author: Dominik Harmim <harmim6@gmail.com>
 
-export FLASK_APP=./src/index.py
-pipenv run flask run -h 0.0.0.0
+# The database is converted to incremental vacuuming before serving.
+pipenv run python -m src.db
+
+# SERVER=asgi serves the application asynchronously using Uvicorn.
+if [ "$SERVER" = "asgi" ]; then
+	pipenv run uvicorn src.asgi:app --host 0.0.0.0 --port 5000
+else
+	export FLASK_APP="src.index:create_app()"
+	pipenv run flask run -h 0.0.0.0
+fi
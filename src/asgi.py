@@ -0,0 +1,260 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+The ASGI entry point of the REST API.
+
+Sorting requests are served asynchronously, so reading their bodies does not
+block, small ones are processed in threads, and large ones are processed in a
+worker pool while other requests are being served. Other end-points are
+served by the Flask application.
+"""
+
+from asyncio import get_running_loop
+from functools import partial
+from http import HTTPMethod, HTTPStatus
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from .db import stop_sweeper
+from .index import app as flask_app
+from .index import start
+from .metrics import SERVER_TIMING, record, stage
+from .negotiation import content_format
+from .parsing import ParsingError
+from .rates import stop_refresher
+from .service import Condition, Representation, represent
+from .workers import shutdown, sort_async
+
+Scope = Dict[str, Any]
+"""connection scope of ASGI"""
+
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+"""function receiving ASGI events"""
+
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+"""function sending ASGI events"""
+
+Headers = List[Tuple[bytes, bytes]]
+"""headers of an HTTP response"""
+
+__flask_app = WsgiToAsgi(flask_app)  # Flask application served via ASGI
+
+
+async def __read_body(receive: Receive) -> bytes:
+    """
+    Read a body of an HTTP request.
+
+    :param Receive receive: function receiving ASGI events
+    :return bytes: body of the HTTP request
+    """
+    chunks = []
+    more_body = True
+    while more_body:
+        event = await receive()
+        chunks.append(event.get("body", b""))
+        more_body = event.get("more_body", False)
+
+    return b"".join(chunks)
+
+
+async def __respond(
+    send: Send,
+    status: HTTPStatus,
+    body: bytes,
+    content_type: str,
+    headers: Headers | None = None,
+) -> None:
+    """
+    Send an HTTP response.
+
+    :param Send send: function sending ASGI events
+    :param HTTPStatus status: status of the HTTP response
+    :param bytes body: body of the HTTP response
+    :param str content_type: content type of the body
+    :param Headers | None headers: other headers of the HTTP response,
+        defaults to None
+    """
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+            *(headers or []),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def __header(scope: Scope, name: bytes) -> str | None:
+    """
+    Get a header of an HTTP request.
+
+    :param Scope scope: connection scope
+    :param bytes name: lower-case name of the header
+    :return str | None: value of the header, None if it is not given
+    """
+    values = [v.decode("latin-1") for n, v in scope["headers"] if n == name]
+    return ", ".join(values) if values else None
+
+
+async def __stream(
+    send: Send,
+    chunks: Iterable[bytes],
+    headers: Headers | None = None,
+    status: HTTPStatus = HTTPStatus.OK,
+) -> None:
+    """
+    Send an HTTP response by chunks.
+
+    :param Send send: function sending ASGI events
+    :param Iterable[bytes] chunks: chunks of the body of the HTTP response
+    :param Headers | None headers: headers of the HTTP response, including
+        its content type, defaults to None
+    :param HTTPStatus status: status of the HTTP response,
+        defaults to HTTPStatus.OK
+    """
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers or [],
+    })
+    for chunk in chunks:
+        await send({
+            "type": "http.response.body", "body": chunk, "more_body": True,
+        })
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def __sort_itineraries(
+    scope: Scope, receive: Receive, send: Send,
+) -> None:
+    """
+    Process a sorting itineraries POST request.
+
+    The request and the response may be in the MessagePack format instead of
+    JSON (by the Content-Type and Accept headers). A JSON response is
+    streamed in the compact format, unless the pretty query argument is given
+    or it is compressed. It is not sent again if it matches the If-None-Match
+    header, which is checked before sorting. The response is represented
+    (e.g., compressed) in a thread, so the event loop is not blocked.
+    Durations of stages of the processing are given in the Server-Timing
+    header, if enabled.
+
+    :param Scope scope: connection scope
+    :param Receive receive: function receiving ASGI events
+    :param Send send: function sending ASGI events
+    """
+    try:
+        body = await __read_body(receive)
+        query = parse_qs(scope["query_string"].decode(), True)
+        pretty = "pretty" in query
+        accept = __header(scope, b"accept")
+        accept_encoding = __header(scope, b"accept-encoding")
+        if_none_match = __header(scope, b"if-none-match")
+        condition = None
+        if if_none_match:
+            condition = Condition(
+                if_none_match, pretty, accept, accept_encoding,
+            )
+
+        with record() as recording, stage("total"):
+            response = await sort_async(
+                body,
+                content_format(__header(scope, b"content-type")),
+                condition,
+            )
+
+        if isinstance(response, Representation):
+            representation = response
+        else:
+            # compression, encoding, and caching of variants do not block
+            # the event loop
+            representation = await get_running_loop().run_in_executor(
+                None,
+                partial(
+                    represent,
+                    response,
+                    pretty=pretty,
+                    accept=accept,
+                    accept_encoding=accept_encoding,
+                    if_none_match=if_none_match,
+                ),
+            )
+        headers = [
+            (name.lower().encode(), value.encode())
+            for name, value in representation.headers.items()
+        ]
+        if SERVER_TIMING:
+            headers.append(
+                (b"server-timing", recording.server_timing().encode()),
+            )
+        await __stream(
+            send, representation.body, headers, representation.status,
+        )
+
+    except ParsingError as e:
+        await __respond(
+            send, HTTPStatus.BAD_REQUEST, e.message.encode(), "text/plain",
+        )
+
+    except TimeoutError:
+        await __respond(
+            send,
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            b"Sorting timed out.",
+            "text/plain",
+        )
+
+    except Exception:
+        await __respond(
+            send,
+            HTTPStatus.INTERNAL_SERVER_ERROR,
+            b"Internal error.",
+            "text/plain",
+        )
+
+
+async def __lifespan(receive: Receive, send: Send) -> None:
+    """
+    Process lifespan events of the application.
+
+    The background threads are started when the application starts, and
+    they and the worker pool are shut down when the application shuts down.
+
+    :param Receive receive: function receiving ASGI events
+    :param Send send: function sending ASGI events
+    """
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            start()
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            shutdown()
+            stop_sweeper()
+            stop_refresher()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    """
+    Serve an ASGI connection.
+
+    :param Scope scope: connection scope
+    :param Receive receive: function receiving ASGI events
+    :param Send send: function sending ASGI events
+    """
+    if scope["type"] == "lifespan":
+        await __lifespan(receive, send)
+    elif (
+        scope["type"] == "http"
+        and scope["path"] == "/sort_itineraries"
+        and scope["method"] == HTTPMethod.POST
+    ):
+        await __sort_itineraries(scope, receive, send)
+    else:
+        await __flask_app(scope, receive, send)
@@ -0,0 +1,74 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Module with a columnar representation of itineraries used for sorting."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from .metrics import stage
+from .parsing import Itineraries
+
+
+@dataclass(frozen=True)
+class ItineraryBatch:
+    """
+    Encapsulates itineraries stored column by column in contiguous arrays.
+
+    An itinerary is identified by its index into the original list of
+    itineraries, so sorting only needs to compute a permutation of these
+    indices.
+    """
+
+    durations: np.ndarray
+    """travel durations in minutes"""
+
+    amounts_eur: np.ndarray
+    """price amounts in EUR"""
+
+    ids: List[str]
+    """identifiers (only looked up to order itineraries with equal keys)"""
+
+    @classmethod
+    def from_itineraries(
+        cls: type[ItineraryBatch], itineraries: Itineraries,
+    ) -> ItineraryBatch:
+        """
+        Construct a columnar batch from a list of itineraries.
+
+        Amounts in EUR are computed column by column from the amounts and EUR
+        rates of the prices.
+
+        :param Itineraries itineraries: itineraries to be stored
+        :return ItineraryBatch: columnar batch of the given itineraries
+        """
+        count = len(itineraries)
+        with stage("convert"):
+            amounts_eur = np.fromiter(
+                (i.price.amount for i in itineraries),
+                dtype=np.float64,
+                count=count,
+            ) * np.fromiter(
+                (i.price.rate for i in itineraries),
+                dtype=np.float64,
+                count=count,
+            )
+
+        return cls(
+            durations=np.fromiter(
+                (i.duration for i in itineraries), dtype=np.int64, count=count,
+            ),
+            amounts_eur=amounts_eur,
+            ids=[i.id for i in itineraries],
+        )
+
+    def __len__(self: ItineraryBatch) -> int:
+        """
+        Get the number of stored itineraries.
+
+        :return int: number of stored itineraries
+        """
+        return len(self.durations)
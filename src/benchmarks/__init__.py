@@ -0,0 +1,5 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Itineraries sorting benchmarks module."""
+
+__author__ = "Dominik Harmim <harmim6@gmail.com>"
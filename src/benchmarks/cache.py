@@ -0,0 +1,102 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Benchmark of reading and writing sorting requests from/to the SQLite3 cache.
+
+It compares opening a new database connection for each request with taking
+a pooled connection. Run it using ``python -m src.benchmarks.cache``.
+"""
+
+from contextlib import closing, contextmanager
+from os.path import join as join_path
+from sqlite3 import Cursor, connect
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, ContextManager, Iterator, Tuple
+
+from ..db import close_connections, database
+
+__REPEAT = 2000  # number of measured reads and writes
+__RECORD = b"x" * 4096  # cached record
+
+
+@contextmanager
+def __unpooled_database(db_file: str) -> Iterator[Cursor]:
+    """
+    Open a new database connection in the default journal mode.
+
+    This is how each request accessed the database before connections were
+    pooled.
+
+    :param str db_file: database file name
+    :yield Iterator[Cursor]: open database cursor
+    """
+    with (
+        closing(connect(db_file)) as connection,
+        closing(connection.cursor()) as cursor,
+    ):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS result " +
+            "(hash TEXT PRIMARY KEY, version INTEGER NOT NULL, " +
+            "sorting_type TEXT NOT NULL, items BLOB NOT NULL, " +
+            "ends BLOB NOT NULL)",
+        )
+        connection.commit()
+
+        yield cursor
+
+
+def __measure(
+    open_database: Callable[[str], ContextManager[Cursor]], db_file: str,
+) -> Tuple[float, float]:
+    """
+    Measure median latencies of cache writes and reads.
+
+    :param Callable[[str], ContextManager[Cursor]] open_database: function
+        opening a database
+    :param str db_file: database file name
+    :return Tuple[float, float]: write and read latencies in microseconds
+    """
+    writes, reads = [], []
+    for n in range(__REPEAT):
+        start = perf_counter()
+        with open_database(db_file) as cursor:
+            cursor.execute(
+                "INSERT INTO result " +
+                "(hash, version, sorting_type, items, ends) " +
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(n), 1, "best", __RECORD, b""),
+            )
+            cursor.connection.commit()
+        writes.append(perf_counter() - start)
+
+    for n in range(__REPEAT):
+        start = perf_counter()
+        with open_database(db_file) as cursor:
+            cursor.execute(
+                "SELECT sorting_type, items, ends FROM result " +
+                "WHERE hash = ? AND version = ?",
+                (str(n), 1),
+            ).fetchone()
+        reads.append(perf_counter() - start)
+
+    return median(writes) * 1e6, median(reads) * 1e6
+
+
+def main() -> None:
+    """Run the benchmark and print its results."""
+    with TemporaryDirectory() as tmp_dir:
+        for name, open_database in (
+            ("unpooled", __unpooled_database),
+            ("pooled", database),
+        ):
+            db_file = join_path(tmp_dir, f"{name}.db")
+            write, read = __measure(open_database, db_file)
+            print(f"{name:>10}: write {write:8.1f} us, read {read:8.1f} us")
+
+        close_connections()
+
+
+if __name__ == "__main__":
+    main()
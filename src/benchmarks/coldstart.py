@@ -0,0 +1,91 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Benchmark of cold starts of the asynchronous (ASGI) serving.
+
+It measures the time from starting the server to serving the first sorting
+request, once with EUR rates loaded from the precomputed snapshot and once
+with them computed by the currency converter. Run it using
+``python -m src.benchmarks.coldstart``.
+"""
+
+import subprocess
+import sys
+from http.client import HTTPConnection
+from os import environ
+from os.path import join as join_path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import Dict
+
+from .generator import generate_body
+
+__PORT = 5124  # port of the tested server
+__REPEAT = 5  # number of measured cold starts
+
+
+def __first_request(body: bytes) -> bool:
+    """
+    Try to send a sorting request to the tested server.
+
+    :param bytes body: body of the sorting request
+    :return bool: True if the request was served successfully
+    """
+    try:
+        connection = HTTPConnection("127.0.0.1", __PORT, timeout=60)
+        connection.request(
+            "POST",
+            "/sort_itineraries",
+            body,
+            {"Content-Type": "application/json"},
+        )
+        status = connection.getresponse().status
+        connection.close()
+    except OSError:
+        return False
+
+    return status == 200
+
+
+def __measure(env: Dict[str, str]) -> float:
+    """
+    Start the server and measure the time to its first served request.
+
+    :param Dict[str, str] env: environment variables of the server
+    :return float: time to the first served request in milliseconds
+    """
+    body = generate_body(10)
+    start = perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "src.asgi:app",
+            "--port", str(__PORT), "--log-level", "warning",
+        ],
+        env={**environ, **env},
+    )
+    try:
+        while not __first_request(body):
+            sleep(0.005)
+
+        return (perf_counter() - start) * 1e3
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    """Run the benchmark and print its results."""
+    with TemporaryDirectory() as tmp_dir:
+        for name, env in (
+            ("snapshot", {}),
+            ("converter", {"RATES_FILE": join_path(tmp_dir, "missing")}),
+        ):
+            env["REQUESTS_DB"] = join_path(tmp_dir, f"{name}.db")
+            latency = median(__measure(env) for _ in range(__REPEAT))
+            print(f"{name:>10}: first request after {latency:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Module generating synthetic sorting requests for benchmarks."""
+
+import json
+from random import Random
+from typing import Any, Dict
+
+from ..negotiation import WireFormat, encode
+
+CURRENCIES = ("EUR", "CZK", "USD", "GBP", "PLN", "CHF")
+"""currencies of generated prices"""
+
+__PRICE_POOL = 1000  # number of distinct price amounts
+
+
+def generate_request(
+    count: int, sorting_type: str = "best", seed: int = 0,
+) -> Dict[str, Any]:
+    """
+    Generate a realistic sorting request.
+
+    Prices are drawn from a limited pool of amounts in mixed currencies, so
+    many itineraries have equal prices (and durations). The same seed always
+    generates the same request.
+
+    :param int count: number of itineraries
+    :param str sorting_type: sorting criteria, defaults to "best"
+    :param int seed: seed of the random generator, defaults to 0
+    :return Dict[str, Any]: sorting request in the JSON format
+    """
+    rnd = Random(seed)
+    amounts = [rnd.randint(10, 5000) for _ in range(__PRICE_POOL)]
+    return {
+        "sorting_type": sorting_type,
+        "itineraries": [
+            {
+                "id": f"itinerary_{seed}_{n}",
+                "duration_minutes": rnd.randint(30, 1440),
+                "price": {
+                    "amount": rnd.choice(amounts),
+                    "currency": rnd.choice(CURRENCIES),
+                },
+            }
+            for n in range(count)
+        ],
+    }
+
+
+def generate_body(
+    count: int,
+    sorting_type: str = "best",
+    seed: int = 0,
+    wire_format: WireFormat = WireFormat.JSON,
+) -> bytes:
+    """
+    Generate a body of a realistic sorting request.
+
+    :param int count: number of itineraries
+    :param str sorting_type: sorting criteria, defaults to "best"
+    :param int seed: seed of the random generator, defaults to 0
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :return bytes: body of the sorting request
+    """
+    request_json = generate_request(count, sorting_type, seed)
+    if wire_format == WireFormat.JSON:
+        return json.dumps(request_json).encode()
+
+    return encode(request_json, wire_format)
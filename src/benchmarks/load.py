@@ -0,0 +1,124 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Load test of the asynchronous (ASGI) serving of sorting requests.
+
+It measures latencies of small sorting requests while large ones are being
+processed, once with all requests processed inline and once with large ones
+offloaded to the worker pool. All the requests accept gzip, so the large
+responses are compressed while the small ones are being served. Run it using
+``python -m src.benchmarks.load``.
+"""
+
+import subprocess
+import sys
+from http.client import HTTPConnection
+from os import environ
+from os.path import join as join_path
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Dict, List
+
+from .generator import generate_body
+
+__PORT = 5123  # port of the tested server
+__SMALL_COUNT = 10  # number of itineraries of small requests
+__LARGE_COUNT = 100_000  # number of itineraries of large requests
+__REQUESTS = 100  # number of measured small requests
+
+
+def __post(body: bytes) -> float:
+    """
+    Send a sorting request to the tested server.
+
+    :param bytes body: body of the sorting request
+    :return float: latency of the request in milliseconds
+    """
+    connection = HTTPConnection("127.0.0.1", __PORT, timeout=120)
+    start = perf_counter()
+    connection.request(
+        "POST",
+        "/sort_itineraries",
+        body,
+        {"Content-Type": "application/json", "Accept-Encoding": "gzip"},
+    )
+    connection.getresponse().read()
+    connection.close()
+
+    return (perf_counter() - start) * 1e3
+
+
+def __measure(env: Dict[str, str], load: bool) -> List[float]:
+    """
+    Start the server and measure latencies of small requests.
+
+    :param Dict[str, str] env: environment variables of the server
+    :param bool load: whether large requests are sent in the background
+    :return List[float]: latencies of small requests in milliseconds
+    """
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "src.asgi:app",
+            "--port", str(__PORT), "--log-level", "warning",
+        ],
+        env={**environ, **env},
+    )
+    try:
+        for _ in range(100):
+            try:
+                HTTPConnection("127.0.0.1", __PORT).connect()
+                break
+            except OSError:
+                sleep(0.1)
+
+        __post(generate_body(__SMALL_COUNT))  # warm up
+
+        stop = Event()
+
+        def load_server() -> None:
+            seed = 0
+            while not stop.is_set():
+                seed += 1
+                __post(generate_body(__LARGE_COUNT, seed=seed))
+
+        loaders = [Thread(target=load_server) for _ in range(2 if load else 0)]
+        for loader in loaders:
+            loader.start()
+
+        sleep(1 if load else 0)
+        latencies = [
+            __post(generate_body(__SMALL_COUNT, seed=-n))
+            for n in range(__REQUESTS)
+        ]
+
+        stop.set()
+        for loader in loaders:
+            loader.join()
+
+        return latencies
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    """Run the benchmark and print its results."""
+    with TemporaryDirectory() as tmp_dir:
+        for name, env, load in (
+            ("idle", {}, False),
+            ("inline", {"WORKER_THRESHOLD": str(sys.maxsize)}, True),
+            ("pooled", {}, True),
+        ):
+            env["REQUESTS_DB"] = join_path(tmp_dir, f"{name}.db")
+            latencies = __measure(env, load)
+            cuts = quantiles(latencies, n=100)
+            print(
+                f"{name:>10}: p50 {cuts[49]:8.1f} ms, p99 {cuts[98]:8.1f} ms",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Benchmark of memory used by parsed itineraries.
+
+It measures bytes per itinerary retained after decoding and parsing a
+sorting request, once the decoded request is released. It also measures the
+peak memory of sorting streams of itineraries spilled to runs, which does not
+grow with the number of itineraries. Run it using
+``python -m src.benchmarks.memory``.
+"""
+
+import gc
+import json
+import tracemalloc
+from typing import Iterator
+
+from ..external import sort_stream
+from ..parsing import Request
+from .generator import generate_body, generate_request
+
+__SIZES = (10_000, 100_000, 1_000_000)  # numbers of itineraries
+__STREAM_MEMORY = 4 * 1024 * 1024  # memory budget of runs of streams
+__STREAM_BLOCK = 10_000  # itineraries generated at once for streams
+
+
+def __measure(size: int) -> float:
+    """
+    Measure memory used by parsed itineraries of a sorting request.
+
+    The request is decoded from the JSON format, as it is by the server, so
+    equal strings of different itineraries are distinct objects.
+
+    :param int size: number of itineraries of the request
+    :return float: bytes per itinerary
+    """
+    body = generate_body(size, seed=size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        request_json = json.loads(body)
+        request = Request(request_json)
+        del request_json
+        gc.collect()
+        used, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(request.itineraries) == size
+    return used / size
+
+
+def __generate_lines(size: int) -> Iterator[bytes]:
+    """
+    Generate lines of a stream of itineraries lazily, block by block.
+
+    :param int size: number of itineraries of the stream
+    :return Iterator[bytes]: lines of the stream
+    """
+    for block in range(0, size, __STREAM_BLOCK):
+        for itinerary in generate_request(
+            min(__STREAM_BLOCK, size - block), seed=block,
+        )["itineraries"]:
+            yield json.dumps(itinerary).encode() + b"\n"
+
+
+def __measure_stream(size: int) -> float:
+    """
+    Measure the peak memory of sorting a stream of itineraries.
+
+    :param int size: number of itineraries of the stream
+    :return float: peak memory in MiB
+    """
+    request = Request({"sorting_type": "best", "itineraries": []})
+    gc.collect()
+    tracemalloc.start()
+    try:
+        chunks = sort_stream(
+            __generate_lines(size), request, memory=__STREAM_MEMORY,
+        )
+        for _ in chunks:
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024 / 1024
+
+
+def main() -> None:
+    """Run the benchmark and print its results."""
+    for size in __SIZES:
+        print(f"{size:>9}: {__measure(size):8.1f} bytes per itinerary")
+    for size in __SIZES:
+        print(f"{size:>9}: {__measure_stream(size):8.1f} MiB peak of a stream")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Benchmark of the parallel sorting of very large numbers of itineraries.
+
+It compares a stable sequential sort with the parallel sort by increasing
+numbers of processes, for keys of the cheapest (floats) and the fastest
+(integers) itineraries. The parallel sort includes copying the keys to and
+the permutation from shared memory. Run it using
+``python -m src.benchmarks.parallel``.
+"""
+
+from os import cpu_count
+from statistics import median
+from time import perf_counter
+from typing import Callable, Dict
+
+import numpy as np
+
+from ..batch import ItineraryBatch
+from ..parallel import parallel_argsort
+from ..parsing import Request, SortingType
+from ..sorting import sort_keys
+from .generator import generate_request
+
+__SIZES = (1_000_000, 4_000_000)  # numbers of sorted keys
+__REPEAT = 3  # number of measured sorts
+__ITINERARIES = 100_000  # generated itineraries repeated to the sizes
+
+
+def __keys(size: int) -> Dict[str, np.ndarray]:
+    """
+    Generate sorting keys of realistic itineraries.
+
+    Keys of generated itineraries are repeated and shuffled, since generating
+    millions of itineraries takes much longer than sorting them.
+
+    :param int size: number of the keys
+    :return Dict[str, np.ndarray]: the keys by the sorting criteria
+    """
+    batch = ItineraryBatch.from_itineraries(
+        Request(generate_request(__ITINERARIES, "cheapest")).itineraries,
+    )
+    rng = np.random.default_rng(0)
+    return {
+        sorting_type.value: rng.permutation(
+            np.resize(sort_keys(batch, sorting_type), size),
+        )
+        for sorting_type in (SortingType.CHEAPEST, SortingType.FASTEST)
+    }
+
+
+def __measure(sort: Callable[[], np.ndarray]) -> float:
+    """
+    Measure the median duration of a sort.
+
+    :param Callable[[], np.ndarray] sort: the sort
+    :return float: median duration in milliseconds
+    """
+    durations = []
+    for _ in range(__REPEAT):
+        start = perf_counter()
+        sort()
+        durations.append((perf_counter() - start) * 1e3)
+
+    return median(durations)
+
+
+def main() -> None:
+    """Run the benchmark and print its results."""
+    workers = sorted({
+        w for w in (2, 4, 8, cpu_count() or 1) if w <= (cpu_count() or 1)
+    })
+    print(f"{cpu_count()} CPUs")
+    for size in __SIZES:
+        for name, keys in __keys(size).items():
+            expected = np.argsort(keys, kind="stable")
+            sequential = __measure(lambda: np.argsort(keys, kind="stable"))
+            print(f"{size:>9} {name:>8}: {sequential:8.1f} ms sequential")
+            for w in workers:
+                assert np.array_equal(parallel_argsort(keys, w), expected)
+                parallel = __measure(lambda: parallel_argsort(keys, w))
+                print(
+                    f"{size:>9} {name:>8}: {parallel:8.1f} ms by {w} " +
+                    f"processes ({sequential / parallel:.2f}x)",
+                )
+
+
+if __name__ == "__main__":
+    main()
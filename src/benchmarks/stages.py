@@ -0,0 +1,271 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Benchmark of the stages of processing of sorting requests.
+
+It measures decoding and parsing of requests, currency conversion, sorting
+by each sorting criteria, serialisation of responses, cold and warm cache
+paths, and the time to the first byte of a response (i.e., to its first
+chunk) for synthetic requests of various sizes. Decoding, serialisation, and
+whole responses of cached sorted itineraries are measured in the JSON and
+MessagePack formats. The results are saved in the JSON format and compared
+against a baseline, which has to be stored on the same machine first. Run it
+using ``python -m src.benchmarks.stages``, see ``--help`` for its options.
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from os import environ
+from os.path import dirname, exists
+from os.path import join as join_path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+from .. import service
+from ..cache import MemoryCache
+from ..db import close_connections, database
+from ..negotiation import WIRE_FORMATS
+from ..parsing import Price, RateTable, Request, SortingType, parse_request
+from ..result import SortedItineraries
+from ..service import iter_response, represent
+from ..sorting import sort_request, sort_request_cached
+from .generator import generate_body, generate_request
+
+SIZES = (10, 1_000, 100_000, 1_000_000)
+"""default numbers of itineraries of benchmarked requests"""
+
+BASELINE = join_path(dirname(__file__), "baseline.json")
+"""default file with the stored baseline results"""
+
+Results = Dict[str, Dict[str, float]]
+"""median latencies in milliseconds: [size, [stage, latency]]"""
+
+
+def __repeat(size: int) -> int:
+    """
+    Get the number of measurements of a stage, fewer for larger requests.
+
+    :param int size: number of itineraries of the request
+    :return int: number of measurements
+    """
+    return max(3, min(1000, 100_000 // size))
+
+
+def __measure(
+    stage: Callable[[], Any],
+    size: int,
+    setup: Callable[[], Any] | None = None,
+) -> float:
+    """
+    Measure the median latency of a stage.
+
+    :param Callable[[], Any] stage: the measured stage
+    :param int size: number of itineraries of the request
+    :param Callable[[], Any] | None setup: function run before each
+        measurement, which is not measured, defaults to None
+    :return float: median latency in milliseconds
+    """
+    latencies = []
+    for _ in range(__repeat(size)):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        stage()
+        latencies.append(perf_counter() - start)
+
+    return median(latencies) * 1e3
+
+
+def __measure_size(size: int, db_file: str) -> Dict[str, float]:
+    """
+    Measure latencies of all the stages for a request of a given size.
+
+    :param int size: number of itineraries of the request
+    :param str db_file: database file name
+    :return Dict[str, float]: median latencies in milliseconds of the stages
+    """
+    request_json = generate_request(size, seed=size)
+    body = generate_body(size, seed=size)
+    request = Request(request_json)
+    latencies = {
+        "decode": __measure(lambda: parse_request(body), size),
+        "parse": __measure(lambda: Request(request_json), size),
+    }
+
+    def convert() -> None:
+        rates = RateTable()
+        for i in request_json["itineraries"]:
+            Price(i["price"]["amount"], i["price"]["currency"], rates)
+
+    latencies["convert"] = __measure(convert, size)
+
+    for sorting_type in SortingType:
+        request.sorting_type = sorting_type
+        latencies[f"sort_{sorting_type.value}"] = __measure(
+            lambda: sort_request(request), size,
+        )
+
+    latencies["serialise"] = __measure(
+        lambda: SortedItineraries.from_request(request).to_json(), size,
+    )
+
+    # binary formats are decoded directly and encoded from serialised JSON
+    for wire_format in WIRE_FORMATS[1:]:
+        name = wire_format.name.lower()
+        binary_body = generate_body(size, seed=size, wire_format=wire_format)
+        latencies[f"decode_{name}"] = __measure(
+            lambda: parse_request(binary_body, wire_format), size,
+        )
+        latencies[f"serialise_{name}"] = __measure(
+            lambda: SortedItineraries.from_request(request).with_msgpack(),
+            size,
+        )
+
+    memory_cache: MemoryCache[SortedItineraries] = MemoryCache()
+    fresh: List[Request] = []
+    with database(db_file) as cursor:
+        def clear() -> None:
+            memory_cache.clear()
+            cursor.execute("DELETE FROM result")
+            cursor.connection.commit()
+            fresh[:] = [Request(request_json)]  # nothing precomputed
+
+        latencies["cache_cold"] = __measure(
+            lambda: sort_request_cached(fresh[0], cursor, memory_cache),
+            size,
+            clear,
+        )
+        latencies["cache_warm_db"] = __measure(
+            lambda: sort_request_cached(request, cursor), size,
+        )
+        latencies["cache_warm_memory"] = __measure(
+            lambda: sort_request_cached(request, cursor, memory_cache), size,
+        )
+
+        # responses are streamed from the cached serialised itineraries, so
+        # a cold response starts once all of them are serialised
+        latencies["first_byte_cold"] = __measure(
+            lambda: next(iter_response(
+                sort_request_cached(fresh[0], cursor, memory_cache),
+            )),
+            size,
+            clear,
+        )
+        latencies["first_byte_warm"] = __measure(
+            lambda: next(iter_response(
+                sort_request_cached(request, cursor, memory_cache),
+            )),
+            size,
+        )
+
+    # whole responses of cached sorted itineraries in each format, which are
+    # encoded into it (and cached by the service) before the measurements
+    def respond(accept: str) -> bytes:
+        with database(db_file) as cursor:
+            return b"".join(represent(
+                sort_request_cached(request, cursor, service.memory_cache),
+                accept=accept,
+            ).body)
+
+    for wire_format in WIRE_FORMATS:
+        respond(wire_format.value)
+        latencies[f"response_{wire_format.name.lower()}_hit"] = __measure(
+            lambda: respond(wire_format.value), size,
+        )
+
+    return latencies
+
+
+def compare(
+    results: Results, baseline: Results, threshold: float,
+) -> List[str]:
+    """
+    Compare results against the baseline.
+
+    :param Results results: measured results
+    :param Results baseline: baseline results
+    :param float threshold: maximal allowed relative slowdown
+    :return List[str]: descriptions of regressions, empty if there are none
+    """
+    regressions = []
+    for size, latencies in results.items():
+        for stage, latency in latencies.items():
+            base = baseline.get(size, {}).get(stage)
+            if base and latency > base * (1 + threshold):
+                regressions.append(
+                    f"{stage} ({size} itineraries): {latency:.3f} ms " +
+                    f"vs. {base:.3f} ms (+{latency / base - 1:.0%})",
+                )
+
+    return regressions
+
+
+def main() -> None:
+    """Run the benchmark, save its results, and compare them."""
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(size) for size in s.split(",")],
+        default=SIZES,
+        help="comma-separated numbers of itineraries of requests",
+    )
+    parser.add_argument(
+        "--output",
+        default="bench_results.json",
+        help="file the results are saved in",
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE, help="file with baseline results",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="maximal allowed relative slowdown against the baseline",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    args = parser.parse_args()
+
+    results: Results = {}
+    with TemporaryDirectory() as tmp_dir:
+        db_file = join_path(tmp_dir, "requests.db")
+        environ["REQUESTS_DB"] = db_file  # of encoded cached responses
+        for size in args.sizes:
+            results[str(size)] = __measure_size(size, db_file)
+            for stage, latency in results[str(size)].items():
+                print(f"{size:>9} {stage:>20}: {latency:12.3f} ms")
+
+        close_connections()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+
+    if not exists(args.baseline):
+        print(
+            f"No baseline in {args.baseline}, store one using " +
+            "`make bench-baseline` (or the --save-baseline option).",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for regression in regressions:
+        print(f"Regression of {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with an in-memory cache of sorting requests and with coalescing of
+concurrent identical computations.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Dict, Generic, NamedTuple, Tuple, TypeVar
+
+T = TypeVar("T")
+"""type of cached values"""
+
+
+class _Entry(NamedTuple, Generic[T]):
+    """Cached value with its metadata."""
+
+    value: T
+    """cached value"""
+
+    size: int
+    """size of the value in bytes"""
+
+    expires: float
+    """time when the value expires"""
+
+
+@dataclass
+class CacheStats:
+    """Counters of an in-memory cache."""
+
+    hits: int = 0
+    """number of lookups that found a value"""
+
+    misses: int = 0
+    """number of lookups that did not find a value"""
+
+    evictions: int = 0
+    """number of values removed because of the size limits or expiration"""
+
+    entries: int = 0
+    """number of cached values"""
+
+    bytes: int = 0
+    """total size of cached values in bytes"""
+
+
+class MemoryCache(Generic[T]):
+    """
+    Bounded in-memory LRU cache with optional expiration of values.
+
+    When a limit of the number of values or their total size is exceeded, the
+    least recently used values are evicted. The cache is thread-safe.
+    """
+
+    def __init__(
+        self: MemoryCache[T],
+        max_entries: int = 1024,
+        max_bytes: int | None = None,
+        ttl: float | None = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        """
+        Construct an empty in-memory cache.
+
+        :param int max_entries: maximal number of cached values,
+            defaults to 1024
+        :param int | None max_bytes: maximal total size of cached values in
+            bytes, defaults to None (unlimited)
+        :param float | None ttl: time to live of cached values in seconds,
+            defaults to None (values do not expire)
+        :param Callable[[], float] clock: source of the current time in
+            seconds, defaults to monotonic
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.__clock = clock
+        self.__entries: OrderedDict[str, _Entry[T]] = OrderedDict()
+        self.__stats = CacheStats()
+        self.__lock = Lock()
+
+    def get(self: MemoryCache[T], key: str) -> T | None:
+        """
+        Get a cached value and mark it as the most recently used one.
+
+        :param str key: key of the value
+        :return T | None: cached value, None if it is not cached or it expired
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry.expires <= self.__clock():
+                self.__remove(key)
+                self.__stats.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.__stats.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__stats.hits += 1
+
+            return entry.value
+
+    def put(self: MemoryCache[T], key: str, value: T, size: int = 0) -> None:
+        """
+        Cache a value as the most recently used one.
+
+        Values bigger than the size limit are not cached at all.
+
+        :param str key: key of the value
+        :param T value: value to be cached
+        :param int size: size of the value in bytes, defaults to 0
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires = float("inf")
+        if self.ttl is not None:
+            expires = self.__clock() + self.ttl
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+
+            self.__entries[key] = _Entry(value, size, expires)
+            self.__stats.entries += 1
+            self.__stats.bytes += size
+
+            while len(self.__entries) > self.max_entries or (
+                self.max_bytes is not None
+                and self.__stats.bytes > self.max_bytes
+            ):
+                self.__remove(next(iter(self.__entries)))
+                self.__stats.evictions += 1
+
+    def clear(self: MemoryCache[T]) -> None:
+        """Remove all cached values and reset the counters."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__stats = CacheStats()
+
+    def stats(self: MemoryCache[T]) -> Dict[str, int]:
+        """
+        Get the counters of the cache.
+
+        :return Dict[str, int]: dictionary: [counter name, counter's value]
+        """
+        with self.__lock:
+            return asdict(self.__stats)
+
+    def __remove(self: MemoryCache[T], key: str) -> None:
+        """
+        Remove a cached value (the lock must be held).
+
+        :param str key: key of the value
+        """
+        entry = self.__entries.pop(key)
+        self.__stats.entries -= 1
+        self.__stats.bytes -= entry.size
+
+    def __len__(self: MemoryCache[T]) -> int:
+        """
+        Get the number of cached values.
+
+        :return int: number of cached values
+        """
+        return len(self.__entries)
+
+
+class _Call(Generic[T]):
+    """Computation in flight, shared by concurrent callers."""
+
+    def __init__(self: _Call[T]) -> None:
+        """Construct a computation in flight."""
+        self.done = Event()
+        self.value: T | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalescing of concurrent identical computations.
+
+    The first caller with a key computes the value, and callers with the
+    same key arriving meanwhile wait for it and share it (or its exception)
+    instead of computing it again. Nothing is cached, a computation is shared
+    only while it is in flight. It is thread-safe.
+    """
+
+    def __init__(self: SingleFlight[T]) -> None:
+        """Construct coalescing without any computations in flight."""
+        self.__calls: Dict[str, _Call[T]] = {}
+        self.__lock = Lock()
+
+    def do(
+        self: SingleFlight[T], key: str, compute: Callable[[], T],
+    ) -> Tuple[T, bool]:
+        """
+        Compute a value, or wait for the same computation in flight.
+
+        :param str key: key of the computation
+        :param Callable[[], T] compute: computation of the value
+        :return Tuple[T, bool]: the value and whether it was computed by
+            another caller
+        :raises BaseException: exception of the computation
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            shared = call is not None
+            if call is None:
+                call = self.__calls[key] = _Call()
+
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.value, True
+
+        try:
+            call.value = compute()
+            return call.value, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+    def __len__(self: SingleFlight[T]) -> int:
+        """
+        Get the number of computations in flight.
+
+        :return int: number of computations in flight
+        """
+        return len(self.__calls)
@@ -1,32 +1,553 @@
 # Author: Dominik Harmim <harmim6@gmail.com>
 
-"""Module that handles SQLite3 database stuff related to sorting requests."""
+"""
+Module that handles SQLite3 database stuff related to sorting requests.
+
+Cached results record their size and times of their creation and of their
+last access. Encoded variants of their responses (e.g., compressed ones) are
+stored with them, counted into their size, and deleted with them. A
+background sweeper evicts results not accessed for a TTL and the least
+recently accessed ones over a size cap, in batches of deletes, and it
+returns freed pages by incremental vacuuming. Accesses are only recorded
+in memory while requests are being served and the sweeper writes them, so
+the database is never maintained on the request path. Databases created
+without incremental vacuuming are converted offline (``python -m src.db``),
+since the conversion is a full vacuum locking the database.
+
+Connections are shared by all the threads of a process through a bounded
+pool. The schema is created and migrated once, when the pool is opened.
+"""
 
 from contextlib import closing, contextmanager
-from sqlite3 import Cursor, connect
-from typing import Iterator
+from os import getenv, getpid
+from queue import Empty, Queue
+from sqlite3 import Connection, Cursor, Error, connect
+from threading import Event, Lock, Thread, local
+from time import time
+from typing import Dict, Iterator
+
+from .metrics import count, stage
+
+__CACHE_SIZE = -16384  # page cache size (negative means KiB)
+__CACHED_STATEMENTS = 256  # number of prepared statements kept per connection
+
+# seconds since the last access of evicted results, 0 means no expiration
+__TTL = float(getenv("REQUESTS_DB_TTL", str(7 * 24 * 60 * 60)))
+# maximal total size of results in bytes, 0 means unlimited
+__MAX_BYTES = int(getenv("REQUESTS_DB_MAX_BYTES", str(1024 * 1024 * 1024)))
+# seconds between sweeps, 0 means no sweeper
+__SWEEP_INTERVAL = float(getenv("REQUESTS_DB_SWEEP_INTERVAL", "60"))
+__SWEEP_BATCH = 500  # number of results deleted by a single transaction
+__VACUUM_PAGES = 1024  # number of pages freed by a single transaction
+
+# maximal number of open connections of a database in a process
+__POOL_SIZE = int(getenv("REQUESTS_DB_POOL_SIZE", "8"))
+
+__pools: Dict[str, Queue[Connection]] = {}  # idle connections by databases
+__opened: Dict[str, int] = {}  # numbers of open connections by databases
+__pools_lock = Lock()  # lock of the pools
+__pools_pid: int | None = None  # process of the pools
+__held = local()  # connections held by the current thread
+
+__accesses: Dict[str, float] = {}  # unwritten last accesses of results
+__accesses_lock = Lock()  # lock of the unwritten last accesses
+__sweeper: Thread | None = None  # background sweeper of the database
+__sweeper_pid: int | None = None  # process of the sweeper
+__sweeper_stop = Event()  # stops the sweeper
+
+
+def __connect(db_file: str) -> Connection:
+    """
+    Open and prepare a new database connection.
+
+    The connection uses WAL journaling, so readers do not block the writer,
+    and it enforces foreign keys, so variants of responses are deleted with
+    their results. It may be used by any thread, one at a time.
+
+    :param str db_file: database file name
+    :return Connection: open database connection
+    """
+    connection = connect(
+        db_file,
+        check_same_thread=False,
+        cached_statements=__CACHED_STATEMENTS,
+    )
+    # only applied to new databases, see convert for the existing ones
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = {__CACHE_SIZE}")
+    connection.execute("PRAGMA foreign_keys = ON")
+
+    return connection
+
+
+def __migrate(connection: Connection) -> None:
+    """
+    Create the schema of a database and migrate it from older schemas.
+
+    :param Connection connection: open database connection
+    """
+    for obsolete_table in ("request", "response"):
+        connection.execute(f"DROP TABLE IF EXISTS {obsolete_table}")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS result " +
+        "(hash TEXT PRIMARY KEY, version INTEGER NOT NULL, " +
+        "sorting_type TEXT NOT NULL, items BLOB NOT NULL, " +
+        "ends BLOB NOT NULL, keys BLOB, profile TEXT, " +
+        "created REAL, accessed REAL, size INTEGER, rates TEXT, " +
+        "msgpack_items BLOB, msgpack_ends BLOB)",
+    )
+    columns = [c[1] for c in connection.execute("PRAGMA table_info(result)")]
+    for column, column_type in (
+        ("keys", "BLOB"),
+        ("profile", "TEXT"),
+        ("created", "REAL"),
+        ("accessed", "REAL"),
+        ("size", "INTEGER"),
+        ("rates", "TEXT"),
+        ("msgpack_items", "BLOB"),
+        ("msgpack_ends", "BLOB"),
+    ):
+        if column not in columns:
+            connection.execute(
+                f"ALTER TABLE result ADD COLUMN {column} {column_type}",
+            )
+    if "size" not in columns:
+        connection.execute(
+            "UPDATE result SET created = ?, accessed = ?, " +
+            "size = length(items) + length(ends) + " +
+            "coalesce(length(keys), 0)",
+            (time(), time()),
+        )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS result_accessed ON result (accessed)",
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS variant " +
+        "(hash TEXT NOT NULL REFERENCES result (hash) ON DELETE CASCADE, " +
+        "etag TEXT NOT NULL, body BLOB NOT NULL, PRIMARY KEY (hash, etag))",
+    )
+    connection.commit()
+
+
+def db_file_name() -> str:
+    """
+    Get the default database file name.
+
+    It is read on each use, so the database may be changed (e.g., by tests)
+    after this module is imported.
+
+    :return str: the REQUESTS_DB environment variable or "requests.db"
+    """
+    return getenv("REQUESTS_DB", "requests.db")
+
+
+def __open_pool(db_file: str) -> Queue[Connection]:
+    """
+    Get the pool of connections of a database, which is opened on first use.
+
+    The schema of the database is created and migrated when its pool is
+    opened, by the first connection. Pools inherited from a parent process
+    are not used, a new process opens its own pools.
+
+    :param str db_file: database file name
+    :return Queue[Connection]: idle connections of the database
+    """
+    global __pools_pid
+    with __pools_lock:
+        if __pools_pid != getpid():
+            __pools.clear()
+            __opened.clear()
+            __pools_pid = getpid()
+
+        pool = __pools.get(db_file)
+        if pool is None:
+            with stage("db_connect"):
+                first = __connect(db_file)
+                try:
+                    __migrate(first)
+                except Error:
+                    first.close()
+                    raise
+            pool = __pools[db_file] = Queue()
+            pool.put(first)
+            __opened[db_file] = 1
+
+        return pool
+
+
+def __acquire(db_file: str, pool: Queue[Connection]) -> Connection:
+    """
+    Take an idle connection from the pool of connections of a database.
+
+    A new connection is opened if there is no idle one and the pool is not
+    full. Otherwise, a connection is waited for.
+
+    :param str db_file: database file name
+    :param Queue[Connection] pool: idle connections of the database
+    :return Connection: open database connection
+    """
+    try:
+        return pool.get_nowait()
+    except Empty:
+        pass
+
+    with __pools_lock:
+        full = __opened.get(db_file, 0) >= __POOL_SIZE
+        if not full:
+            __opened[db_file] = __opened.get(db_file, 0) + 1
+
+    if full:
+        return pool.get()
+
+    try:
+        with stage("db_connect"):
+            return __connect(db_file)
+    except Error:
+        __forget(db_file, pool)
+        raise
+
+
+def __forget(db_file: str, pool: Queue[Connection]) -> None:
+    """
+    Forget a connection of the pool of connections of a database.
+
+    :param str db_file: database file name
+    :param Queue[Connection] pool: idle connections of the database
+    """
+    with __pools_lock:
+        if __pools.get(db_file) is pool:
+            __opened[db_file] -= 1
+
+
+def __release(
+    db_file: str, pool: Queue[Connection], connection: Connection,
+) -> None:
+    """
+    Return a connection to the pool of connections of a database.
+
+    An unfinished transaction of the connection is rolled back. The
+    connection is closed if the pool has been closed meanwhile or if it
+    cannot be rolled back.
+
+    :param str db_file: database file name
+    :param Queue[Connection] pool: idle connections of the database
+    :param Connection connection: the returned connection
+    """
+    try:
+        if connection.in_transaction:
+            connection.rollback()
+    except Error:
+        connection.close()
+        __forget(db_file, pool)
+        return
+
+    with __pools_lock:
+        if __pools.get(db_file) is pool:
+            pool.put(connection)
+            return
+
+    connection.close()
+
+
+def open_pool(db_file: str | None = None) -> None:
+    """
+    Open the pool of connections of a database before serving.
+
+    :param str | None db_file: database file name, defaults to None
+        (see db_file_name)
+    """
+    __open_pool(db_file or db_file_name())
+
+
+@contextmanager
+def connection(db_file: str | None = None) -> Iterator[Connection]:
+    """
+    Hold an open database connection from the pool of the process.
+
+    The connection is held by the current thread until the block ends, then
+    it is returned to the pool and kept open for later uses. Nested blocks of
+    the same thread hold the same connection.
+
+    :param str | None db_file: database file name, defaults to None
+        (see db_file_name)
+    :yield Iterator[Connection]: open database connection
+    """
+    db_file = db_file or db_file_name()
+    if not hasattr(__held, "connections"):
+        __held.connections = {}
+
+    held: Dict[str, Connection] = __held.connections
+    if db_file in held:
+        yield held[db_file]
+        return
 
-__DB_FILE = "requests.db"  # database file name
+    pool = __open_pool(db_file)
+    held[db_file] = __acquire(db_file, pool)
+    try:
+        yield held[db_file]
+    finally:
+        __release(db_file, pool, held.pop(db_file))
+
+
+def close_connections() -> None:
+    """
+    Close all the idle database connections of the process.
+
+    The pools are closed, so connections held meanwhile are closed when they
+    are returned, and new pools are opened on the next use.
+    """
+    with __pools_lock:
+        pools = list(__pools.values())
+        __pools.clear()
+        __opened.clear()
+
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except Empty:
+                break
 
 
 @contextmanager
-def database() -> Iterator[Cursor]:
+def database(db_file: str | None = None) -> Iterator[Cursor]:
     """
-    Open, prepare, and return a database (cursor) for working with sorting
-    requests.
+    Return a database (cursor) for working with sorting requests.
 
-    The database and cursor are closed afterwards.
+    The database connection is held from the pool of the process. Only the
+    cursor is closed afterwards.
 
+    :param str | None db_file: database file name, defaults to None
+        (see db_file_name)
     :yield Iterator[Cursor]: open database cursor
     """
-    with (
-        closing(connect(__DB_FILE)) as connection,
-        closing(connection.cursor()) as cursor,
-    ):
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS request " +
-            "(hash TEXT PRIMARY KEY, request TEXT)",
+    with connection(db_file) as pooled:
+        with closing(pooled.cursor()) as cursor:
+            yield cursor
+
+
+def touch(token: str) -> None:
+    """
+    Record an access of a cached result.
+
+    The access is only recorded in memory and it is written by the sweeper.
+    Nothing is recorded in processes without the sweeper (e.g., workers).
+
+    :param str token: token of the accessed result
+    """
+    if __sweeper_pid == getpid():
+        with __accesses_lock:
+            __accesses[token] = time()
+
+
+def __delete_expired(cursor: Cursor, accessed_before: float) -> int:
+    """
+    Delete results not accessed since a time, in batches.
+
+    :param Cursor cursor: database cursor
+    :param float accessed_before: time of the last access of deleted results
+    :return int: number of the deleted results
+    """
+    deleted = 0
+    while True:
+        batch = cursor.execute(
+            "DELETE FROM result WHERE rowid IN (SELECT rowid FROM result " +
+            "WHERE accessed < ? LIMIT ?)",
+            (accessed_before, __SWEEP_BATCH),
+        ).rowcount
+        cursor.connection.commit()
+        deleted += batch
+        if batch < __SWEEP_BATCH:
+            return deleted
+
+
+def __delete_oversized(cursor: Cursor, max_bytes: int) -> int:
+    """
+    Delete the least recently accessed results over a size cap, in batches.
+
+    :param Cursor cursor: database cursor
+    :param int max_bytes: maximal total size of results in bytes
+    :return int: number of the deleted results
+    """
+    deleted = 0
+    total = cursor.execute(
+        "SELECT coalesce(sum(size), 0) FROM result",
+    ).fetchone()[0]
+    while total > max_bytes:
+        victims = []
+        for rowid, size in cursor.execute(
+            "SELECT rowid, size FROM result ORDER BY accessed LIMIT ?",
+            (__SWEEP_BATCH,),
+        ).fetchall():
+            if total <= max_bytes:
+                break
+            victims.append((rowid,))
+            total -= size or 0
+        if not victims:
+            break
+
+        cursor.executemany("DELETE FROM result WHERE rowid = ?", victims)
+        cursor.connection.commit()
+        deleted += len(victims)
+
+    return deleted
+
+
+def __vacuum(cursor: Cursor) -> None:
+    """
+    Return free pages of the database to the file system, in batches.
+
+    A database without incremental vacuuming is not vacuumed, its free pages
+    are only reused by later results (see convert).
+
+    :param Cursor cursor: database cursor
+    """
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return
+
+    free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    while free_pages > 0:
+        cursor.execute(f"PRAGMA incremental_vacuum({__VACUUM_PAGES})")
+        cursor.fetchall()
+        cursor.connection.commit()
+        remaining = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free_pages:
+            break
+        free_pages = remaining
+
+
+def sweep(
+    cursor: Cursor,
+    ttl: float = __TTL,
+    max_bytes: int = __MAX_BYTES,
+) -> int:
+    """
+    Write recorded accesses, evict results, and vacuum the database.
+
+    Results not accessed for the TTL are evicted first, then the least
+    recently accessed ones over the size cap.
+
+    :param Cursor cursor: database cursor
+    :param float ttl: seconds since the last access of evicted results,
+        defaults to the REQUESTS_DB_TTL environment variable or 7 days,
+        0 means no expiration
+    :param int max_bytes: maximal total size of results in bytes, defaults to
+        the REQUESTS_DB_MAX_BYTES environment variable or 1 GiB, 0 means
+        unlimited
+    :return int: number of the evicted results
+    """
+    with stage("db_sweep"):
+        with __accesses_lock:
+            accesses = [(t, token) for token, t in __accesses.items()]
+            __accesses.clear()
+        cursor.executemany(
+            "UPDATE result SET accessed = max(accessed, ?) WHERE hash = ?",
+            accesses,
         )
-        connection.commit()
+        cursor.connection.commit()
+
+        expired = 0 if ttl <= 0 else __delete_expired(cursor, time() - ttl)
+        oversized = 0 if max_bytes <= 0 else __delete_oversized(
+            cursor, max_bytes,
+        )
+        __vacuum(cursor)
+
+    if expired:
+        count("sorting_cache_evictions_total", expired, reason="ttl")
+    if oversized:
+        count("sorting_cache_evictions_total", oversized, reason="size")
+
+    return expired + oversized
+
+
+def convert(db_file: str | None = None) -> bool:
+    """
+    Convert a database to incremental vacuuming, if it is not converted.
+
+    The conversion is a full vacuum, which locks the whole database until it
+    finishes, so it is run offline before serving (it is never run by the
+    sweeper).
+
+    :param str | None db_file: database file name, defaults to None
+        (see db_file_name)
+    :return bool: True if the database has been converted
+    """
+    with database(db_file) as cursor:
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+
+    return True
+
+
+def __sweep_periodically(db_file: str, interval: float) -> None:
+    """
+    Sweep the database periodically until the sweeper is stopped.
+
+    :param str db_file: database file name
+    :param float interval: seconds between sweeps
+    """
+    while not __sweeper_stop.wait(interval):
+        try:
+            with database(db_file) as cursor:
+                sweep(cursor)
+        except Error:
+            pass  # e.g., the database is locked, the next sweep retries
+
+
+def start_sweeper(
+    db_file: str | None = None, interval: float = __SWEEP_INTERVAL,
+) -> None:
+    """
+    Start the background sweeper of the database, if it is not running.
+
+    :param str | None db_file: database file name, defaults to None
+        (see db_file_name)
+    :param float interval: seconds between sweeps, defaults to the
+        REQUESTS_DB_SWEEP_INTERVAL environment variable or 60, 0 means no
+        sweeper
+    """
+    global __sweeper, __sweeper_pid
+    if interval <= 0 or (
+        __sweeper is not None
+        and __sweeper.is_alive()
+        and __sweeper_pid == getpid()
+    ):
+        return
+
+    __sweeper_stop.clear()
+    __sweeper = Thread(
+        target=__sweep_periodically,
+        args=(db_file or db_file_name(), interval),
+        name="requests-db-sweeper",
+        daemon=True,
+    )
+    __sweeper_pid = getpid()
+    __sweeper.start()
+
+
+def stop_sweeper() -> None:
+    """Stop the background sweeper of the database, if it is running."""
+    global __sweeper, __sweeper_pid
+    if __sweeper is not None:
+        __sweeper_stop.set()
+        if __sweeper_pid == getpid():
+            __sweeper.join()
+        __sweeper = None
+        __sweeper_pid = None
+
+
+def main() -> None:
+    """Convert the database to incremental vacuuming before serving."""
+    db_file = db_file_name()
+    if convert(db_file):
+        print(f"Converted {db_file} to incremental vacuuming.")
+    close_connections()
+
 
-        yield cursor
+if __name__ == "__main__":
+    main()
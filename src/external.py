@@ -0,0 +1,276 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module sorting streams of itineraries larger than memory.
+
+Itineraries are read one by one from newline-delimited JSON and validated by
+the same rules as itineraries of sorting requests. They are sorted in runs
+fitting into a memory budget, which are spilled to temporary files. The runs
+are merged lazily (k-way), so the memory used does not depend on the number
+of itineraries. The result is the same as of sorting all the itineraries of
+a sorting request at once.
+"""
+
+import json
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from os import getenv, remove
+from os.path import join as join_path
+from tempfile import TemporaryDirectory
+from typing import Any, Iterable, Iterator, List, Tuple
+
+from .batch import ItineraryBatch
+from .metrics import count, stage
+from .parsing import Itineraries, Itinerary, ParsingError, Request, SortingType
+from .result import CHUNK_SIZE
+from .sorting import sort_keys, sort_permutation
+
+EXTERNAL_SORT_MEMORY = int(
+    getenv("EXTERNAL_SORT_MEMORY", str(64 * 1024 * 1024)),
+)
+"""memory budget of a sorted run of itineraries in bytes"""
+
+EXTERNAL_SORT_FAN_IN = int(getenv("EXTERNAL_SORT_FAN_IN", "64"))
+"""maximal number of runs merged at once (i.e., of open run files)"""
+
+__ITINERARY_BYTES = 384  # memory of a buffered itinerary and its sorting keys
+
+Record = Tuple[List[Any], str]
+"""sorting keys of an itinerary and its serialised line in a run"""
+
+
+def __parse_line(line: bytes, n: int, request: Request) -> Itinerary:
+    """
+    Parse an itinerary of a line of a stream.
+
+    :param bytes line: the line in the JSON format
+    :param int n: index of the itinerary in the stream
+    :param Request request: sorting request without itineraries, with the
+        sorting criteria and the EUR rates of the stream
+    :return Itinerary: the parsed itinerary
+    :raises ParsingError: if parsing of the itinerary failed, with its index
+        in the message
+    """
+    try:
+        itinerary_json = json.loads(line)
+        if not isinstance(itinerary_json, dict):
+            raise ParsingError
+
+        return Itinerary(itinerary_json, request.rates)
+    except (ValueError, RecursionError, ParsingError):
+        raise ParsingError(
+            f"Format of the itinerary {n} of the given sorting stream is " +
+            "not valid.",
+        )
+
+
+def __write_run(
+    itineraries: Itineraries, request: Request, run_file: str,
+) -> None:
+    """
+    Sort itineraries and write them into a run file.
+
+    The itineraries are sorted the same as itineraries of a sorting request.
+    Each line of the run contains the sorting keys of an itinerary (ending
+    with its canonical form, so the merge breaks ties the same) and the
+    serialised itinerary.
+
+    :param Itineraries itineraries: itineraries of the run
+    :param Request request: sorting request without itineraries, with the
+        sorting criteria
+    :param str run_file: file of the run
+    """
+    with stage("sort"):
+        canonical_forms = [i._canonical() for i in itineraries]
+        canonical_order = sorted(
+            range(len(itineraries)), key=canonical_forms.__getitem__,
+        )
+        itineraries = [itineraries[i] for i in canonical_order]
+        canonical_forms = [canonical_forms[i] for i in canonical_order]
+        batch = ItineraryBatch.from_itineraries(itineraries)
+        keys = sort_keys(batch, request.sorting_type, request.profile).tolist()
+        tie_keys = (
+            request.profile.tie_keys(batch)
+            if request.sorting_type == SortingType.BEST
+                else [()] * len(batch)
+        )
+        permutation = sort_permutation(
+            batch, request.sorting_type, profile=request.profile,
+        )
+
+    with open(run_file, "w", encoding="ascii") as f:
+        for i in permutation.tolist():
+            f.write(json.dumps(
+                [keys[i], *tie_keys[i], canonical_forms[i]],
+                separators=(",", ":"),
+            ))
+            f.write("\t")
+            f.write(itineraries[i]._serialise_json())
+            f.write("\n")
+
+
+def __read_run(run_file: str) -> Iterator[Record]:
+    """
+    Read records of a run file one by one.
+
+    :param str run_file: file of the run
+    :return Iterator[Record]: records of the run in the sorted order
+    """
+    with open(run_file, encoding="ascii") as f:
+        for line in f:
+            keys, itinerary = line.split("\t", 1)
+            yield json.loads(keys), itinerary
+
+
+def __merge_runs(run_files: List[str]) -> Iterator[Record]:
+    """
+    Merge sorted runs lazily.
+
+    :param List[str] run_files: files of the runs
+    :return Iterator[Record]: records of all the runs in the sorted order
+    """
+    return merge(*map(__read_run, run_files), key=itemgetter(0))
+
+
+def __spill(
+    lines: Iterable[bytes],
+    request: Request,
+    directory: str,
+    memory: int,
+    fan_in: int,
+) -> List[str]:
+    """
+    Sort itineraries of a stream into runs spilled to files.
+
+    Runs are merged in passes until at most fan_in of them remain, so they can
+    be merged at once.
+
+    :param Iterable[bytes] lines: lines of the stream
+    :param Request request: sorting request without itineraries, with the
+        sorting criteria and the EUR rates of the stream
+    :param str directory: directory of the run files
+    :param int memory: memory budget of a run in bytes
+    :param int fan_in: maximal number of runs merged at once
+    :return List[str]: files of the runs
+    :raises ParsingError: if parsing of an itinerary failed
+    """
+    run_files: List[str] = []
+    buffer: Itineraries = []
+    buffered = 0
+    n = 0
+
+    def spill() -> None:
+        run_files.append(join_path(directory, f"run_{len(run_files)}"))
+        __write_run(buffer, request, run_files[-1])
+        buffer.clear()
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        buffer.append(__parse_line(line, n, request))
+        buffered += len(line) + __ITINERARY_BYTES
+        n += 1
+        if buffered >= memory:
+            spill()
+            buffered = 0
+
+    if buffer:
+        spill()
+    count("sorting_spilled_runs_total", len(run_files))
+
+    passes = 0
+    while len(run_files) > fan_in:
+        merged_files = []
+        for start in range(0, len(run_files), fan_in):
+            group = run_files[start:start + fan_in]
+            merged_files.append(join_path(
+                directory, f"merged_{passes}_{len(merged_files)}",
+            ))
+            with open(merged_files[-1], "w", encoding="ascii") as f:
+                for keys, itinerary in __merge_runs(group):
+                    f.write(json.dumps(keys, separators=(",", ":")))
+                    f.write("\t")
+                    f.write(itinerary)
+            for run_file in group:
+                remove(run_file)
+        run_files = merged_files
+        passes += 1
+
+    return run_files
+
+
+def __stream_merged(
+    run_files: List[str],
+    directory: TemporaryDirectory,
+    limit: int | None,
+    chunk_size: int,
+) -> Iterator[bytes]:
+    """
+    Stream merged runs by chunks and remove them afterwards.
+
+    :param List[str] run_files: files of the runs
+    :param TemporaryDirectory directory: directory of the run files
+    :param int | None limit: maximal number of streamed itineraries, None if
+        unlimited
+    :param int chunk_size: minimal size of a chunk in bytes
+    :return Iterator[bytes]: chunks of sorted itineraries in the
+        newline-delimited JSON format
+    """
+    try:
+        chunk: List[str] = []
+        size = 0
+        for _, itinerary in islice(__merge_runs(run_files), limit):
+            chunk.append(itinerary)
+            size += len(itinerary)
+            if size >= chunk_size:
+                yield "".join(chunk).encode("ascii")
+                chunk.clear()
+                size = 0
+        if chunk:
+            yield "".join(chunk).encode("ascii")
+    finally:
+        directory.cleanup()
+
+
+def sort_stream(
+    lines: Iterable[bytes],
+    request: Request,
+    memory: int = EXTERNAL_SORT_MEMORY,
+    fan_in: int = EXTERNAL_SORT_FAN_IN,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Sort a stream of itineraries in the newline-delimited JSON format.
+
+    The whole stream is read, validated, and spilled to sorted runs before
+    this function returns, so an invalid itinerary is reported before any
+    sorted itinerary is streamed. The sorted itineraries are then merged
+    while they are being streamed. Temporary files are removed once the
+    streaming finishes (or the returned iterator is garbage-collected).
+
+    :param Iterable[bytes] lines: lines of the stream, each with an itinerary
+        in the JSON format (blank lines are skipped)
+    :param Request request: sorting request without itineraries, with the
+        sorting criteria, the limit, and the EUR rates of the stream
+    :param int memory: memory budget of a sorted run in bytes, defaults to
+        the EXTERNAL_SORT_MEMORY environment variable or 64 MiB
+    :param int fan_in: maximal number of runs merged at once, defaults to the
+        EXTERNAL_SORT_FAN_IN environment variable or 64
+    :param int chunk_size: minimal size of a chunk of the sorted itineraries
+        in bytes, defaults to CHUNK_SIZE
+    :return Iterator[bytes]: chunks of the sorted itineraries in the
+        newline-delimited JSON format
+    :raises ParsingError: if parsing of an itinerary failed
+    """
+    directory = TemporaryDirectory(prefix="itineraries-")
+    try:
+        run_files = __spill(
+            lines, request, directory.name, memory, max(2, fan_in),
+        )
+    except BaseException:
+        directory.cleanup()
+        raise
+
+    return __stream_merged(run_files, directory, request.limit, chunk_size)
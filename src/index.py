@@ -2,38 +2,199 @@
 
 """The index of the REST API."""
 
+import json
 from http import HTTPMethod, HTTPStatus
+from typing import Any, Dict
 
 from flask import Flask, Response
 from flask import request as http_request
 
-from .db import database
+from .db import database, open_pool, start_sweeper
+from .external import sort_stream
+from .metrics import CONTENT_TYPE, SERVER_TIMING, record, render, stage
+from .negotiation import content_format
 from .parsing import ParsingError, Request
-from .sorting import sort_request
+from .rates import warm_up
+from .service import (
+    Condition,
+    Page,
+    Representation,
+    SortedResponse,
+    memory_cache,
+    represent,
+    update_body,
+)
+from .sorting import load_sorted
+from .workers import sort
 
 app = Flask(__name__)
 """instance of the Flask application"""
 
 
+def start() -> None:
+    """
+    Start the background work of the application before serving it.
+
+    Rates are loaded before the first request and refreshed in the
+    background. The database is migrated and its connection pool is opened
+    before the first request, and it is maintained by the background sweeper.
+    Nothing is started when this module is only imported (e.g., by tests).
+    """
+    warm_up()
+    open_pool()
+    start_sweeper()
+
+
+def create_app() -> Flask:
+    """
+    Start the Flask application (a factory for ``flask run``).
+
+    :return Flask: the started Flask application
+    """
+    start()
+    return app
+
+
+def __represent(
+    response: SortedResponse,
+    page: Page | None = None,
+    conditional: bool = True,
+) -> Representation:
+    """
+    Negotiate a representation of a response with the client.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :param Page | None page: page of the sorted itineraries, defaults to None
+        (a response of a sorting request)
+    :param bool conditional: whether the If-None-Match header is applied,
+        defaults to True
+    :return Representation: the negotiated representation
+    """
+    return represent(
+        response,
+        page,
+        "pretty" in http_request.args,
+        http_request.headers.get("Accept"),
+        http_request.headers.get("Accept-Encoding"),
+        http_request.headers.get("If-None-Match") if conditional else None,
+    )
+
+
+def __condition() -> Condition | None:
+    """
+    Get the condition of a sorting request given by the client.
+
+    :return Condition | None: the condition, None if the If-None-Match header
+        is not given
+    """
+    if_none_match = http_request.headers.get("If-None-Match")
+    if not if_none_match:
+        return None
+
+    return Condition(
+        if_none_match,
+        "pretty" in http_request.args,
+        http_request.headers.get("Accept"),
+        http_request.headers.get("Accept-Encoding"),
+    )
+
+
 @app.route("/sort_itineraries", methods=[HTTPMethod.POST])
 def sort_itineraries() -> Response:
     """
     Process a sorting itineraries POST request.
 
-    A sorting itineraries end-point.
+    A sorting itineraries end-point. If multiple sorting criteria are given,
+    the response contains results of all of them. Large requests are
+    processed in a worker pool. The request and the response may be in the
+    MessagePack format instead of JSON (by the Content-Type and Accept
+    headers). A JSON response is streamed in the compact format, unless the
+    pretty query argument is given or it is compressed. It is not sent again
+    if it matches the If-None-Match header, which is checked before sorting.
+    Durations of stages of the processing are given in the Server-Timing
+    header, if enabled.
 
     :return Response: HTTP response
     """
     try:
-        request = Request(http_request.get_json())
+        with record() as recording, stage("total"):
+            sorted_response = sort(
+                http_request.get_data(),
+                content_format(http_request.content_type),
+                __condition(),
+            )
+
+        representation = (
+            sorted_response if isinstance(sorted_response, Representation)
+                else __represent(sorted_response)
+        )
+        headers = representation.headers
+        if SERVER_TIMING:
+            headers["Server-Timing"] = recording.server_timing()
+
+        return Response(
+            representation.body,
+            status=representation.status,
+            headers=headers,
+        )
+
+    except ParsingError as e:
+        return Response(e.message, status=HTTPStatus.BAD_REQUEST)
+
+    except TimeoutError:
+        return Response(
+            "Sorting timed out.", status=HTTPStatus.SERVICE_UNAVAILABLE,
+        )
+
+    except:
+        return Response(
+            "Internal error.", status=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+
+
+def __stream_request() -> Request:
+    """
+    Parse the query arguments of a sorting stream request.
+
+    The sorting criteria, the scoring profile, and the limit are given by the
+    sorting_type, scoring_profile, and limit query arguments and they are
+    validated the same as fields of a sorting request.
+
+    :return Request: sorting request without itineraries
+    :raises ParsingError: if the query arguments are not valid
+    """
+    request_json: Dict[str, Any] = {
+        "sorting_type": http_request.args.get("sorting_type"),
+        "itineraries": [],
+    }
+    if "scoring_profile" in http_request.args:
+        request_json["scoring_profile"] = http_request.args["scoring_profile"]
+    limit = __page_argument("limit")
+    if limit is not None:
+        request_json["limit"] = limit
+
+    return Request(request_json)
 
-        with database() as cursor:
-            request = sort_request(request, cursor)
+
+@app.route("/sort_itineraries/stream", methods=[HTTPMethod.POST])
+def sort_itineraries_stream() -> Response:
+    """
+    Process a sorting stream of itineraries POST request.
+
+    A sorting end-point for itineraries larger than memory, given in the
+    newline-delimited JSON format (an itinerary per line). They are sorted in
+    runs spilled to temporary files, which are merged while the sorted
+    itineraries are streamed in the newline-delimited JSON format.
+
+    :return Response: HTTP response
+    """
+    try:
+        sorted_stream = sort_stream(http_request.stream, __stream_request())
 
         return Response(
-            request.to_json(),
+            sorted_stream,
             status=HTTPStatus.OK,
-            mimetype="application/json",
+            mimetype="application/x-ndjson",
         )
 
     except ParsingError as e:
@@ -43,3 +204,142 @@ def sort_itineraries() -> Response:
         return Response(
             "Internal error.", status=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
+
+
+def __page_argument(name: str) -> int | None:
+    """
+    Parse a non-negative integer query argument (e.g., of a page request).
+
+    :param str name: name of the argument
+    :return int | None: value of the argument, None if it is not given
+    :raises ParsingError: if the argument is not a non-negative integer
+    """
+    value = http_request.args.get(name)
+    if value is None:
+        return None
+
+    # unlike isdigit, only characters accepted by int (e.g., not "²")
+    if not value.isdecimal():
+        raise ParsingError(
+            f"Format of the given {name} argument is not valid.",
+        )
+
+    return int(value)
+
+
+@app.route("/sorted_itineraries/<token>", methods=[HTTPMethod.GET])
+def sorted_itineraries(token: str) -> Response:
+    """
+    Process a page of sorted itineraries GET request.
+
+    A paging end-point over itineraries sorted by a previous sorting request,
+    identified by the token of its response. The page is given by the offset
+    and limit query arguments. The format of the response is negotiated as
+    for sorting requests. It is not sent again if it matches the
+    If-None-Match header.
+
+    :param str token: token of the sorted itineraries
+    :return Response: HTTP response
+    """
+    try:
+        offset = __page_argument("offset") or 0
+        limit = __page_argument("limit")
+
+        with database() as cursor:
+            result = load_sorted(token, cursor, memory_cache)
+
+        if result is None:
+            return Response(
+                "The given token is not valid or it expired.",
+                status=HTTPStatus.NOT_FOUND,
+            )
+
+        representation = __represent(result, (offset, limit))
+
+        return Response(
+            representation.body,
+            status=representation.status,
+            headers=representation.headers,
+        )
+
+    except ParsingError as e:
+        return Response(e.message, status=HTTPStatus.BAD_REQUEST)
+
+    except:
+        return Response(
+            "Internal error.", status=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+
+
+@app.route("/sorted_itineraries/<token>", methods=[HTTPMethod.PATCH])
+def update_sorted_itineraries(token: str) -> Response:
+    """
+    Process a change of sorted itineraries PATCH request.
+
+    An end-point adding itineraries to and removing them from itineraries
+    sorted by a previous sorting request, identified by the token of its
+    response, without sorting them again. The response contains the changed
+    sorted itineraries with a new token. Formats of the request and the
+    response are negotiated as for sorting requests.
+
+    :param str token: token of the sorted itineraries
+    :return Response: HTTP response
+    """
+    try:
+        result = update_body(
+            token,
+            http_request.get_data(),
+            content_format(http_request.content_type),
+        )
+
+        if result is None:
+            return Response(
+                "The given token is not valid or it expired.",
+                status=HTTPStatus.NOT_FOUND,
+            )
+
+        representation = __represent(result, conditional=False)
+
+        return Response(
+            representation.body,
+            status=representation.status,
+            headers=representation.headers,
+        )
+
+    except ParsingError as e:
+        return Response(e.message, status=HTTPStatus.BAD_REQUEST)
+
+    except:
+        return Response(
+            "Internal error.", status=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+
+
+@app.route("/cache_stats", methods=[HTTPMethod.GET])
+def cache_stats() -> Response:
+    """
+    Process a cache statistics GET request.
+
+    An end-point with counters of the in-memory cache of sorted itineraries.
+
+    :return Response: HTTP response
+    """
+    return Response(
+        json.dumps(memory_cache.stats(), indent=2),
+        status=HTTPStatus.OK,
+        mimetype="application/json",
+    )
+
+
+@app.route("/metrics", methods=[HTTPMethod.GET])
+def metrics() -> Response:
+    """
+    Process a metrics GET request.
+
+    An end-point with latencies of stages of processing of sorting requests,
+    cache hits and misses, and sizes of payloads in the Prometheus text
+    format.
+
+    :return Response: HTTP response
+    """
+    return Response(render(), status=HTTPStatus.OK, content_type=CONTENT_TYPE)
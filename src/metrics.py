@@ -0,0 +1,293 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with low-overhead metrics of processing of sorting requests.
+
+Stages of processing are timed into histograms, and cache hits and misses
+and sizes of payloads are counted. The metrics are rendered in the
+Prometheus text format. Stages are also the points where processing bounded
+by a deadline is aborted, so it is never aborted in the middle of a stage.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from threading import Lock
+from time import perf_counter, time
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+SERVER_TIMING = getenv("SERVER_TIMING", "0") not in ("", "0")
+"""whether responses to sorting requests have the Server-Timing header"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""content type of the metrics in the Prometheus text format"""
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+"""key of a metric: its name and sorted (label name, label value) pairs"""
+
+__HELP = {
+    "sorting_stage_seconds":
+        "Latency of stages of processing of sorting requests in seconds.",
+    "sorting_request_bytes": "Size of bodies of sorting requests in bytes.",
+    "sorting_response_bytes_total":
+        "Total size of bodies of sorting responses in bytes.",
+    "sorting_cache_hits_total": "Number of sorted itineraries found in caches.",
+    "sorting_cache_misses_total":
+        "Number of sorted itineraries not found in caches.",
+    "sorting_cache_evictions_total":
+        "Number of sorted itineraries evicted from the database.",
+    "sorting_coalesced_total":
+        "Number of sorting requests sharing a concurrent identical one.",
+    "sorting_not_modified_total":
+        "Number of responses not modified since a client received them.",
+    "sorting_compressed_total": "Number of compressed bodies of responses.",
+    "sorting_spilled_runs_total":
+        "Number of sorted runs of streamed itineraries spilled to files.",
+}  # help texts of the metrics
+
+__BUCKETS = {
+    "sorting_stage_seconds": (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    ),
+    "sorting_request_bytes": tuple(float(4 ** n) for n in range(5, 15)),
+}  # upper bounds of buckets of the histograms
+
+__lock = Lock()  # lock of the global metrics
+__counters: Dict[Key, float] = {}  # global counters
+__histograms: Dict[Key, Histogram] = {}  # global histograms
+
+_current: ContextVar[Recording | None] = ContextVar("recording", default=None)
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+class Histogram:
+    """Histogram of observed values with fixed buckets."""
+
+    def __init__(self: Histogram, buckets: Sequence[float]) -> None:
+        """
+        Construct an empty histogram.
+
+        :param Sequence[float] buckets: sorted upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self: Histogram, value: float) -> None:
+        """
+        Observe a value.
+
+        :param float value: the observed value
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Recording:
+    """
+    Metrics recorded during processing of a sorting request.
+
+    They are not applied to the global metrics until the recording is
+    merged, so they can be passed from a worker process back to the server.
+    """
+
+    def __init__(self: Recording) -> None:
+        """Construct an empty recording."""
+        self.counters: List[Tuple[Key, float]] = []
+        self.observations: List[Tuple[Key, float]] = []
+
+    def merge(self: Recording) -> None:
+        """
+        Merge the recording into the current one or into the global metrics.
+        """
+        for (name, labels), amount in self.counters:
+            count(name, amount, **dict(labels))
+        for (name, labels), value in self.observations:
+            observe(name, value, **dict(labels))
+
+    def server_timing(self: Recording) -> str:
+        """
+        Get durations of the recorded stages as a Server-Timing header value.
+
+        :return str: value of the Server-Timing header
+        """
+        durations: Dict[str, float] = {}
+        for (name, labels), value in self.observations:
+            if name == "sorting_stage_seconds":
+                stage_name = dict(labels)["stage"]
+                durations[stage_name] = durations.get(stage_name, 0) + value
+
+        return ", ".join(
+            f"{stage_name};dur={duration * 1e3:.3f}"
+            for stage_name, duration in durations.items()
+        )
+
+
+def __histogram(key: Key) -> Histogram:
+    """
+    Get a global histogram, which is created on the first use.
+
+    The lock of the global metrics has to be held.
+
+    :param Key key: key of the histogram
+    :return Histogram: the global histogram
+    """
+    histogram = __histograms.get(key)
+    if histogram is None:
+        histogram = __histograms[key] = Histogram(__BUCKETS[key[0]])
+
+    return histogram
+
+
+def count(name: str, amount: float = 1, **labels: str) -> None:
+    """
+    Increase a counter.
+
+    :param str name: name of the counter
+    :param float amount: increment of the counter, defaults to 1
+    :param str labels: labels of the counter
+    """
+    key = (name, tuple(sorted(labels.items())))
+    current = _current.get()
+    if current is not None:
+        current.counters.append((key, amount))
+        return
+
+    with __lock:
+        __counters[key] = __counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """
+    Observe a value by a histogram.
+
+    :param str name: name of the histogram
+    :param float value: the observed value
+    :param str labels: labels of the histogram
+    """
+    key = (name, tuple(sorted(labels.items())))
+    current = _current.get()
+    if current is not None:
+        current.observations.append((key, value))
+        return
+
+    with __lock:
+        __histogram(key).observe(value)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a stage of processing of sorting requests.
+
+    :param str name: name of the stage
+    :yield Iterator[None]: the timed stage
+    :raises TimeoutError: if the deadline of the processing has passed
+    """
+    current_deadline = _deadline.get()
+    if current_deadline is not None and time() >= current_deadline:
+        raise TimeoutError
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe("sorting_stage_seconds", perf_counter() - start, stage=name)
+
+
+@contextmanager
+def deadline(at: float) -> Iterator[None]:
+    """
+    Bound processing of a sorting request by a deadline.
+
+    The deadline is checked whenever a stage of the processing starts, so the
+    processing is aborted between stages (e.g., never within a database
+    transaction).
+
+    :param float at: time by which the processing has to finish
+    :yield Iterator[None]: the bounded processing
+    """
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def record(merge: bool = True) -> Iterator[Recording]:
+    """
+    Record metrics of processing of a sorting request.
+
+    :param bool merge: whether the recording is merged (into the enclosing
+        recording or into the global metrics) afterwards, defaults to True
+    :yield Iterator[Recording]: the recording
+    """
+    recording = Recording()
+    token = _current.set(recording)
+    try:
+        yield recording
+    finally:
+        _current.reset(token)
+        if merge:
+            recording.merge()
+
+
+def __labels(labels: Sequence[Tuple[str, str]]) -> str:
+    """
+    Format labels of a metric in the Prometheus text format.
+
+    :param Sequence[Tuple[str, str]] labels: (label name, label value) pairs
+    :return str: formatted labels, empty if there are none
+    """
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{n}="{v}"' for n, v in labels) + "}"
+
+
+def render() -> str:
+    """
+    Render the global metrics in the Prometheus text format.
+
+    :return str: the global metrics in the Prometheus text format
+    """
+    with __lock:
+        counters = dict(__counters)
+        histograms = {
+            key: (list(h.counts), h.sum) for key, h in __histograms.items()
+        }
+
+    lines = []
+    for name, help_text in __HELP.items():
+        kind = "histogram" if name in __BUCKETS else "counter"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for (key_name, labels), value in sorted(counters.items()):
+            if key_name == name:
+                lines.append(f"{name}{__labels(labels)} {value!r}")
+        for (key_name, labels), (counts, total) in sorted(histograms.items()):
+            if key_name != name:
+                continue
+
+            cumulative = 0
+            for bound, bucket_count in zip(
+                [*map(repr, __BUCKETS[name]), "+Inf"], counts,
+            ):
+                cumulative += bucket_count
+                bucket_labels = __labels([*labels, ("le", bound)])
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{__labels(labels)} {total!r}")
+            lines.append(f"{name}_count{__labels(labels)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """Reset the global metrics."""
+    with __lock:
+        __counters.clear()
+        __histograms.clear()
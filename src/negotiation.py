@@ -0,0 +1,264 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with conditional, compressed, and binary representations of responses.
+
+Sorted itineraries are identified by their tokens (digests of sorting
+requests), and itineraries with equal sorting keys are ordered by their
+canonical forms, so a token fixes the sorted itineraries. A strong entity tag
+of a response is thus derived from the tokens without serialising it. Content
+codings are negotiated by the ``Accept-Encoding`` header. Gzip is always
+available, Brotli and Zstandard are used only if the ``brotli`` and
+``zstandard`` packages are installed. Bodies of requests and responses may be
+encoded in MessagePack instead of JSON (negotiated by the ``Content-Type`` and
+``Accept`` headers).
+"""
+
+import gzip
+import json
+from enum import Enum
+from hashlib import blake2b
+from typing import Any, Callable, Dict, Sequence
+
+import msgpack
+
+
+class WireFormat(Enum):
+    """Formats of bodies of requests and responses by their media types."""
+
+    JSON = "application/json"
+    MSGPACK = "application/msgpack"
+
+
+WIRE_FORMATS = (WireFormat.JSON, WireFormat.MSGPACK)
+"""formats in the order of preference"""
+
+__MEDIA_TYPES = {
+    "application/json": WireFormat.JSON,
+    "application/msgpack": WireFormat.MSGPACK,
+    "application/x-msgpack": WireFormat.MSGPACK,
+    "application/vnd.msgpack": WireFormat.MSGPACK,
+}  # media types of the formats, including the unregistered ones
+
+Compressor = Callable[[bytes], bytes]
+"""compression of a body by a content coding"""
+
+__COMPRESSORS: Dict[str, Compressor] = {}  # by preference of the server
+
+try:
+    import zstandard
+
+    __COMPRESSORS["zstd"] = lambda body: (
+        zstandard.ZstdCompressor(level=3).compress(body)
+    )
+except ImportError:
+    pass
+
+try:
+    import brotli
+
+    __COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=5)
+except ImportError:
+    pass
+
+__COMPRESSORS["gzip"] = lambda body: gzip.compress(
+    body, compresslevel=6, mtime=0,
+)
+
+CODINGS = tuple(__COMPRESSORS)
+"""available content codings in the order of preference"""
+
+
+def entity_tag(tokens: Sequence[str], *variant: Any) -> str:
+    """
+    Derive an opaque tag of a response from tokens of its sorted itineraries.
+
+    A response with a single result and no variant is tagged by its token.
+    Otherwise, the tag is a digest of the tokens and the variant (e.g., a page
+    or pretty-printing), so different bodies never share a tag.
+
+    :param Sequence[str] tokens: tokens of the sorted itineraries
+    :param Any variant: further properties of the body of the response
+    :return str: opaque tag of the response (without quotes)
+    """
+    if len(tokens) == 1 and not variant:
+        return tokens[0]
+
+    parts = [*tokens, *map(repr, variant)]
+    return blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def strong_etag(tag: str, coding: str | None = None) -> str:
+    """
+    Format a strong entity tag of a representation of a response.
+
+    Each content coding is a different representation, so it has its own
+    entity tag.
+
+    :param str tag: opaque tag of the response
+    :param str | None coding: content coding of the representation,
+        defaults to None (no coding)
+    :return str: value of the ETag header
+    """
+    return f'"{tag}"' if coding is None else f'"{tag}-{coding}"'
+
+
+def not_modified(if_none_match: str | None, etag: str) -> bool:
+    """
+    Check whether an If-None-Match header matches an entity tag.
+
+    Entity tags are compared weakly, as required for If-None-Match.
+
+    :param str | None if_none_match: value of the If-None-Match header, None
+        if it is not given
+    :param str etag: entity tag of the current representation
+    :return bool: True if the client has the current representation already
+    """
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    return any(
+        candidate.strip().removeprefix("W/") == etag.removeprefix("W/")
+        for candidate in if_none_match.split(",")
+    )
+
+
+def __qualities(header: str) -> Dict[str, float]:
+    """
+    Parse quality values of a header with a list of preferences.
+
+    :param str header: value of the header (e.g., Accept-Encoding)
+    :return Dict[str, float]: quality values by lower-case preferred values
+    """
+    qualities: Dict[str, float] = {}
+    for part in header.split(","):
+        value, *parameters = (p.strip() for p in part.split(";"))
+        quality = 1.0
+        for parameter in parameters:
+            name, _, quality_value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(quality_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[value.lower()] = quality
+
+    return qualities
+
+
+def negotiate(accept_encoding: str | None) -> str | None:
+    """
+    Choose a content coding accepted by a client.
+
+    The coding with the highest quality value is chosen, ties are resolved by
+    the preference of the server.
+
+    :param str | None accept_encoding: value of the Accept-Encoding header,
+        None if it is not given
+    :return str | None: the chosen content coding, None for no coding
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = __qualities(accept_encoding)
+    default = qualities.get("*", 0.0)
+    quality, _, coding = max(
+        (qualities.get(c, default), -n, c) for n, c in enumerate(CODINGS)
+    )
+
+    return coding if quality > 0 else None
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    """
+    Compress a body by a content coding.
+
+    :param bytes body: the body
+    :param str coding: an available content coding
+    :return bytes: the compressed body
+    """
+    return __COMPRESSORS[coding](body)
+
+
+def content_format(content_type: str | None) -> WireFormat:
+    """
+    Get the format of a body of a request.
+
+    Bodies of any other media type (or without one) are in the JSON format.
+
+    :param str | None content_type: value of the Content-Type header, None if
+        it is not given
+    :return WireFormat: format of the body
+    """
+    if not content_type:
+        return WireFormat.JSON
+
+    media_type = content_type.split(";")[0].strip().lower()
+    return __MEDIA_TYPES.get(media_type, WireFormat.JSON)
+
+
+def accept_format(accept: str | None) -> WireFormat:
+    """
+    Choose a format of a body of a response accepted by a client.
+
+    The format with the highest quality value is chosen, ties are resolved by
+    the preference of the server. The JSON format is chosen if the client
+    accepts none of the formats.
+
+    :param str | None accept: value of the Accept header, None if it is not
+        given
+    :return WireFormat: the chosen format
+    """
+    if not accept:
+        return WireFormat.JSON
+
+    qualities = __qualities(accept)
+    default = qualities.get("application/*", qualities.get("*/*", 0.0))
+    candidates = []
+    for n, wire_format in enumerate(WIRE_FORMATS):
+        quality = max((
+            q for media_type, q in qualities.items()
+            if __MEDIA_TYPES.get(media_type) == wire_format
+        ), default=default)
+        candidates.append((quality, -n, wire_format.value))
+
+    quality, _, media_type = max(candidates)
+    return WireFormat(media_type) if quality > 0 else WireFormat.JSON
+
+
+def decode(body: bytes, wire_format: WireFormat) -> Any:
+    """
+    Decode a body of a request.
+
+    Both formats are decoded into the same objects (dictionaries, lists,
+    strings, and numbers), so they are validated the same.
+
+    :param bytes body: the body
+    :param WireFormat wire_format: format of the body
+    :return Any: the decoded body
+    :raises ValueError: if the body is not valid
+    """
+    if wire_format == WireFormat.JSON:
+        return json.loads(body)
+
+    try:
+        return msgpack.unpackb(body)
+    except TypeError as e:
+        raise ValueError(e)
+
+
+def encode(value: Any, wire_format: WireFormat) -> bytes:
+    """
+    Encode a body of a response.
+
+    :param Any value: the body (e.g., a dictionary)
+    :param WireFormat wire_format: format of the body
+    :return bytes: the encoded body
+    """
+    if wire_format == WireFormat.JSON:
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    return msgpack.packb(value)
@@ -0,0 +1,353 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with parallel sorting of very large numbers of itineraries.
+
+Keys are sorted in runs by a pool of processes and the runs are then merged
+in parallel: they are split by shared splitters into ranges of keys, and
+each range of all the runs is merged by a single process. The keys, the
+runs, and the permutation are passed through shared memory, so only the
+bounds of the runs and the ranges are sent to the processes.
+"""
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_all_start_methods, get_context
+from multiprocessing.context import BaseContext
+from multiprocessing.shared_memory import SharedMemory
+from os import cpu_count, getenv
+from threading import Lock
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+PARALLEL_WORKERS = int(getenv("PARALLEL_WORKERS", "0")) or cpu_count() or 1
+"""number of processes sorting in parallel"""
+
+PARALLEL_THRESHOLD = int(getenv("PARALLEL_THRESHOLD", str(1_000_000)))
+"""minimal number of itineraries sorted in parallel"""
+
+__SAMPLES = 32  # number of splitter samples of each run per range
+
+__workers = PARALLEL_WORKERS  # processes sorting in parallel in this process
+__executor: Executor | None = None  # lazily started process pool
+__executor_workers = 0  # number of processes of the pool
+__executor_users = 0  # number of sorts using the pool
+__executor_lock = Lock()  # lock of the pool
+
+Segment = Tuple[int, int]
+"""start and end offsets of a part of the sorted runs"""
+
+
+def parallel_workers() -> int:
+    """
+    Get the number of processes sorting in parallel in this process.
+
+    :return int: number of processes sorting in parallel
+    """
+    return __workers
+
+
+def set_parallel_workers(workers: int) -> None:
+    """
+    Set the number of processes sorting in parallel in this process.
+
+    Processes of other pools (e.g., of the worker pool) share the CPUs by
+    sorting with fewer processes each.
+
+    :param int workers: number of processes sorting in parallel
+    """
+    global __workers
+    __workers = max(1, workers)
+
+
+def process_context() -> BaseContext:
+    """
+    Get the context starting processes of process pools.
+
+    Processes are not forked from the server, which is multi-threaded, since
+    a forked process might inherit locks held by other threads. They are
+    forked from a single-threaded server process, if possible, or spawned.
+
+    :return BaseContext: the multiprocessing context
+    """
+    if "forkserver" in get_all_start_methods():
+        return get_context("forkserver")
+
+    return get_context("spawn")
+
+
+@contextmanager
+def __executor_of(workers: int) -> Iterator[Executor]:
+    """
+    Use the process pool, preferably with at least a number of processes.
+
+    The pool is started on the first use and restarted with more processes
+    if needed, but only while no other sort (of another thread) uses it.
+    Otherwise, the smaller pool is used, its processes only sort more runs.
+
+    :param int workers: preferred minimal number of processes
+    :yield Iterator[Executor]: the process pool
+    """
+    global __executor, __executor_workers, __executor_users
+    with __executor_lock:
+        if __executor is None or (
+            __executor_workers < workers and __executor_users == 0
+        ):
+            if __executor is not None:
+                __executor.shutdown()
+            __executor = ProcessPoolExecutor(
+                workers, mp_context=process_context(),
+            )
+            __executor_workers = workers
+        executor = __executor
+        __executor_users += 1
+
+    try:
+        yield executor
+    finally:
+        with __executor_lock:
+            __executor_users -= 1
+
+
+def shutdown() -> None:
+    """
+    Shut down the process pool, if it has been started.
+
+    A process exits only once its pool is shut down, since it waits for the
+    processes of the pool, so worker processes shut it down when they exit.
+    """
+    global __executor, __executor_workers
+    with __executor_lock:
+        if __executor is not None:
+            __executor.shutdown()
+            __executor = None
+            __executor_workers = 0
+
+
+def __release(memories: List[SharedMemory], unlink: bool = False) -> None:
+    """
+    Close shared memory blocks and optionally unlink them.
+
+    :param List[SharedMemory] memories: the shared memory blocks
+    :param bool unlink: whether the blocks are unlinked (by their creator),
+        defaults to False
+    """
+    for memory in memories:
+        if unlink:
+            memory.unlink()
+        try:
+            memory.close()
+        except BufferError:
+            pass  # arrays of a failed sort are released with its traceback
+
+
+def __sort_run(
+    keys_name: str,
+    runs_name: str,
+    indices_name: str,
+    dtype: str,
+    start: int,
+    end: int,
+) -> None:
+    """
+    Stably sort a run of keys in shared memory.
+
+    :param str keys_name: name of the shared memory with the keys
+    :param str runs_name: name of the shared memory for the sorted keys
+    :param str indices_name: name of the shared memory for the indices of
+        the sorted keys
+    :param str dtype: data type of the keys
+    :param int start: index of the first key of the run
+    :param int end: index after the last key of the run
+    """
+    memories = [
+        SharedMemory(name) for name in (keys_name, runs_name, indices_name)
+    ]
+    try:
+        keys, runs = (
+            np.ndarray((end,), dtype=dtype, buffer=m.buf) for m in memories[:2]
+        )
+        indices = np.ndarray((end,), dtype=np.intp, buffer=memories[2].buf)
+
+        order = np.argsort(keys[start:end], kind="stable")
+        runs[start:end] = keys[start:end][order]
+        indices[start:end] = order + start
+        del keys, runs, indices
+    finally:
+        __release(memories)
+
+
+def __merge_range(
+    runs_name: str,
+    indices_name: str,
+    permutation_name: str,
+    dtype: str,
+    length: int,
+    segments: List[Segment],
+    offset: int,
+) -> None:
+    """
+    Stably merge a range of keys of all the sorted runs in shared memory.
+
+    The segments of the runs are concatenated in the order of the runs, so
+    equal keys keep the order of their indices, and the concatenation is
+    merged by a stable sort (which merges sorted runs in linear time).
+
+    :param str runs_name: name of the shared memory with the sorted runs
+    :param str indices_name: name of the shared memory with the indices of
+        the sorted runs
+    :param str permutation_name: name of the shared memory for the
+        permutation
+    :param str dtype: data type of the keys
+    :param int length: number of the keys
+    :param List[Segment] segments: the range in each of the runs
+    :param int offset: index of the first key of the range in the
+        permutation
+    """
+    memories = [
+        SharedMemory(name)
+        for name in (runs_name, indices_name, permutation_name)
+    ]
+    try:
+        runs = np.ndarray((length,), dtype=dtype, buffer=memories[0].buf)
+        indices, permutation = (
+            np.ndarray((length,), dtype=np.intp, buffer=m.buf)
+            for m in memories[1:]
+        )
+
+        keys = np.concatenate([runs[start:end] for start, end in segments])
+        range_indices = np.concatenate(
+            [indices[start:end] for start, end in segments],
+        )
+        permutation[offset:offset + len(keys)] = range_indices[
+            np.argsort(keys, kind="stable")
+        ]
+        del runs, indices, permutation
+    finally:
+        __release(memories)
+
+
+def __split_runs(
+    runs: np.ndarray, indices: np.ndarray, bounds: np.ndarray, ranges: int,
+) -> List[List[Segment]]:
+    """
+    Split sorted runs into ranges of keys by shared splitters.
+
+    Splitters are sampled from the runs. They are pairs of a key and its
+    index, so even a lot of equal keys are split evenly. Each run is split
+    before the first pair not less than each splitter.
+
+    :param np.ndarray runs: sorted runs of the keys
+    :param np.ndarray indices: indices of the sorted runs
+    :param np.ndarray bounds: offsets of the runs
+    :param int ranges: number of the ranges
+    :return List[List[Segment]]: the ranges, each with its segment of each
+        run
+    """
+    starts, ends = bounds[:-1], bounds[1:]
+    samples = np.concatenate([
+        np.linspace(start, end, __SAMPLES * ranges, endpoint=False)
+        .astype(np.intp)
+        for start, end in zip(starts, ends) if start < end
+    ])
+    samples = samples[np.lexsort((indices[samples], runs[samples]))]
+    splitters = samples[np.arange(1, ranges) * len(samples) // ranges]
+
+    splits = np.empty((len(starts), ranges + 1), dtype=np.intp)
+    splits[:, 0], splits[:, -1] = starts, ends
+    for r, (start, end) in enumerate(zip(starts, ends)):
+        run, run_indices = runs[start:end], indices[start:end]
+        for j, splitter in enumerate(splitters, 1):
+            key, index = runs[splitter], indices[splitter]
+            low = np.searchsorted(run, key, "left")
+            high = np.searchsorted(run, key, "right")
+            splits[r, j] = start + low + np.searchsorted(
+                run_indices[low:high], index,
+            )
+
+    return [
+        [
+            (int(start), int(end))
+            for start, end in zip(splits[:, j], splits[:, j + 1])
+        ]
+        for j in range(ranges)
+    ]
+
+
+def parallel_argsort(
+    keys: np.ndarray, workers: int | None = None,
+) -> np.ndarray:
+    """
+    Compute a permutation that stably sorts keys using multiple processes.
+
+    The keys are split into runs, which are sorted in a process pool. The
+    runs are split into ranges of keys, which are merged in the pool too.
+    The result is the same as of a stable sequential sort.
+
+    :param np.ndarray keys: sorting keys
+    :param int | None workers: number of processes sorting in parallel,
+        defaults to None (see parallel_workers)
+    :return np.ndarray: permutation of the sorted keys
+    """
+    keys = np.ascontiguousarray(keys)
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    workers = max(1, min(workers or __workers, len(keys)))
+    with __executor_of(workers) as executor:
+        length, dtype = len(keys), keys.dtype.str
+        memories = [
+            SharedMemory(create=True, size=length * np.dtype(d).itemsize)
+            for d in (keys.dtype, keys.dtype, np.intp, np.intp)
+        ]
+        try:
+            keys_memory, runs_memory, indices_memory, permutation_memory = (
+                memories
+            )
+            runs, indices, permutation = (
+                np.ndarray((length,), d, buffer=m.buf)
+                for d, m in zip((keys.dtype, np.intp, np.intp), memories[1:])
+            )
+            np.ndarray((length,), keys.dtype, buffer=keys_memory.buf)[:] = keys
+
+            bounds = np.linspace(0, length, workers + 1, dtype=np.intp)
+            for future in [
+                executor.submit(
+                    __sort_run,
+                    keys_memory.name,
+                    runs_memory.name,
+                    indices_memory.name,
+                    dtype,
+                    int(start),
+                    int(end),
+                )
+                for start, end in zip(bounds[:-1], bounds[1:])
+            ]:
+                future.result()
+
+            ranges = __split_runs(runs, indices, bounds, workers)
+            offsets = np.cumsum(
+                [0] + [sum(end - start for start, end in r) for r in ranges],
+            )
+            for future in [
+                executor.submit(
+                    __merge_range,
+                    runs_memory.name,
+                    indices_memory.name,
+                    permutation_memory.name,
+                    dtype,
+                    length,
+                    segments,
+                    int(offset),
+                )
+                for segments, offset in zip(ranges, offsets)
+            ]:
+                future.result()
+
+            result = permutation.copy()
+            del runs, indices, permutation
+        finally:
+            __release(memories, unlink=True)
+
+    return result
@@ -4,14 +4,22 @@
 
 from __future__ import annotations
 
+import gc
 import json
+from contextlib import contextmanager
+from copy import copy
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Dict, List
+from functools import cached_property
+from hashlib import blake2b
+from json.encoder import encode_basestring_ascii
+from sys import intern
+from typing import Any, Dict, Iterator, List, Sequence
 
-from currency_converter import CurrencyConverter
-
-_currency_converter = None
+from .metrics import stage
+from .negotiation import WireFormat, decode
+from .rates import RateSnapshot, snapshot
+from .scoring import DEFAULT_PROFILE, PROFILES, ScoringProfile, profile
 
 
 class SortingType(Enum):
@@ -22,22 +30,85 @@ class SortingType(Enum):
     BEST = "best"  # sort with the best ones coming first
 
 
+ALL_SORTING_TYPES = "all"
+"""value requesting itineraries sorted by all the sorting criteria"""
+
+SORTING_TYPE_VALUES = tuple(t.value for t in SortingType)
+"""values of the sorting criteria in their order"""
+
+PRICE_SORTING_TYPES = frozenset({SortingType.CHEAPEST, SortingType.BEST})
+"""sorting criteria depending on prices (i.e., on EUR rates)"""
+
+MAX_DURATION = 2 ** 63 - 1
+"""maximal absolute travel duration in minutes (sorted as 64-bit integers)"""
+
+MAX_AMOUNT = 2 ** 63 - 1
+"""maximal absolute price amount (encoded as 64-bit integers)"""
+
+
 class ParsingError(Exception):
     """Exception class for sorting requests parsing errors."""
 
-    def __init__(self: ParsingError) -> None:
-        """Construct the exception with a message."""
-        self.message = "Format of the given sorting request is not valid."
+    def __init__(
+        self: ParsingError,
+        message: str = "Format of the given sorting request is not valid.",
+    ) -> None:
+        """
+        Construct the exception with a message.
+
+        :param str message: message of the exception, defaults to a message
+            about an invalid sorting request
+        """
+        self.message = message
         super().__init__(self.message)
 
 
+class RateTable:
+    """
+    Table of EUR rates of currencies used within a sorting request.
+
+    The rates are taken from a single snapshot for the whole sorting request,
+    even if the snapshot is reloaded meanwhile. Prices are converted by a
+    single multiplication.
+    """
+
+    def __init__(self: RateTable, rates: RateSnapshot | None = None) -> None:
+        """
+        Construct a table of EUR rates.
+
+        :param RateSnapshot | None rates: snapshot of EUR rates, defaults to
+            None (the current snapshot)
+        """
+        rates = rates or snapshot()
+        self.version = rates.version
+        self.__rates: Dict[str, float] = rates.rates
+
+    def rate(self: RateTable, currency: str) -> float:
+        """
+        Get the EUR rate of a currency, i.e., the price of 1 unit in EUR.
+
+        :param str currency: currency of the rate
+        :return float: EUR rate of the currency
+        :raises ParsingError: if unknown currency is given
+        """
+        try:
+            return self.__rates[currency]
+        except KeyError:
+            raise ParsingError
+
+
 PriceType = int | str
 """type of an itinerary's price"""
 
 
-@dataclass(init=False, frozen=True)
+@dataclass(init=False, frozen=True, slots=True)
 class Price:
-    """Encapsulates an itinerary's price."""
+    """
+    Encapsulates an itinerary's price.
+
+    Prices are slotted and their currency codes are interned, so prices in
+    the same currency share both the currency code and the EUR rate.
+    """
 
     amount: int
     """price amount in a given currency"""
@@ -45,32 +116,39 @@ class Price:
     currency: str
     """currency of the price"""
 
-    amount_eur: float
-    """price amount in EUR"""
+    rate: float
+    """EUR rate of the currency, i.e., the price of 1 unit in EUR"""
 
-    def __init__(self: Price, amount: int, currency: str) -> None:
+    def __init__(
+        self: Price,
+        amount: int,
+        currency: str,
+        rates: RateTable | None = None,
+    ) -> None:
         """
         Construct a representation of an itinerary's price.
 
         :param int amount: price amount in a given currency
         :param str currency: currency of the price
+        :param RateTable | None rates: table of EUR rates shared by prices of
+            a sorting request, defaults to None (a new table)
         :raises ParsingError: if unknown currency is given
         """
+        if rates is None:
+            rates = RateTable()
+
         object.__setattr__(self, "amount", amount)
-        object.__setattr__(self, "currency", currency)
+        object.__setattr__(self, "currency", intern(currency))
+        object.__setattr__(self, "rate", rates.rate(currency))
 
-        try:
-            global _currency_converter
-            if _currency_converter is None:
-                _currency_converter = CurrencyConverter()
-
-            object.__setattr__(
-                self,
-                "amount_eur",
-                _currency_converter.convert(amount, currency, "EUR"),
-            )
-        except ValueError:
-            raise ParsingError
+    @property
+    def amount_eur(self: Price) -> float:
+        """
+        Get the price amount in EUR.
+
+        :return float: price amount in EUR
+        """
+        return self.amount * self.rate
 
     def _serialise(self: Price) -> Dict[str, PriceType]:
         """
@@ -94,7 +172,7 @@ ItineraryType = str | int | PriceType
 """type of an itinerary"""
 
 
-@dataclass(init=False, frozen=True)
+@dataclass(init=False, frozen=True, slots=True)
 class Itinerary:
     """Encapsulates an itinerary."""
 
@@ -107,11 +185,17 @@ class Itinerary:
     price: Price
     """total price of the itinerary"""
 
-    def __init__(self: Itinerary, itinerary_json: Dict[str, Any]) -> None:
+    def __init__(
+        self: Itinerary,
+        itinerary_json: Dict[str, Any],
+        rates: RateTable | None = None,
+    ) -> None:
         """
         Construct a representation of an itinerary.
 
         :param Dict[str, Any] itinerary_json: itinerary in the JSON format
+        :param RateTable | None rates: table of EUR rates shared by prices of
+            a sorting request, defaults to None (a new table)
         :raises ParsingError: if parsing of the itinerary failed
         """
         if (
@@ -119,10 +203,12 @@ class Itinerary:
             or not isinstance(itinerary_json["id"], str)
             or "duration_minutes" not in itinerary_json
             or not isinstance(itinerary_json["duration_minutes"], int)
+            or abs(itinerary_json["duration_minutes"]) > MAX_DURATION
             or "price" not in itinerary_json
             or not isinstance(itinerary_json["price"], Dict)
             or "amount" not in itinerary_json["price"]
             or not isinstance(itinerary_json["price"]["amount"], int)
+            or abs(itinerary_json["price"]["amount"]) > MAX_AMOUNT
             or "currency" not in itinerary_json["price"]
             or not isinstance(itinerary_json["price"]["currency"], str)
         ):
@@ -136,6 +222,7 @@ class Itinerary:
             Price(
                 itinerary_json["price"]["amount"],
                 itinerary_json["price"]["currency"],
+                rates,
             ),
         )
 
@@ -152,6 +239,38 @@ class Itinerary:
             "price": self.price._serialise(),
         }
 
+    def _serialise_json(self: Itinerary) -> str:
+        """
+        Serialise the itinerary into the compact JSON format.
+
+        It is the same as serialising the dictionary of the itinerary, only
+        without building the dictionary. The result is ASCII only.
+
+        :return str: the itinerary in the compact JSON format
+        """
+        return (
+            '{"id":%s,"duration_minutes":%d,' +
+            '"price":{"amount":%d,"currency":%s}}'
+        ) % (
+            encode_basestring_ascii(self.id),
+            self.duration,
+            self.price.amount,
+            encode_basestring_ascii(self.price.currency),
+        )
+
+    def _canonical(self: Itinerary) -> str:
+        """
+        Encode the itinerary into a canonical form.
+
+        Equal itineraries always have the same canonical form, no matter the
+        process they are encoded in.
+
+        :return str: canonical form of the itinerary
+        """
+        return json.dumps(
+            [self.id, self.duration, self.price.amount, self.price.currency],
+            separators=(",", ":"),
+        )
 
     def __hash__(self: Itinerary) -> int:
         """
@@ -166,6 +285,69 @@ Itineraries = List[Itinerary]
 """list of itineraries"""
 
 
+def _parse_itineraries(
+    itineraries_json: List[Any], rates: RateTable,
+) -> Itineraries:
+    """
+    Parse itineraries in the JSON format.
+
+    Each itinerary is validated and constructed at once, without calling the
+    constructors, which is much faster for large numbers of itineraries. The
+    result is the same as of constructing the itineraries one by one.
+
+    :param List[Any] itineraries_json: itineraries in the JSON format
+    :param RateTable rates: table of EUR rates shared by prices of the
+        itineraries
+    :return Itineraries: parsed itineraries
+    :raises ParsingError: if parsing of an itinerary failed, with the index
+        of the itinerary in the message
+    """
+    itineraries: Itineraries = []
+    append = itineraries.append
+    new, set_attribute, rate = object.__new__, object.__setattr__, rates.rate
+    for n, itinerary_json in enumerate(itineraries_json):
+        try:
+            itinerary_id = itinerary_json["id"]
+            duration = itinerary_json["duration_minutes"]
+            price_json = itinerary_json["price"]
+            amount = price_json["amount"]
+            currency = price_json["currency"]
+            if not (
+                isinstance(itinerary_json, dict)
+                and isinstance(itinerary_id, str)
+                and isinstance(duration, int)
+                and abs(duration) <= MAX_DURATION
+                and isinstance(price_json, dict)
+                and isinstance(amount, int)
+                and abs(amount) <= MAX_AMOUNT
+                and isinstance(currency, str)
+            ):
+                raise ParsingError
+
+            currency_rate = rate(currency)
+        except (KeyError, TypeError, ParsingError):
+            raise ParsingError(
+                f"Format of the itinerary {n} of the given sorting request " +
+                "is not valid.",
+            )
+
+        price = new(Price)
+        set_attribute(price, "amount", amount)
+        set_attribute(price, "currency", intern(currency))
+        set_attribute(price, "rate", currency_rate)
+        itinerary = new(Itinerary)
+        set_attribute(itinerary, "id", itinerary_id)
+        set_attribute(itinerary, "duration", duration)
+        set_attribute(itinerary, "price", price)
+        append(itinerary)
+
+    return itineraries
+
+
+Order = Sequence[int]
+"""order of itineraries given by their indices into a list of them"""
+
+
 @dataclass(init=False)
 class Request:
     """Encapsulates a sorting request."""
@@ -176,6 +358,18 @@ class Request:
     itineraries: Itineraries
     """itineraries to be sorted"""
 
+    limit: int | None
+    """maximal number of sorted itineraries, None if unlimited"""
+
+    profile: ScoringProfile
+    """scoring profile of the best itineraries"""
+
+    rates: RateTable
+    """table of EUR rates of prices of the itineraries"""
+
+    order: Order | None
+    """order of the itineraries established by sorting, None if not sorted"""
+
     def __init__(self: Request, request_json: Dict[str, Any]) -> None:
         """
         Construct a representation of a sorting request.
@@ -185,34 +379,316 @@ class Request:
         """
         if (
             "sorting_type" not in request_json
-            or request_json["sorting_type"] not in
-                [t.value for t in SortingType]
+            or not isinstance(request_json["sorting_type"], str)
+            or request_json["sorting_type"] not in SORTING_TYPE_VALUES
             or "itineraries" not in request_json
             or not isinstance(request_json["itineraries"], List)
+            or (
+                "limit" in request_json
+                and (
+                    not isinstance(request_json["limit"], int)
+                    or isinstance(request_json["limit"], bool)
+                    or request_json["limit"] < 0
+                )
+            )
+            or (
+                "scoring_profile" in request_json
+                and (
+                    not isinstance(request_json["scoring_profile"], str)
+                    or request_json["scoring_profile"] not in PROFILES
+                )
+            )
         ):
             raise ParsingError
 
         self.sorting_type = SortingType(request_json["sorting_type"])
-        self.itineraries = [Itinerary(i) for i in request_json["itineraries"]]
+        self.limit = request_json.get("limit")
+        self.profile = profile(
+            request_json.get("scoring_profile", DEFAULT_PROFILE),
+        )
+        self.rates = RateTable()
+        with stage("validate"):
+            self.itineraries = _parse_itineraries(
+                request_json["itineraries"], self.rates,
+            )
+        self.order = None
+
+    @classmethod
+    def many(
+        cls: type[Request], request_json: Dict[str, Any],
+    ) -> List[Request]:
+        """
+        Construct representations of a multi-criteria sorting request.
+
+        The sorting criteria are given by a list of them or by "all". There is
+        a sorting request for each of them and all of them share the same
+        itineraries, which are parsed only once.
 
-    def to_json(self: Request) -> str:
+        :param Dict[str, Any] request_json: multi-criteria sorting request in
+            the JSON format
+        :return List[Request]: sorting requests, one for each sorting criteria
+        :raises ParsingError: if parsing of the sorting request failed
+        """
+        sorting_types = request_json.get("sorting_type")
+        if sorting_types == ALL_SORTING_TYPES:
+            sorting_types = list(SORTING_TYPE_VALUES)
+        if (
+            not isinstance(sorting_types, List)
+            or not sorting_types
+            or not all(t in SORTING_TYPE_VALUES for t in sorting_types)
+        ):
+            raise ParsingError
+
+        sorting_types = list(dict.fromkeys(sorting_types))
+        request = cls({**request_json, "sorting_type": sorting_types[0]})
+        request._canonical_itineraries  # shared by all the requests
+
+        requests = [request]
+        for sorting_type in sorting_types[1:]:
+            requests.append(copy(request))
+            requests[-1].sorting_type = SortingType(sorting_type)
+
+        return requests
+
+    @staticmethod
+    def is_many(request_json: Any) -> bool:
+        """
+        Check whether a sorting request is a multi-criteria one.
+
+        :param Any request_json: sorting request in the JSON format
+        :return bool: True if it is a multi-criteria sorting request
+        """
+        return isinstance(request_json, Dict) and (
+            isinstance(request_json.get("sorting_type"), List)
+            or request_json.get("sorting_type") == ALL_SORTING_TYPES
+        )
+
+    def sorted_itineraries(self: Request) -> Itineraries:
+        """
+        Get the itineraries in the order established by sorting.
+
+        :return Itineraries: sorted itineraries (as given if not sorted)
+        """
+        if self.order is None:
+            return self.itineraries
+
+        return [self.itineraries[i] for i in self.order]
+
+    def to_json(self: Request, indent: int | None = None) -> str:
         """
         Convert the current object to the JSON format.
 
+        :param int | None indent: indentation of pretty-printed JSON,
+            defaults to None (compact JSON)
         :return str: the current object in the JSON format
         """
-        return json.dumps({
-            "sorting_type": self.sorting_type.value,
-            "sorted_itineraries": [i._serialise() for i in self.itineraries]
-        }, indent=2)
+        if indent is not None:
+            return json.dumps({
+                "sorting_type": self.sorting_type.value,
+                "sorted_itineraries": [
+                    i._serialise() for i in self.sorted_itineraries()
+                ],
+            }, indent=indent)
+
+        return '{"sorting_type":%s,"sorted_itineraries":[%s]}' % (
+            json.dumps(self.sorting_type.value),
+            ",".join(i._serialise_json() for i in self.sorted_itineraries()),
+        )
 
-    def __hash__(self: Request) -> int:
+    def digest(self: Request) -> str:
         """
-        Generate a unique hash from the current object.
+        Generate a stable digest of the current object.
 
-        :return int: generated hash
+        The digest is the same across processes and it does not depend on the
+        order of the itineraries, so permuted requests share the digest. The
+        best itineraries are digested with the definition of their scoring
+        profile. Criteria depending on prices are digested with the version
+        of EUR rates, so they are sorted again when the rates change.
+
+        :return str: hexadecimal digest
+        """
+        with stage("hash"):
+            digest = blake2b(digest_size=32)
+            digest.update(self.sorting_type.value.encode())
+            if self.sorting_type == SortingType.BEST:
+                digest.update(f":{self.profile.to_json()}".encode())
+            if self.sorting_type in PRICE_SORTING_TYPES:
+                digest.update(f"@{self.rates.version}".encode())
+            if self.limit is not None:
+                digest.update(f":{self.limit}".encode())
+            digest.update(self._canonical_itineraries)
+
+            return digest.hexdigest()
+
+    @cached_property
+    def _canonical_forms(self: Request) -> List[str]:
+        """
+        Encode each of the itineraries into its canonical form.
+
+        :return List[str]: canonical forms of the itineraries
+        """
+        return [i._canonical() for i in self.itineraries]
+
+    @cached_property
+    def _canonical_order(self: Request) -> List[int]:
+        """
+        Get the order of the itineraries by their canonical forms.
+
+        Itineraries with equal sorting keys are sorted in this order, so the
+        sorted itineraries do not depend on the order they were given in.
+
+        :return List[int]: indices of the itineraries in the canonical order
+        """
+        forms = self._canonical_forms
+        return sorted(range(len(forms)), key=forms.__getitem__)
+
+    @cached_property
+    def _canonical_itineraries(self: Request) -> bytes:
         """
-        return hash((
-            self.sorting_type,
-            ''.join([str(hash(i)) for i in self.itineraries]),
-        ))
+        Encode the itineraries into a canonical form, regardless their order.
+
+        :return bytes: canonical form of the itineraries
+        """
+        forms = self._canonical_forms
+        return b"".join(
+            b"\n" + forms[i].encode() for i in self._canonical_order
+        )
+
+
+@dataclass(init=False)
+class Delta:
+    """Encapsulates changes of itineraries sorted by a sorting request."""
+
+    added: Itineraries
+    """itineraries to be added"""
+
+    removed: List[str]
+    """identifiers of itineraries to be removed"""
+
+    rates: RateTable
+    """table of EUR rates of prices of the added itineraries"""
+
+    def __init__(self: Delta, delta_json: Dict[str, Any]) -> None:
+        """
+        Construct a representation of changes of sorted itineraries.
+
+        :param Dict[str, Any] delta_json: changes of sorted itineraries in the
+            JSON format
+        :raises ParsingError: if parsing of the changes failed
+        """
+        added = delta_json.get("added", [])
+        removed = delta_json.get("removed", [])
+        if (
+            not isinstance(added, List)
+            or not isinstance(removed, List)
+            or not all(isinstance(i, str) for i in removed)
+        ):
+            raise ParsingError(
+                "Format of the given update request is not valid.",
+            )
+
+        self.rates = RateTable()
+        with stage("validate"):
+            self.added = _parse_itineraries(added, self.rates)
+        self.removed = list(dict.fromkeys(removed))
+
+    def digest(self: Delta, token: str) -> str:
+        """
+        Generate a stable digest of sorted itineraries updated by the changes.
+
+        The digest is derived from the token of the sorted itineraries and
+        the changes, regardless the order of the added and removed ones.
+
+        :param str token: token of the updated sorted itineraries
+        :return str: hexadecimal digest
+        """
+        with stage("hash"):
+            digest = blake2b(token.encode(), digest_size=32)
+            for i in sorted(i._canonical() for i in self.added):
+                digest.update(b"\n+" + i.encode())
+            for i in sorted(self.removed):
+                digest.update(b"\n-" + json.dumps(i).encode())
+
+            return digest.hexdigest()
+
+
+@contextmanager
+def __paused_gc() -> Iterator[None]:
+    """
+    Pause the cyclic garbage collector.
+
+    Parsed requests do not contain reference cycles, but allocating millions
+    of their objects would trigger many useless collections otherwise.
+
+    :yield Iterator[None]: block with the garbage collector paused
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def parse_request(
+    body: bytes, wire_format: WireFormat = WireFormat.JSON,
+) -> Request | List[Request]:
+    """
+    Parse a body of a sorting request.
+
+    The body is decoded by the C JSON (or MessagePack) decoder, then the
+    itineraries are validated and constructed in a single pass over the
+    decoded itineraries. Both formats are validated the same and they give
+    the same sorting requests.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :return Request | List[Request]: sorting request, or sorting requests
+        for each sorting criteria of a multi-criteria sorting request
+    :raises ParsingError: if parsing of the sorting request failed
+    """
+    with __paused_gc():
+        try:
+            with stage("decode"):
+                request_json = decode(body, wire_format)
+        except (ValueError, RecursionError):
+            raise ParsingError
+
+        if not isinstance(request_json, dict):
+            raise ParsingError
+
+        if Request.is_many(request_json):
+            return Request.many(request_json)
+
+        return Request(request_json)
+
+
+def parse_delta(
+    body: bytes, wire_format: WireFormat = WireFormat.JSON,
+) -> Delta:
+    """
+    Parse a body of a request changing sorted itineraries.
+
+    :param bytes body: body of the request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :return Delta: changes of the sorted itineraries
+    :raises ParsingError: if parsing of the request failed
+    """
+    with __paused_gc():
+        try:
+            with stage("decode"):
+                delta_json = decode(body, wire_format)
+        except (ValueError, RecursionError):
+            raise ParsingError(
+                "Format of the given update request is not valid.",
+            )
+
+        if not isinstance(delta_json, dict):
+            raise ParsingError(
+                "Format of the given update request is not valid.",
+            )
+
+        return Delta(delta_json)
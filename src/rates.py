@@ -0,0 +1,268 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with snapshots of EUR rates of currencies.
+
+Parsing the history of rates of the European Central Bank by the currency
+converter takes hundreds of milliseconds. So, the latest rates are stored in
+a small precomputed snapshot, which loads in milliseconds. The snapshot file
+is checked for changes and reloaded by a background refresher, and the new
+snapshot is swapped in atomically, so requests never wait for it. Run
+``python -m src.rates`` to regenerate the snapshot from the currency
+converter.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from os import getenv, getpid, replace
+from os.path import dirname, getmtime
+from os.path import join as join_path
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict
+
+from currency_converter import CurrencyConverter
+
+from .metrics import stage
+
+RATES_FILE = getenv("RATES_FILE", join_path(dirname(__file__), "rates.json"))
+"""file with the snapshot of EUR rates"""
+
+__CHECK_INTERVAL = float(getenv("RATES_CHECK_INTERVAL", "60"))  # in seconds
+
+__lock = Lock()  # lock of loading of the snapshot (not of reading it)
+__snapshot: RateSnapshot | None = None  # current snapshot
+__modified: float | None = None  # modification time of the loaded file
+__checked = 0.0  # time of the last check of the file
+__refresher: Thread | None = None  # background refresher of the snapshot
+__refresher_pid: int | None = None  # process of the refresher
+__refresher_stop = Event()  # stops the refresher
+
+
+@dataclass(frozen=True)
+class RateSnapshot:
+    """Encapsulates a snapshot of EUR rates of currencies."""
+
+    date: str
+    """date of the latest rates"""
+
+    rates: Dict[str, float]
+    """EUR rates of currencies, i.e., prices of 1 unit in EUR"""
+
+    version: str = field(init=False)
+    """version of the snapshot (the date and a digest of the rates)"""
+
+    def __post_init__(self: RateSnapshot) -> None:
+        """
+        Derive the version of the snapshot from its contents.
+
+        The rates are digested too, so rates changed without changing their
+        date (e.g., edited by hand) are a different version.
+        """
+        digest = blake2b(
+            json.dumps(self.rates, sort_keys=True).encode(), digest_size=8,
+        )
+        object.__setattr__(
+            self, "version", f"{self.date}-{digest.hexdigest()}",
+        )
+
+    @classmethod
+    def from_converter(cls: type[RateSnapshot]) -> RateSnapshot:
+        """
+        Create a snapshot of the latest rates of the currency converter.
+
+        :return RateSnapshot: snapshot of the latest rates
+        """
+        converter = CurrencyConverter()
+        return cls(
+            date=max(
+                bounds.last_date for bounds in converter.bounds.values()
+            ).isoformat(),
+            rates={
+                currency: converter.convert(1, currency, "EUR")
+                for currency in sorted(converter.currencies)
+            },
+        )
+
+    @classmethod
+    def load(cls: type[RateSnapshot], rates_file: str) -> RateSnapshot:
+        """
+        Load a snapshot from a file.
+
+        :param str rates_file: file with the snapshot
+        :return RateSnapshot: the loaded snapshot
+        :raises OSError: if the file cannot be read
+        :raises ValueError: if the file does not contain a valid snapshot
+        """
+        with open(rates_file) as f:
+            snapshot_json = json.load(f)
+
+        try:
+            return cls(
+                date=str(
+                    snapshot_json["date"] if "date" in snapshot_json
+                        else snapshot_json["version"]  # older snapshots
+                ),
+                rates={
+                    str(currency): float(rate)
+                    for currency, rate in snapshot_json["rates"].items()
+                },
+            )
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid snapshot of rates: {e}.")
+
+    def save(self: RateSnapshot, rates_file: str) -> None:
+        """
+        Save the snapshot to a file.
+
+        The file is replaced atomically, so it is never read half-written.
+
+        :param str rates_file: file for the snapshot
+        """
+        tmp_file = f"{rates_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {"date": self.date, "rates": self.rates}, f, indent=2,
+            )
+            f.write("\n")
+        replace(tmp_file, rates_file)
+
+
+def reload(rates_file: str = RATES_FILE) -> RateSnapshot:
+    """
+    Reload the snapshot if its file has changed since it was loaded.
+
+    Requests being processed keep the snapshot they started with, and other
+    requests keep using the current one while it is being reloaded. If there
+    is no snapshot file, the snapshot is created by the currency converter.
+    An invalid file is ignored if a snapshot has been loaded already.
+
+    :param str rates_file: file with the snapshot, defaults to the RATES_FILE
+        environment variable or "rates.json" next to this module
+    :return RateSnapshot: the current snapshot
+    """
+    global __snapshot, __modified, __checked
+    # only the first load blocks, otherwise another thread already reloads it
+    if not __lock.acquire(blocking=__snapshot is None):
+        return __snapshot
+
+    try:
+        __checked = monotonic()
+        try:
+            modified = getmtime(rates_file)
+        except OSError:
+            modified = None
+
+        if __snapshot is None or modified != __modified:
+            with stage("rates_load"):
+                try:
+                    if modified is None:
+                        __snapshot = RateSnapshot.from_converter()
+                    else:
+                        __snapshot = RateSnapshot.load(rates_file)
+                except (OSError, ValueError):
+                    if __snapshot is None:
+                        raise
+            __modified = modified
+
+        return __snapshot
+
+    finally:
+        __lock.release()
+
+
+def snapshot() -> RateSnapshot:
+    """
+    Get the current snapshot of EUR rates.
+
+    The snapshot is loaded on the first use. Then, it is reloaded by the
+    background refresher. Without the refresher, its file is checked for
+    changes at most once per RATES_CHECK_INTERVAL seconds.
+
+    :return RateSnapshot: the current snapshot
+    """
+    if __snapshot is None or (
+        __refresher_pid != getpid()
+        and monotonic() - __checked >= __CHECK_INTERVAL
+    ):
+        return reload()
+
+    return __snapshot
+
+
+def __refresh_periodically(rates_file: str, interval: float) -> None:
+    """
+    Reload the snapshot periodically until the refresher is stopped.
+
+    :param str rates_file: file with the snapshot
+    :param float interval: seconds between checks of the file
+    """
+    while not __refresher_stop.wait(interval):
+        try:
+            reload(rates_file)
+        except (OSError, ValueError):
+            pass  # the current snapshot is kept, the next check retries
+
+
+def start_refresher(
+    rates_file: str = RATES_FILE, interval: float = __CHECK_INTERVAL,
+) -> None:
+    """
+    Start the background refresher of the snapshot, if it is not running.
+
+    :param str rates_file: file with the snapshot, defaults to the RATES_FILE
+        environment variable or "rates.json" next to this module
+    :param float interval: seconds between checks of the file, defaults to
+        the RATES_CHECK_INTERVAL environment variable or 60
+    """
+    global __refresher, __refresher_pid
+    if (
+        __refresher is not None
+        and __refresher.is_alive()
+        and __refresher_pid == getpid()
+    ):
+        return
+
+    __refresher_stop.clear()
+    __refresher = Thread(
+        target=__refresh_periodically,
+        args=(rates_file, interval),
+        name="rates-refresher",
+        daemon=True,
+    )
+    __refresher_pid = getpid()
+    __refresher.start()
+
+
+def stop_refresher() -> None:
+    """Stop the background refresher of the snapshot, if it is running."""
+    global __refresher, __refresher_pid
+    if __refresher is not None:
+        __refresher_stop.set()
+        if __refresher_pid == getpid():
+            __refresher.join()
+        __refresher = None
+        __refresher_pid = None
+
+
+def warm_up() -> None:
+    """
+    Load the snapshot at startup, so the first request does not wait, and
+    start the background refresher.
+    """
+    snapshot()
+    start_refresher()
+
+
+def main() -> None:
+    """Regenerate the snapshot file from the currency converter."""
+    rates = RateSnapshot.from_converter()
+    rates.save(RATES_FILE)
+    print(f"Saved rates of {len(rates.rates)} currencies ({rates.version}).")
+
+
+if __name__ == "__main__":
+    main()
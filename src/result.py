@@ -0,0 +1,284 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Module with sorted itineraries serialised for responses and caching."""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, replace
+from json.encoder import encode_basestring_ascii
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import msgpack
+import numpy as np
+
+from .parsing import PRICE_SORTING_TYPES, Request, SortingType
+from .scoring import ScoringProfile
+
+CHUNK_SIZE = 64 * 1024
+"""size of chunks of streamed sorted itineraries in bytes"""
+
+
+@dataclass(frozen=True)
+class SortedItineraries:
+    """
+    Encapsulates sorted itineraries serialised into the JSON format.
+
+    Itineraries are serialised one by one and joined by commas, so any page
+    of them is a single slice of the serialised itineraries. They may be
+    encoded into the MessagePack format the same way.
+    """
+
+    token: str
+    """token of the result (digest of the sorting request)"""
+
+    sorting_type: SortingType
+    """sorting criteria"""
+
+    items: bytes
+    """serialised itineraries joined by commas"""
+
+    ends: np.ndarray
+    """end offsets of the serialised itineraries"""
+
+    keys: np.ndarray | None = None
+    """sorting keys of the itineraries, None if they cannot be updated"""
+
+    profile: ScoringProfile | None = None
+    """scoring profile of the best itineraries, None for other criteria"""
+
+    rates_version: str | None = None
+    """version of EUR rates of prices, None if the criteria ignores prices"""
+
+    msgpack_items: bytes | None = None
+    """itineraries encoded into the MessagePack format one by one and
+    concatenated, None if they have not been encoded"""
+
+    msgpack_ends: np.ndarray | None = None
+    """end offsets of the itineraries encoded into the MessagePack format"""
+
+    @classmethod
+    def from_request(
+        cls: type[SortedItineraries],
+        request: Request,
+        keys: np.ndarray | None = None,
+    ) -> SortedItineraries:
+        """
+        Serialise sorted itineraries of a sorting request.
+
+        :param Request request: sorting request with sorted itineraries
+        :param np.ndarray | None keys: sorting keys of the sorted itineraries,
+            defaults to None (the sorted itineraries cannot be updated)
+        :return SortedItineraries: serialised sorted itineraries
+        """
+        # serialised itineraries are ASCII only, so characters are bytes
+        items = [i._serialise_json() for i in request.sorted_itineraries()]
+        lengths = np.fromiter(map(len, items), dtype=np.int64, count=len(items))
+
+        return cls(
+            token=request.digest(),
+            sorting_type=request.sorting_type,
+            items=",".join(items).encode("ascii"),
+            ends=np.cumsum(lengths) + np.arange(len(items), dtype=np.int64),
+            keys=keys,
+            profile=(
+                request.profile if request.sorting_type == SortingType.BEST
+                    else None
+            ),
+            rates_version=(
+                request.rates.version
+                if request.sorting_type in PRICE_SORTING_TYPES else None
+            ),
+        )
+
+    def starts(self: SortedItineraries) -> np.ndarray:
+        """
+        Get the start offsets of the serialised itineraries.
+
+        :return np.ndarray: start offsets of the serialised itineraries
+        """
+        return np.concatenate(([0], self.ends[:-1] + 1))[:len(self)]
+
+    def find(
+        self: SortedItineraries, itinerary_ids: Sequence[str],
+    ) -> List[np.ndarray]:
+        """
+        Find the sorted itineraries with given identifiers.
+
+        The identifiers of all the serialised itineraries are read in a single
+        pass, however many identifiers are found. A serialised identifier is
+        between '{"id":' and ',"duration_minutes":', which cannot be found
+        within serialised strings (their quotes are escaped), so the
+        serialised itineraries are split by the latter, and each part ends
+        with the identifier of an itinerary after the last of the former.
+
+        :param Sequence[str] itinerary_ids: identifiers of the itineraries
+        :return List[np.ndarray]: indices of the itineraries with each of the
+            identifiers
+        """
+        patterns = [
+            encode_basestring_ascii(i).encode() for i in itinerary_ids
+        ]
+        indices: Dict[bytes, List[int]] = {p: [] for p in patterns}
+        parts = self.items.split(b',"duration_minutes":')[:len(self)]
+        for n, part in enumerate(parts):
+            found = indices.get(part[part.rfind(b'{"id":') + 6:])
+            if found is not None:
+                found.append(n)
+
+        return [np.array(indices[p], dtype=np.intp) for p in patterns]
+
+    def iter_json(
+        self: SortedItineraries,
+        offset: int = 0,
+        limit: int | None = None,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Convert a page of the sorted itineraries to the JSON format by chunks.
+
+        The serialised itineraries are never copied as a whole, only by
+        chunks. They have been serialised as a whole before, so the first
+        chunk is not sent any sooner than all of them could be.
+
+        :param int offset: index of the first itinerary of the page,
+            defaults to 0
+        :param int | None limit: maximal number of itineraries of the page,
+            defaults to None (all the remaining ones)
+        :param int chunk_size: maximal size of a chunk of the serialised
+            itineraries in bytes, defaults to CHUNK_SIZE
+        :return Iterator[bytes]: chunks of the page in the JSON format
+        """
+        header = json.dumps({
+            "sorting_type": self.sorting_type.value,
+            "token": self.token,
+            "offset": offset,
+            "total": len(self),
+        }, separators=(",", ":"))
+        yield header[:-1].encode() + b',"sorted_itineraries":['
+
+        start, end = self.page_bounds(offset, limit)
+        page = memoryview(self.items)[start:end]
+        for chunk_start in range(0, len(page), chunk_size):
+            yield bytes(page[chunk_start:chunk_start + chunk_size])
+
+        yield b"]}"
+
+    def page_bounds(
+        self: SortedItineraries, offset: int = 0, limit: int | None = None,
+    ) -> Tuple[int, int]:
+        """
+        Get the offsets of a page of the serialised itineraries.
+
+        :param int offset: index of the first itinerary of the page,
+            defaults to 0
+        :param int | None limit: maximal number of itineraries of the page,
+            defaults to None (all the remaining ones)
+        :return Tuple[int, int]: start and end offsets of the page
+        """
+        end = len(self) if limit is None else min(offset + limit, len(self))
+        if offset >= end:
+            return 0, 0
+
+        start = 0 if offset == 0 else int(self.ends[offset - 1]) + 1
+        return start, int(self.ends[end - 1])
+
+    def to_json(
+        self: SortedItineraries, offset: int = 0, limit: int | None = None,
+    ) -> bytes:
+        """
+        Convert a page of the sorted itineraries to the JSON format.
+
+        :param int offset: index of the first itinerary of the page,
+            defaults to 0
+        :param int | None limit: maximal number of itineraries of the page,
+            defaults to None (all the remaining ones)
+        :return bytes: the page of the sorted itineraries in the JSON format
+        """
+        return b"".join(self.iter_json(offset, limit, len(self.items) or 1))
+
+    def with_msgpack(self: SortedItineraries) -> SortedItineraries:
+        """
+        Encode the sorted itineraries into the MessagePack format too.
+
+        The serialised itineraries are decoded at once by the C JSON decoder
+        and encoded one by one. It is done once, then pages in the MessagePack
+        format are slices of the encoded itineraries.
+
+        :return SortedItineraries: the sorted itineraries with the encoded
+            ones (the same object if they have been encoded already)
+        """
+        if self.msgpack_items is not None:
+            return self
+
+        packer = msgpack.Packer()
+        items = [
+            packer.pack(i) for i in json.loads(b"[" + self.items + b"]")
+        ]
+        lengths = np.fromiter(
+            map(len, items), dtype=np.int64, count=len(items),
+        )
+
+        return replace(
+            self,
+            msgpack_items=b"".join(items),
+            msgpack_ends=np.cumsum(lengths),
+        )
+
+    def to_msgpack(
+        self: SortedItineraries, offset: int = 0, limit: int | None = None,
+    ) -> bytes:
+        """
+        Convert a page of the sorted itineraries to the MessagePack format.
+
+        The page has the same structure as in the JSON format. It is a slice
+        of the encoded itineraries (see with_msgpack) after a header.
+
+        :param int offset: index of the first itinerary of the page,
+            defaults to 0
+        :param int | None limit: maximal number of itineraries of the page,
+            defaults to None (all the remaining ones)
+        :return bytes: the page of the sorted itineraries in the MessagePack
+            format
+        """
+        encoded = self.with_msgpack()
+        end = len(self) if limit is None else min(offset + limit, len(self))
+        start = min(offset, end)
+        first = 0 if start == 0 else int(encoded.msgpack_ends[start - 1])
+        last = first if start == end else int(encoded.msgpack_ends[end - 1])
+
+        packer = msgpack.Packer()
+        header = [packer.pack_map_header(5)]
+        for key, value in (
+            ("sorting_type", self.sorting_type.value),
+            ("token", self.token),
+            ("offset", offset),
+            ("total", len(self)),
+            ("sorted_itineraries", None),
+        ):
+            header.append(packer.pack(key))
+            if value is not None:
+                header.append(packer.pack(value))
+        header.append(packer.pack_array_header(end - start))
+
+        return b"".join(header) + encoded.msgpack_items[first:last]
+
+    def size(self: SortedItineraries) -> int:
+        """
+        Get the size of the serialised itineraries in bytes.
+
+        :return int: size of the serialised itineraries in bytes
+        """
+        keys_size = 0 if self.keys is None else self.keys.nbytes
+        msgpack_size = 0 if self.msgpack_items is None else (
+            len(self.msgpack_items) + self.msgpack_ends.nbytes
+        )
+        return len(self.items) + self.ends.nbytes + keys_size + msgpack_size
+
+    def __len__(self: SortedItineraries) -> int:
+        """
+        Get the number of sorted itineraries.
+
+        :return int: number of sorted itineraries
+        """
+        return len(self.ends)
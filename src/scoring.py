@@ -0,0 +1,277 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""
+Module with scoring profiles of the best itineraries.
+
+A profile weights duration and price of itineraries into a score and it
+defines the order of sorting keys, so itineraries with equal scores are
+ordered by further keys (e.g., price, duration, and identifier) instead of
+their order in a sorting request. Profiles are compiled into vectorised
+computations of their keys once, when they are constructed. Further profiles
+may be registered from a JSON file given by the ``SCORING_PROFILES``
+environment variable.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from os import getenv
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from .batch import ItineraryBatch
+
+KEYS = ("score", "price", "duration", "id")
+"""names of sorting keys of profiles"""
+
+DEFAULT_PROFILE = "default"
+"""name of the profile used if a sorting request does not name one"""
+
+Column = Callable[["ItineraryBatch", Any], np.ndarray]
+"""computation of a sorting key of itineraries of a batch at given indices"""
+
+
+@dataclass(frozen=True)
+class ScoringProfile:
+    """Encapsulates a scoring profile of the best itineraries."""
+
+    name: str
+    """name of the profile"""
+
+    duration_weight: float = 1
+    """weight of duration in minutes in the score"""
+
+    price_weight: float = 5
+    """weight of price in EUR in the score"""
+
+    order: Tuple[str, ...] = KEYS
+    """sorting keys in the order of their significance"""
+
+    _columns: Tuple[Column, ...] = field(
+        init=False, repr=False, compare=False,
+    )
+    """compiled computations of the sorting keys"""
+
+    def __post_init__(self: ScoringProfile) -> None:
+        """
+        Validate the profile and compile computations of its sorting keys.
+
+        :raises ValueError: if the profile is not valid
+        """
+        if (
+            not isinstance(self.name, str)
+            or not all(
+                isinstance(w, (int, float)) and not isinstance(w, bool)
+                for w in (self.duration_weight, self.price_weight)
+            )
+            or not self.order
+            or not all(k in KEYS for k in self.order)
+            or len(set(self.order)) != len(self.order)
+            or self.order[0] == "id"
+        ):
+            raise ValueError(f"Invalid scoring profile {self.name!r}.")
+
+        # integer weights would overflow the 64-bit integer durations
+        duration_weight, price_weight = self.duration_weight, self.price_weight
+        columns: Dict[str, Column] = {
+            "score": lambda batch, at: (
+                duration_weight * batch.durations[at].astype(np.float64)
+                    + price_weight * batch.amounts_eur[at]
+            ),
+            "price": lambda batch, at: batch.amounts_eur[at],
+            "duration": lambda batch, at: batch.durations[at],
+            "id": lambda batch, at: np.array(
+                [batch.ids[i] for i in at], dtype=str,
+            ),
+        }
+        object.__setattr__(
+            self, "_columns", tuple(columns[k] for k in self.order),
+        )
+
+    def __reduce__(self: ScoringProfile) -> Tuple[Any, ...]:
+        """
+        Reduce the profile for pickling, without its compiled computations.
+
+        :return Tuple[Any, ...]: the class and arguments of its constructor
+        """
+        return (
+            type(self),
+            (self.name, self.duration_weight, self.price_weight, self.order),
+        )
+
+    @classmethod
+    def from_json(
+        cls: type[ScoringProfile], name: str, profile_json: Any,
+    ) -> ScoringProfile:
+        """
+        Construct a profile from the JSON format.
+
+        :param str name: name of the profile
+        :param Any profile_json: the profile in the JSON format
+        :return ScoringProfile: the constructed profile
+        :raises ValueError: if the profile is not valid
+        """
+        if not isinstance(profile_json, dict) or not isinstance(
+            profile_json.get("order", []), list,
+        ):
+            raise ValueError(f"Invalid scoring profile {name!r}.")
+
+        defaults = cls(name)
+        return cls(
+            name=name,
+            duration_weight=profile_json.get(
+                "duration_weight", defaults.duration_weight,
+            ),
+            price_weight=profile_json.get(
+                "price_weight", defaults.price_weight,
+            ),
+            order=tuple(profile_json.get("order", defaults.order)),
+        )
+
+    def to_json(self: ScoringProfile) -> str:
+        """
+        Convert the profile to the JSON format.
+
+        Profiles with the same definition have the same JSON format, so it
+        identifies them in cache keys.
+
+        :return str: the profile in the JSON format
+        """
+        return json.dumps({
+            "name": self.name,
+            "duration_weight": self.duration_weight,
+            "price_weight": self.price_weight,
+            "order": list(self.order),
+        }, separators=(",", ":"))
+
+    def keys(self: ScoringProfile, batch: ItineraryBatch) -> np.ndarray:
+        """
+        Compute the most significant sorting keys of itineraries.
+
+        :param ItineraryBatch batch: itineraries to be sorted
+        :return np.ndarray: the most significant sorting keys
+        """
+        return self._columns[0](batch, slice(None))
+
+    def break_ties(
+        self: ScoringProfile,
+        batch: ItineraryBatch,
+        keys: np.ndarray,
+        permutation: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Order itineraries with equal most significant keys by the other keys.
+
+        Only runs of itineraries with equal keys are sorted again, key by
+        key, so the less significant keys (e.g., identifiers) are computed
+        only for the few itineraries that are still equal.
+
+        :param ItineraryBatch batch: itineraries to be sorted
+        :param np.ndarray keys: the most significant sorting keys of the
+            itineraries
+        :param np.ndarray permutation: permutation of the itineraries stably
+            sorted by the most significant keys
+        :return np.ndarray: permutation of the itineraries sorted by all the
+            keys
+        """
+        positions = np.arange(len(permutation))
+        runs = np.zeros(len(permutation), dtype=np.intp)
+        values = keys[permutation]
+        permutation = permutation.copy()
+        for column in self._columns[1:]:
+            # keep only runs of equal keys
+            equal = (runs[1:] == runs[:-1]) & (values[1:] == values[:-1])
+            if not equal.any():
+                break
+
+            tied = np.zeros(len(positions), dtype=bool)
+            tied[1:] |= equal
+            tied[:-1] |= equal
+            runs = np.cumsum(np.concatenate(([True], ~equal)))[tied]
+            positions = positions[tied]
+
+            # runs are sorted, so itineraries stay within them
+            indices = permutation[positions]
+            values = column(batch, indices)
+            order = np.lexsort((values, runs))
+            permutation[positions] = indices[order]
+            values = values[order]
+
+        return permutation
+
+    def tie_keys(
+        self: ScoringProfile, batch: ItineraryBatch,
+    ) -> List[Tuple[Any, ...]]:
+        """
+        Compute the less significant sorting keys of itineraries.
+
+        :param ItineraryBatch batch: itineraries to be compared
+        :return List[Tuple[Any, ...]]: the less significant sorting keys of
+            each itinerary
+        """
+        indices = np.arange(len(batch))
+        return list(zip(*(
+            column(batch, indices).tolist() for column in self._columns[1:]
+        ))) or [()] * len(batch)
+
+
+PROFILES: Dict[str, ScoringProfile] = {}
+"""registered profiles by their names"""
+
+
+def register(profile: ScoringProfile) -> None:
+    """
+    Register a profile, replacing a registered one with the same name.
+
+    :param ScoringProfile profile: the registered profile
+    """
+    PROFILES[profile.name] = profile
+
+
+def load(profiles_file: str) -> List[ScoringProfile]:
+    """
+    Load profiles from a JSON file and register them.
+
+    The file contains an object of profiles by their names, each of them
+    with optional ``duration_weight``, ``price_weight``, and ``order``.
+
+    :param str profiles_file: file with the profiles
+    :return List[ScoringProfile]: the registered profiles
+    :raises OSError: if the file cannot be read
+    :raises ValueError: if the file does not contain valid profiles
+    """
+    with open(profiles_file) as f:
+        profiles_json = json.load(f)
+
+    if not isinstance(profiles_json, dict):
+        raise ValueError("Invalid scoring profiles.")
+
+    profiles = [
+        ScoringProfile.from_json(name, profile_json)
+        for name, profile_json in profiles_json.items()
+    ]
+    for profile in profiles:
+        register(profile)
+
+    return profiles
+
+
+def profile(name: str = DEFAULT_PROFILE) -> ScoringProfile:
+    """
+    Get a registered profile.
+
+    :param str name: name of the profile, defaults to DEFAULT_PROFILE
+    :return ScoringProfile: the registered profile
+    :raises KeyError: if there is no such profile
+    """
+    return PROFILES[name]
+
+
+register(ScoringProfile(DEFAULT_PROFILE))
+register(ScoringProfile("budget", duration_weight=1, price_weight=10))
+register(ScoringProfile("quick", duration_weight=3, price_weight=5))
+if getenv("SCORING_PROFILES"):
+    load(getenv("SCORING_PROFILES", ""))
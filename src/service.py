@@ -0,0 +1,466 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Module processing sorting requests independently of the web server."""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from http import HTTPStatus
+from os import getenv
+from sqlite3 import Cursor, Error
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import msgpack
+
+from .cache import MemoryCache
+from .db import database
+from .metrics import count, observe, stage
+from .negotiation import (
+    WireFormat,
+    accept_format,
+    compress,
+    entity_tag,
+    negotiate,
+    not_modified,
+    strong_etag,
+)
+from .parsing import parse_delta, parse_request
+from .result import SortedItineraries
+from .sorting import (
+    encode_msgpack_cached,
+    load_variant,
+    sort_request_cached,
+    sort_requests_cached,
+    store_variant,
+    update_sorted_cached,
+)
+
+memory_cache: MemoryCache[SortedItineraries] = MemoryCache(
+    max_entries=int(getenv("MEMORY_CACHE_ENTRIES", "1024")),
+    max_bytes=int(getenv("MEMORY_CACHE_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(getenv("MEMORY_CACHE_TTL", "300")),
+)
+"""in-memory cache of sorted itineraries in front of the database"""
+
+COMPRESSION_THRESHOLD = int(getenv("COMPRESSION_THRESHOLD", "1024"))
+"""minimal size of bodies of responses to be compressed in bytes"""
+
+SortedResponse = SortedItineraries | List[SortedItineraries]
+"""sorted itineraries of a response (a list for multiple sorting criteria)"""
+
+Page = Tuple[int, int | None]
+"""offset and limit of a page of sorted itineraries"""
+
+
+def sort_body(
+    body: bytes,
+    wire_format: WireFormat = WireFormat.JSON,
+    condition: Condition | None = None,
+) -> SortedResponse | Representation:
+    """
+    Process a body of a sorting request.
+
+    A conditional sorting request is answered before its itineraries are
+    sorted (or loaded), if the client has the current representation of its
+    response already.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :param Condition | None condition: condition of the sorting request,
+        defaults to None (unconditional)
+    :return SortedResponse | Representation: sorted itineraries of the
+        response, or the not modified representation
+    :raises ParsingError: if parsing of the sorting request failed
+    """
+    observe("sorting_request_bytes", len(body))
+    request = parse_request(body, wire_format)
+    if condition is not None:
+        requests = request if isinstance(request, list) else [request]
+        representation = __not_modified_before_sorting(
+            [r.digest() for r in requests],
+            isinstance(request, list),
+            condition,
+        )
+        if representation is not None:
+            return representation
+
+    with database() as cursor:
+        if isinstance(request, list):
+            return sort_requests_cached(request, cursor, memory_cache)
+
+        return sort_request_cached(request, cursor, memory_cache)
+
+
+def update_body(
+    token: str, body: bytes, wire_format: WireFormat = WireFormat.JSON,
+) -> SortedItineraries | None:
+    """
+    Process a body of a request changing sorted itineraries.
+
+    :param str token: token of the sorted itineraries to be changed
+    :param bytes body: body of the request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :return SortedItineraries | None: changed sorted itineraries, None if the
+        sorted itineraries are not cached (anymore)
+    :raises ParsingError: if parsing of the request failed or the sorted
+        itineraries cannot be changed
+    """
+    delta = parse_delta(body, wire_format)
+    with database() as cursor:
+        return update_sorted_cached(token, delta, cursor, memory_cache)
+
+
+def __iter_chunks(response: SortedResponse) -> Iterator[bytes]:
+    """
+    Convert sorted itineraries of a response to the JSON format by chunks.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :return Iterator[bytes]: chunks of the body of the response
+    """
+    if isinstance(response, SortedItineraries):
+        yield from response.iter_json()
+        return
+
+    yield b'{"results":['
+    for n, result in enumerate(response):
+        if n > 0:
+            yield b","
+        yield from result.iter_json()
+    yield b"]}"
+
+
+def iter_response(response: SortedResponse) -> Iterator[bytes]:
+    """
+    Convert sorted itineraries of a response to the JSON format by chunks.
+
+    If multiple sorting criteria were given, the response contains results
+    of all of them. The size of the response is counted once it is complete.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :return Iterator[bytes]: chunks of the body of the response
+    """
+    size = 0
+    for chunk in __iter_chunks(response):
+        size += len(chunk)
+        yield chunk
+
+    count("sorting_response_bytes_total", size)
+
+
+def pretty_print(body: bytes) -> bytes:
+    """
+    Pretty-print a body of a response in the JSON format.
+
+    :param bytes body: body of the response in the compact JSON format
+    :return bytes: body of the response in the pretty-printed JSON format
+    """
+    return json.dumps(json.loads(body), indent=2).encode()
+
+
+def format_body(chunks: Iterable[bytes], pretty: bool) -> Iterable[bytes]:
+    """
+    Format a body of a response in the JSON format.
+
+    :param Iterable[bytes] chunks: chunks of the body in the compact JSON
+        format
+    :param bool pretty: whether the body is pretty-printed
+    :return Iterable[bytes]: chunks of the formatted body
+    """
+    return [pretty_print(b"".join(chunks))] if pretty else chunks
+
+
+@dataclass(frozen=True)
+class Representation:
+    """Encapsulates a representation of a response negotiated with a client."""
+
+    status: HTTPStatus
+    """status of the response"""
+
+    body: Iterable[bytes]
+    """chunks of the body of the response"""
+
+    headers: Dict[str, str]
+    """headers of the representation (format, entity tag, content coding)"""
+
+
+@dataclass(frozen=True)
+class Condition:
+    """
+    Encapsulates a condition of a sorting request on the representation of
+    its response the client has already.
+    """
+
+    if_none_match: str
+    """value of the If-None-Match header"""
+
+    pretty: bool = False
+    """whether a body in the JSON format is pretty-printed"""
+
+    accept: str | None = None
+    """value of the Accept header"""
+
+    accept_encoding: str | None = None
+    """value of the Accept-Encoding header"""
+
+
+def __variant(
+    many: bool, page: Page | None, pretty: bool, wire_format: WireFormat,
+) -> Tuple[Any, ...]:
+    """
+    Get properties of a body of a response other than its sorted itineraries.
+
+    :param bool many: whether the response contains results of multiple
+        sorting criteria
+    :param Page | None page: page of the sorted itineraries, None for a
+        response of a sorting request
+    :param bool pretty: whether the body is pretty-printed
+    :param WireFormat wire_format: format of the body
+    :return Tuple[Any, ...]: the properties of the body
+    """
+    variant: Tuple[Any, ...] = ()
+    if many:
+        variant += ("results",)
+    if page is not None:
+        variant += page
+    if wire_format != WireFormat.JSON:
+        variant += (wire_format.value,)
+    elif pretty:
+        variant += ("pretty",)
+
+    return variant
+
+
+def __headers(wire_format: WireFormat, etag: str) -> Dict[str, str]:
+    """
+    Get headers of a representation of a response.
+
+    :param WireFormat wire_format: format of the body
+    :param str etag: entity tag of the representation
+    :return Dict[str, str]: the headers
+    """
+    return {
+        "Content-Type": wire_format.value,
+        "ETag": etag,
+        "Vary": "Accept, Accept-Encoding",
+    }
+
+
+def __not_modified(wire_format: WireFormat, etag: str) -> Representation:
+    """
+    Get a not modified representation of a response.
+
+    :param WireFormat wire_format: format of the body
+    :param str etag: entity tag of the representation the client has
+    :return Representation: the not modified representation
+    """
+    count("sorting_not_modified_total")
+    return Representation(
+        HTTPStatus.NOT_MODIFIED, [], __headers(wire_format, etag),
+    )
+
+
+def __not_modified_before_sorting(
+    tokens: List[str], many: bool, condition: Condition,
+) -> Representation | None:
+    """
+    Check a condition of a sorting request before sorting its itineraries.
+
+    The size of the body of the response, which decides on its compression,
+    is not known before sorting. So, the condition is met by the entity tags
+    of both the uncompressed body and the body compressed by the negotiated
+    content coding, as both of them represent the same sorted itineraries.
+
+    :param List[str] tokens: tokens of the sorted itineraries of the response
+    :param bool many: whether the response contains results of multiple
+        sorting criteria
+    :param Condition condition: condition of the sorting request
+    :return Representation | None: the not modified representation, None if
+        the condition is not met
+    """
+    wire_format = accept_format(condition.accept)
+    tag = entity_tag(
+        tokens, *__variant(many, None, condition.pretty, wire_format),
+    )
+    for coding in (negotiate(condition.accept_encoding), None):
+        etag = strong_etag(tag, coding)
+        if not_modified(condition.if_none_match, etag):
+            return __not_modified(wire_format, etag)
+
+    return None
+
+
+def __serialise(
+    response: SortedResponse,
+    page: Page | None,
+    pretty: bool,
+    wire_format: WireFormat,
+) -> Iterable[bytes]:
+    """
+    Serialise a body of a response by chunks.
+
+    Bodies in the JSON format are streamed from the serialised itineraries,
+    while bodies in the MessagePack format are joined from the encoded
+    itineraries at once (see encode_msgpack_cached).
+
+    :param SortedResponse response: sorted itineraries of the response
+    :param Page | None page: page of the sorted itineraries, None for a
+        response of a sorting request
+    :param bool pretty: whether the body is pretty-printed
+    :param WireFormat wire_format: format of the body
+    :return Iterable[bytes]: chunks of the body of the response
+    """
+    if wire_format == WireFormat.JSON:
+        if isinstance(response, SortedItineraries) and page is not None:
+            return format_body(response.iter_json(*page), pretty)
+
+        return format_body(iter_response(response), pretty)
+
+    if isinstance(response, SortedItineraries):
+        return [response.to_msgpack(*(page or ()))]
+
+    packer = msgpack.Packer()
+    return [
+        packer.pack_map_header(1) + packer.pack("results") +
+        packer.pack_array_header(len(response)) +
+        b"".join(r.to_msgpack() for r in response),
+    ]
+
+
+def __with_msgpack(response: SortedResponse, cursor: Cursor) -> SortedResponse:
+    """
+    Encode sorted itineraries of a response into the MessagePack format once.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :param Cursor cursor: database cursor
+    :return SortedResponse: the sorted itineraries with the encoded ones
+    """
+    if isinstance(response, SortedItineraries):
+        return encode_msgpack_cached(response, cursor, memory_cache)
+
+    return [encode_msgpack_cached(r, cursor, memory_cache) for r in response]
+
+
+def __encoded(
+    response: SortedResponse,
+    page: Page | None,
+    pretty: bool,
+    wire_format: WireFormat,
+    coding: str | None,
+) -> bytes:
+    """
+    Serialise a body of a response at once and compress it.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :param Page | None page: page of the sorted itineraries, None for a
+        response of a sorting request
+    :param bool pretty: whether the body is pretty-printed
+    :param WireFormat wire_format: format of the body
+    :param str | None coding: content coding of the body, None for no coding
+    :return bytes: the body of the response
+    """
+    body = b"".join(__serialise(response, page, pretty, wire_format))
+    if coding is not None:
+        with stage("compress"):
+            body = compress(body, coding)
+        count("sorting_compressed_total", coding=coding)
+
+    return body
+
+
+def represent(
+    response: SortedResponse,
+    page: Page | None = None,
+    pretty: bool = False,
+    accept: str | None = None,
+    accept_encoding: str | None = None,
+    if_none_match: str | None = None,
+) -> Representation:
+    """
+    Negotiate a representation of a response with a client.
+
+    The entity tag of the response is derived from the tokens of its sorted
+    itineraries. So, if the client has the current representation already,
+    nothing is serialised and the response is not modified. The format of
+    the body is negotiated by the Accept header. Bodies of at least
+    COMPRESSION_THRESHOLD bytes are compressed by a content coding accepted by
+    the client. Compressed bodies are stored with the cached sorted
+    itineraries as their variants by their entity tags, so they are not
+    compressed again. The sorted itineraries are encoded into the MessagePack
+    format once and cached with them, so bodies in the format are only
+    sliced from the encoded itineraries.
+
+    :param SortedResponse response: sorted itineraries of the response
+    :param Page | None page: page of the sorted itineraries, defaults to None
+        (a response of a sorting request)
+    :param bool pretty: whether a body in the JSON format is pretty-printed,
+        defaults to False
+    :param str | None accept: value of the Accept header, defaults to None
+    :param str | None accept_encoding: value of the Accept-Encoding header,
+        defaults to None
+    :param str | None if_none_match: value of the If-None-Match header,
+        defaults to None
+    :return Representation: the negotiated representation
+    """
+    wire_format = accept_format(accept)
+    if isinstance(response, SortedItineraries):
+        tokens = [response.token]
+        start, end = response.page_bounds(*(page or ()))
+        size = end - start
+    else:
+        tokens = [r.token for r in response]
+        size = sum(len(r.items) for r in response)
+
+    coding = None
+    if size >= COMPRESSION_THRESHOLD:
+        coding = negotiate(accept_encoding)
+
+    etag = strong_etag(
+        entity_tag(
+            tokens,
+            *__variant(
+                not isinstance(response, SortedItineraries),
+                page,
+                pretty,
+                wire_format,
+            ),
+        ),
+        coding,
+    )
+    if not_modified(if_none_match, etag):
+        return __not_modified(wire_format, etag)
+
+    headers = __headers(wire_format, etag)
+    if coding is None and wire_format == WireFormat.JSON:
+        return Representation(
+            HTTPStatus.OK,
+            __serialise(response, page, pretty, wire_format),
+            headers,
+        )
+
+    with database() as cursor:
+        body = None if coding is None else load_variant(
+            tokens[0], etag, cursor,
+        )
+        if body is None:
+            if wire_format == WireFormat.MSGPACK:
+                response = __with_msgpack(response, cursor)
+            if coding is None:
+                return Representation(
+                    HTTPStatus.OK,
+                    __serialise(response, page, pretty, wire_format),
+                    headers,
+                )
+
+            body = __encoded(response, page, pretty, wire_format, coding)
+            try:
+                store_variant(tokens[0], etag, body, cursor)
+            except Error:  # e.g., the database is locked
+                cursor.connection.rollback()  # a later request stores it
+
+    if coding is not None:
+        headers["Content-Encoding"] = coding
+
+    return Representation(HTTPStatus.OK, [body], headers)
@@ -2,85 +2,855 @@
 
 """Module that handles sorting of itineraries."""
 
-import pickle
-from sqlite3 import Cursor
+import json
+from bisect import bisect_right
+from sqlite3 import Cursor, Error
+from time import time
+from typing import Any, Callable, Dict, List, Tuple
 
-from .parsing import Itineraries, Request, SortingType
+import numpy as np
 
+from .batch import ItineraryBatch
+from .cache import MemoryCache, SingleFlight
+from .db import touch
+from .metrics import count, stage
+from .parallel import PARALLEL_THRESHOLD, parallel_argsort, parallel_workers
+from .parsing import (
+    Delta,
+    Itineraries,
+    ParsingError,
+    RateTable,
+    Request,
+    SortingType,
+    _parse_itineraries,
+)
+from .result import SortedItineraries
+from .scoring import DEFAULT_PROFILE, PROFILES, ScoringProfile
 
-def __sort_cheapest(itineraries: Itineraries) -> None:
+RECORD_VERSION = 5
+"""version of the format of cached records (other versions are ignored)"""
+
+__in_flight: SingleFlight[SortedItineraries] = SingleFlight()  # being sorted
+__COLUMNS = (
+    "hash", "version", "sorting_type", "items", "ends", "keys", "profile",
+    "created", "accessed", "size", "rates", "msgpack_items", "msgpack_ends",
+)  # stored columns of cached records
+# idempotent storing of a cached record, concurrent stores do not conflict
+__UPSERT = (
+    f"INSERT INTO result ({', '.join(__COLUMNS)}) " +
+    f"VALUES ({', '.join('?' * len(__COLUMNS))}) " +
+    "ON CONFLICT (hash) DO UPDATE SET " +
+    ", ".join(f"{c} = excluded.{c}" for c in __COLUMNS[1:])
+)
+
+
+def __cheapest_keys(batch: ItineraryBatch) -> np.ndarray:
     """
-    Sort itineraries based on price, with the most affordable ones coming first.
+    Compute keys to sort itineraries based on price, with the most affordable
+    ones coming first.
 
-    :param Itineraries itineraries: itineraries to be sorted
+    :param ItineraryBatch batch: itineraries to be sorted
+    :return np.ndarray: sorting keys of the itineraries
     """
-    itineraries.sort(key=lambda i: i.price.amount_eur)
+    return batch.amounts_eur
 
 
-def __sort_fastest(itineraries: Itineraries) -> None:
+def __fastest_keys(batch: ItineraryBatch) -> np.ndarray:
     """
-    Sort itineraries by duration, with the shortest ones coming first.
+    Compute keys to sort itineraries by duration, with the shortest ones
+    coming first.
 
-    :param Itineraries itineraries: itineraries to be sorted
+    :param ItineraryBatch batch: itineraries to be sorted
+    :return np.ndarray: sorting keys of the itineraries
     """
-    itineraries.sort(key=lambda i: i.duration)
+    return batch.durations
 
 
-def __sort_best(itineraries: Itineraries) -> None:
+def __best_keys(
+    batch: ItineraryBatch, profile: ScoringProfile,
+) -> np.ndarray:
     """
-    Sort itineraries with the best ones coming first.
+    Compute keys to sort itineraries with the best ones coming first.
 
     For the best ones, both duration as well as price are considered, each of
-    them with a different weight.
+    them with a weight given by a scoring profile. These are only the most
+    significant keys of the profile.
+
+    :param ItineraryBatch batch: itineraries to be sorted
+    :param ScoringProfile profile: scoring profile of the best itineraries
+    :return np.ndarray: sorting keys of the itineraries
+    """
+    return profile.keys(batch)
+
+
+def sort_keys(
+    batch: ItineraryBatch,
+    sorting_type: SortingType,
+    profile: ScoringProfile | None = None,
+) -> np.ndarray:
+    """
+    Compute keys to sort itineraries using a sorting criteria.
+
+    :param ItineraryBatch batch: itineraries to be sorted
+    :param SortingType sorting_type: sorting criteria
+    :param ScoringProfile | None profile: scoring profile of the best
+        itineraries, defaults to None (the default profile)
+    :return np.ndarray: sorting keys of the itineraries
+    """
+    if sorting_type == SortingType.CHEAPEST:
+        return __cheapest_keys(batch)
+    elif sorting_type == SortingType.FASTEST:
+        return __fastest_keys(batch)
+    else:
+        return __best_keys(batch, profile or PROFILES[DEFAULT_PROFILE])
+
 
-    :param Itineraries itineraries: itineraries to be sorted
+def __keys_dtype(
+    sorting_type: SortingType, profile: ScoringProfile | None = None,
+) -> np.dtype:
     """
-    DURATION_WEIGHT = 1
-    PRICE_WEIGHT = 5
-    itineraries.sort(
-        key=lambda i:
-            DURATION_WEIGHT * i.duration + PRICE_WEIGHT * i.price.amount_eur,
+    Get the data type of keys to sort itineraries using a sorting criteria.
+
+    Durations are integers, so they are kept exactly even above 2^53, while
+    amounts in EUR and scores are floats.
+
+    :param SortingType sorting_type: sorting criteria
+    :param ScoringProfile | None profile: scoring profile of the best
+        itineraries, defaults to None (the default profile)
+    :return np.dtype: little-endian data type of the sorting keys
+    """
+    no_itineraries = ItineraryBatch(
+        durations=np.empty(0, dtype=np.int64),
+        amounts_eur=np.empty(0, dtype=np.float64),
+        ids=[],
     )
+    return sort_keys(
+        no_itineraries, sorting_type, profile,
+    ).dtype.newbyteorder("<")
+
+
+def __select_smallest(keys: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Compute a permutation of the smallest keys without sorting all of them.
 
+    The keys are partitioned around the limit-th smallest one in linear time,
+    and only the keys not greater than it are sorted. The result is the same
+    as a stable sort of all the keys truncated to the limit, except that all
+    the keys equal to the limit-th smallest one are kept, so they can be
+    ordered by other keys before truncating.
 
-def sort_request(request: Request, cursor: Cursor | None = None) -> Request:
+    :param np.ndarray keys: sorting keys
+    :param int limit: minimal number of keys in the permutation
+    :return np.ndarray: permutation of the smallest keys
+    """
+    if limit == 0:
+        return np.empty(0, dtype=np.intp)
+
+    kth_key = np.partition(keys, limit - 1)[limit - 1]
+    candidates = np.flatnonzero(keys <= kth_key)
+
+    return candidates[np.argsort(keys[candidates], kind="stable")]
+
+
+def sort_permutation(
+    batch: ItineraryBatch,
+    sorting_type: SortingType,
+    limit: int | None = None,
+    profile: ScoringProfile | None = None,
+) -> np.ndarray:
+    """
+    Compute a permutation that sorts itineraries using a sorting criteria.
+
+    Sorting is stable, i.e., itineraries that compare equal keep their
+    original order. The best itineraries with equal scores are ordered by the
+    other keys of their scoring profile. If a limit is given, only the first
+    itineraries are selected, which is cheaper than sorting all of them. Very
+    large numbers of itineraries are sorted in parallel.
+
+    :param ItineraryBatch batch: itineraries to be sorted
+    :param SortingType sorting_type: sorting criteria
+    :param int | None limit: maximal number of itineraries in the permutation,
+        defaults to None (all of them)
+    :param ScoringProfile | None profile: scoring profile of the best
+        itineraries, defaults to None (the default profile)
+    :return np.ndarray: permutation of the sorted itineraries
+    """
+    keys = sort_keys(batch, sorting_type, profile)
+    if limit is not None and limit < len(keys):
+        permutation = __select_smallest(keys, limit)
+    elif len(keys) >= PARALLEL_THRESHOLD and parallel_workers() > 1:
+        permutation = parallel_argsort(keys)
+    else:
+        permutation = np.argsort(keys, kind="stable")
+
+    if sorting_type == SortingType.BEST:
+        permutation = (profile or PROFILES[DEFAULT_PROFILE]).break_ties(
+            batch, keys, permutation,
+        )
+
+    return permutation[:limit]
+
+
+def canonical_batch(request: Request) -> ItineraryBatch:
+    """
+    Construct a columnar batch of itineraries in their canonical order.
+
+    :param Request request: sorting request with itineraries to be sorted
+    :return ItineraryBatch: columnar batch of the itineraries of the request
+        in their canonical order
+    """
+    return ItineraryBatch.from_itineraries(
+        [request.itineraries[i] for i in request._canonical_order],
+    )
+
+
+def sort_request(
+    request: Request, batch: ItineraryBatch | None = None,
+) -> Request:
     """
     Sort itineraries using various sorting criteria.
 
-    Sorting requests are cached to the SQLite3 database. So, the same requests
-    are not sorted again.
+    The itineraries are sorted in their canonical order, so itineraries that
+    compare equal are ordered by their canonical forms. The sorted
+    itineraries are thus fixed by the digest of the request, regardless the
+    order the itineraries were given in.
 
     :param Request request: sorting request with itineraries to be sorted
-    :param Cursor | None cursor: database cursor, defaults to None
+    :param ItineraryBatch | None batch: columnar batch of the itineraries of
+        the request in their canonical order, defaults to None (a new batch)
     :return Request: request with sorted itineraries
     """
-    request_hash = hash(request)
+    # for testing purposes only
+    sort_request.sorted_count = getattr(sort_request, "sorted_count", 0) + 1
+
+    with stage("sort"):
+        if batch is None:
+            batch = canonical_batch(request)
+
+        request.order = np.asarray(request._canonical_order, dtype=np.intp)[
+            sort_permutation(
+                batch, request.sorting_type, request.limit, request.profile,
+            )
+        ]
+
+    return request
+
+
+def __load_profile(profile_json: str) -> ScoringProfile:
+    """
+    Load a scoring profile of cached sorted itineraries.
+
+    The profile is restored from its definition, so it is the same even if a
+    registered profile with its name has been changed since.
+
+    :param str profile_json: the scoring profile in the JSON format
+    :return ScoringProfile: the scoring profile
+    """
+    profile_dict = json.loads(profile_json)
+    return ScoringProfile.from_json(profile_dict["name"], profile_dict)
+
+
+def load_sorted(
+    token: str,
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> SortedItineraries | None:
+    """
+    Load cached sorted itineraries.
+
+    The in-memory cache, if given, is looked up before the database and it is
+    populated with sorted itineraries loaded from the database. Found sorted
+    itineraries are recorded as accessed, so they are not evicted from the
+    database.
+
+    :param str token: token of the sorted itineraries
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return SortedItineraries | None: sorted itineraries, None if they are not
+        cached (anymore)
+    """
+    # load from the in-memory cache
+    if memory_cache is not None:
+        result = memory_cache.get(token)
+        count(
+            "sorting_cache_hits_total" if result is not None
+                else "sorting_cache_misses_total",
+            cache="memory",
+        )
+        if result is not None:
+            touch(token)
+            return result
 
     # load from the cache
     if cursor is not None:
-        row = cursor.execute(
-            "SELECT request FROM request WHERE hash = ?",
-            (request_hash,),
-        ).fetchone()
+        with stage("db_lookup"):
+            row = cursor.execute(
+                "SELECT sorting_type, items, ends, keys, profile, rates, " +
+                "msgpack_items, msgpack_ends FROM result " +
+                "WHERE hash = ? AND version = ?",
+                (token, RECORD_VERSION),
+            ).fetchone()
+        count(
+            "sorting_cache_hits_total" if row is not None
+                else "sorting_cache_misses_total",
+            cache="db",
+        )
         if row is not None:
-            return pickle.loads(row[0])
+            sorting_type = SortingType(row[0])
+            profile = None if row[4] is None else __load_profile(row[4])
+            result = SortedItineraries(
+                token=token,
+                sorting_type=sorting_type,
+                items=row[1],
+                ends=np.frombuffer(row[2], dtype="<i8"),
+                keys=(
+                    None if row[3] is None else np.frombuffer(
+                        row[3], dtype=__keys_dtype(sorting_type, profile),
+                    )
+                ),
+                profile=profile,
+                rates_version=row[5],
+                msgpack_items=row[6],
+                msgpack_ends=(
+                    None if row[7] is None
+                        else np.frombuffer(row[7], dtype="<i8")
+                ),
+            )
+            if memory_cache is not None:
+                memory_cache.put(token, result, result.size())
 
-    # for testing purposes only
-    sort_request.sorted_count = getattr(sort_request, "sorted_count", 0) + 1
+            touch(token)
+            return result
 
-    if request.sorting_type == SortingType.CHEAPEST:
-        __sort_cheapest(request.itineraries)
-    elif request.sorting_type == SortingType.FASTEST:
-        __sort_fastest(request.itineraries)
-    else:
-        __sort_best(request.itineraries)
+    return None
+
+
+def __store_sorted(
+    result: SortedItineraries,
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> None:
+    """
+    Store sorted itineraries to the caches.
+
+    They are not stored to the database if it is locked (or if storing fails
+    otherwise), so a sort which succeeded does not fail.
+
+    :param SortedItineraries result: serialised sorted itineraries
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    """
+    if memory_cache is not None:
+        memory_cache.put(result.token, result, result.size())
 
-    # store to the cache
     if cursor is not None:
-        cursor.execute(
-            "INSERT INTO request (hash, request) VALUES (?, ?)",
-            (request_hash, pickle.dumps(request)),
-        )
+        with stage("db_store"):
+            ends = result.ends.astype("<i8").tobytes()
+            keys = None if result.keys is None else result.keys.astype(
+                result.keys.dtype.newbyteorder("<"),
+            ).tobytes()
+            msgpack_ends = None if result.msgpack_ends is None else (
+                result.msgpack_ends.astype("<i8").tobytes()
+            )
+            now = time()
+            try:
+                # variants of a record of another version might differ
+                cursor.execute(
+                    "DELETE FROM variant WHERE hash = ?", (result.token,),
+                )
+                cursor.execute(
+                    __UPSERT,
+                    (
+                        result.token,
+                        RECORD_VERSION,
+                        result.sorting_type.value,
+                        result.items,
+                        ends,
+                        keys,
+                        (
+                            None if result.profile is None
+                                else result.profile.to_json()
+                        ),
+                        now,
+                        now,
+                        len(result.items) + len(ends) + len(keys or b"")
+                            + len(result.msgpack_items or b"")
+                            + len(msgpack_ends or b""),
+                        result.rates_version,
+                        result.msgpack_items,
+                        msgpack_ends,
+                    ),
+                )
+                cursor.connection.commit()
+            except Error:  # e.g., the database is locked
+                cursor.connection.rollback()  # a later request stores it
+
+
+def encode_msgpack_cached(
+    result: SortedItineraries,
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> SortedItineraries:
+    """
+    Encode sorted itineraries into the MessagePack format once.
+
+    The encoded itineraries are stored with the sorted itineraries to the
+    caches, so responses in the MessagePack format are only sliced from them
+    later. They are stored to the database only if the sorted itineraries
+    are cached there, and they are not stored if the database is locked.
+
+    :param SortedItineraries result: serialised sorted itineraries
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return SortedItineraries: the sorted itineraries with the encoded ones
+    """
+    if result.msgpack_items is not None:
+        return result
+
+    with stage("serialise"):
+        result = result.with_msgpack()
+    if memory_cache is not None:
+        memory_cache.put(result.token, result, result.size())
+
+    if cursor is not None:
+        ends = result.msgpack_ends.astype("<i8").tobytes()
+        with stage("db_store"):
+            try:
+                cursor.execute(
+                    "UPDATE result SET msgpack_items = ?, msgpack_ends = ?, " +
+                    "size = size + ? " +
+                    "WHERE hash = ? AND version = ? AND msgpack_items IS NULL",
+                    (
+                        result.msgpack_items,
+                        ends,
+                        len(result.msgpack_items) + len(ends),
+                        result.token,
+                        RECORD_VERSION,
+                    ),
+                )
+                cursor.connection.commit()
+            except Error:  # e.g., the database is locked
+                cursor.connection.rollback()  # a later request stores it
+
+    return result
+
+
+def load_variant(token: str, etag: str, cursor: Cursor) -> bytes | None:
+    """
+    Load a cached variant of a body of a response (e.g., a compressed one).
+
+    :param str token: token of the (first) sorted itineraries of the response
+    :param str etag: entity tag of the variant
+    :param Cursor cursor: database cursor
+    :return bytes | None: the body of the variant, None if it is not cached
+        (anymore)
+    """
+    with stage("db_lookup"):
+        row = cursor.execute(
+            "SELECT body FROM variant WHERE hash = ? AND etag = ?",
+            (token, etag),
+        ).fetchone()
+    count(
+        "sorting_cache_hits_total" if row is not None
+            else "sorting_cache_misses_total",
+        cache="variant",
+    )
+
+    return None if row is None else row[0]
+
+
+def store_variant(token: str, etag: str, body: bytes, cursor: Cursor) -> None:
+    """
+    Store a variant of a body of a response with its sorted itineraries.
+
+    The variant is stored only if the sorted itineraries are cached in the
+    database. It is counted into their size and evicted with them.
+
+    :param str token: token of the (first) sorted itineraries of the response
+    :param str etag: entity tag of the variant
+    :param bytes body: the body of the variant
+    :param Cursor cursor: database cursor
+    """
+    with stage("db_store"):
+        stored = cursor.execute(
+            "INSERT OR IGNORE INTO variant (hash, etag, body) " +
+            "SELECT hash, ?, ? FROM result WHERE hash = ? AND version = ?",
+            (etag, body, token, RECORD_VERSION),
+        ).rowcount
+        if stored:
+            cursor.execute(
+                "UPDATE result SET size = size + ? WHERE hash = ?",
+                (len(body), token),
+            )
         cursor.connection.commit()
 
-    return request
+
+def __sort_serialised(
+    request: Request, batch: ItineraryBatch,
+) -> SortedItineraries:
+    """
+    Sort itineraries and serialise them.
+
+    Sorting keys are kept with the sorted itineraries, unless the number of
+    them is limited, so they can be updated later.
+
+    :param Request request: sorting request with itineraries to be sorted
+    :param ItineraryBatch batch: columnar batch of the itineraries of the
+        request in their canonical order
+    :return SortedItineraries: serialised sorted itineraries
+    """
+    sort_request(request, batch)
+    keys = None
+    if request.limit is None:
+        # keys of the batch are in the canonical order of the itineraries
+        batch_keys = sort_keys(batch, request.sorting_type, request.profile)
+        keys = np.empty(len(batch), dtype=batch_keys.dtype)
+        keys[request._canonical_order] = batch_keys
+        keys = keys[request.order]
+
+    with stage("serialise"):
+        return SortedItineraries.from_request(request, keys)
+
+
+def __sort_coalesced(
+    request: Request,
+    token: str,
+    batch: Callable[[], ItineraryBatch],
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> SortedItineraries:
+    """
+    Sort itineraries, serialise them, and store them to the caches.
+
+    Concurrent identical sorting requests are coalesced, i.e., only the first
+    one is sorted and the others wait for it and share its result.
+
+    :param Request request: sorting request with itineraries to be sorted
+    :param str token: digest of the sorting request
+    :param Callable[[], ItineraryBatch] batch: columnar batch of the
+        itineraries of the request in their canonical order, only built if
+        they are sorted
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return SortedItineraries: serialised sorted itineraries
+    """
+    def sort_stored() -> SortedItineraries:
+        # a coalesced request might have been stored just before
+        if memory_cache is not None:
+            result = memory_cache.get(token)
+            if result is not None:
+                return result
+
+        result = __sort_serialised(request, batch())
+        __store_sorted(result, cursor, memory_cache)
+
+        return result
+
+    result, shared = __in_flight.do(token, sort_stored)
+    if shared:
+        count("sorting_coalesced_total")
+
+    return result
+
+
+def sort_request_cached(
+    request: Request,
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> SortedItineraries:
+    """
+    Sort itineraries and serialise them, or load them from the caches.
+
+    Sorted itineraries are cached to the SQLite3 database under digests of
+    requests already serialised. So, the same requests (even with itineraries
+    given in a different order) are not sorted nor serialised again, not even
+    if they arrive at the same time. The in-memory cache, if given, is looked
+    up before the database and it is populated with sorted itineraries stored
+    to or loaded from the database.
+
+    :param Request request: sorting request with itineraries to be sorted
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return SortedItineraries: serialised sorted itineraries
+    """
+    token = request.digest()
+    result = load_sorted(token, cursor, memory_cache)
+    if result is None:
+        result = __sort_coalesced(
+            request,
+            token,
+            lambda: canonical_batch(request),
+            cursor,
+            memory_cache,
+        )
+
+    return result
+
+
+def sort_requests_cached(
+    requests: List[Request],
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> List[SortedItineraries]:
+    """
+    Sort the same itineraries using multiple sorting criteria.
+
+    Sorting requests have to share their itineraries (see Request.many). The
+    columnar batch of the itineraries is built at most once and all the
+    sorting criteria use it. Each sorting request is cached and coalesced on
+    its own, so later requests with a single sorting criteria are not sorted
+    again.
+
+    :param List[Request] requests: sorting requests sharing the itineraries
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return List[SortedItineraries]: serialised sorted itineraries for each
+        sorting request
+    """
+    batches: List[ItineraryBatch] = []
+
+    def batch() -> ItineraryBatch:
+        if not batches:
+            batches.append(canonical_batch(requests[0]))
+
+        return batches[0]
+
+    results = []
+    for request in requests:
+        token = request.digest()
+        result = load_sorted(token, cursor, memory_cache)
+        if result is None:
+            result = __sort_coalesced(
+                request, token, batch, cursor, memory_cache,
+            )
+
+        results.append(result)
+
+    return results
+
+
+def __tie_keys(
+    itineraries: Itineraries, profile: ScoringProfile | None,
+) -> List[Tuple[Any, ...]]:
+    """
+    Compute the sorting keys of itineraries less significant than the first.
+
+    :param Itineraries itineraries: itineraries to be compared
+    :param ScoringProfile | None profile: scoring profile of the best
+        itineraries, None for other criteria
+    :return List[Tuple[Any, ...]]: the other keys of the scoring profile (if
+        any) followed by the canonical form of each itinerary
+    """
+    canonical_forms = [i._canonical() for i in itineraries]
+    if profile is None:
+        return [(f,) for f in canonical_forms]
+
+    return [
+        (*k, f) for k, f in zip(
+            profile.tie_keys(ItineraryBatch.from_itineraries(itineraries)),
+            canonical_forms,
+        )
+    ]
+
+
+def __break_insertion_ties(
+    result: SortedItineraries,
+    rates: RateTable,
+    kept_indices: np.ndarray,
+    first_equal: np.ndarray,
+    first_greater: np.ndarray,
+    tie_keys: List[Tuple[Any, ...]],
+) -> np.ndarray:
+    """
+    Insert added itineraries among the sorted ones with equal keys.
+
+    Sorted itineraries with keys equal to the added ones are decoded and
+    compared with them by the other keys of the scoring profile (for the best
+    ones) and by their canonical forms. Equal keys are rare, so only a few
+    sorted itineraries are decoded.
+
+    :param SortedItineraries result: the sorted itineraries
+    :param RateTable rates: table of EUR rates of the sorted itineraries
+    :param np.ndarray kept_indices: indices of the sorted itineraries which
+        are not removed
+    :param np.ndarray first_equal: for each added itinerary, the first kept
+        one with an equal key
+    :param np.ndarray first_greater: for each added itinerary, the first kept
+        one with a greater key
+    :param List[Tuple[Any, ...]] tie_keys: less significant sorting keys of
+        each added itinerary, ending with its canonical form
+    :return np.ndarray: for each added itinerary, the first kept one with
+        greater sorting keys
+    """
+    starts, ends = result.starts(), result.ends
+    decoded: Dict[Tuple[int, int], List[Tuple[Any, ...]]] = {}
+    first_greater = first_greater.copy()
+    for n in np.flatnonzero(first_equal < first_greater):
+        run = int(first_equal[n]), int(first_greater[n])
+        if run not in decoded:
+            itineraries = _parse_itineraries(
+                [
+                    json.loads(result.items[starts[i]:ends[i]])
+                    for i in kept_indices[run[0]:run[1]]
+                ],
+                rates,
+            )
+            decoded[run] = __tie_keys(itineraries, result.profile)
+        first_greater[n] = run[0] + bisect_right(decoded[run], tie_keys[n])
+
+    return first_greater
+
+
+def update_sorted(
+    result: SortedItineraries, delta: Delta,
+) -> SortedItineraries:
+    """
+    Update sorted itineraries by adding and removing itineraries.
+
+    Added itineraries are inserted among the sorted ones with equal keys by
+    the other keys of the scoring profile (for the best ones) and by their
+    canonical forms, and removed ones are dropped. So, the result is the same
+    as of sorting the remaining itineraries together with the added ones.
+    Only the changed itineraries are processed one by
+    one, unchanged runs of the sorted itineraries are copied as a whole.
+
+    :param SortedItineraries result: sorted itineraries to be updated
+    :param Delta delta: changes of the sorted itineraries
+    :return SortedItineraries: updated sorted itineraries
+    :raises ParsingError: if the sorted itineraries cannot be updated or a
+        removed itinerary is not among them
+    """
+    if result.keys is None:
+        raise ParsingError("The given sorted itineraries cannot be updated.")
+
+    removed = set()
+    for itinerary_id, found in zip(delta.removed, result.find(delta.removed)):
+        if len(found) == 0:
+            raise ParsingError(
+                f"The itinerary {itinerary_id} is not among the given " +
+                "sorted itineraries.",
+            )
+        removed.update(found.tolist())
+
+    # the added ones in their canonical order, as if they were sorted anew
+    canonical_forms = [i._canonical() for i in delta.added]
+    added = [
+        delta.added[i] for i in sorted(
+            range(len(delta.added)), key=canonical_forms.__getitem__,
+        )
+    ]
+    added_batch = ItineraryBatch.from_itineraries(added)
+    added_order = sort_permutation(
+        added_batch, result.sorting_type, profile=result.profile,
+    )
+    added_keys = sort_keys(
+        added_batch, result.sorting_type, result.profile,
+    ).astype(result.keys.dtype, copy=False)[added_order]
+
+    # insert the added ones before the first remaining one with a greater key
+    kept = np.ones(len(result), dtype=bool)
+    kept[list(removed)] = False
+    kept_indices = np.append(np.flatnonzero(kept), len(result))
+    kept_keys = result.keys[kept_indices[:-1]]
+    first_greater = np.searchsorted(kept_keys, added_keys, "right")
+    first_equal = np.searchsorted(kept_keys, added_keys, "left")
+    if (first_equal < first_greater).any():
+        tie_keys = __tie_keys(added, result.profile)
+        first_greater = __break_insertion_ties(
+            result,
+            delta.rates,
+            kept_indices[:-1],
+            first_equal,
+            first_greater,
+            [tie_keys[n] for n in added_order],
+        )
+    insert_before = kept_indices[first_greater]
+
+    starts, ends = result.starts(), result.ends
+    items: List[bytes] = []
+    lengths: List[np.ndarray] = [np.empty(0, dtype=np.int64)]
+    keys: List[np.ndarray] = [np.empty(0, dtype=result.keys.dtype)]
+
+    def copy_run(start: int, end: int) -> None:
+        if start < end:
+            items.append(result.items[starts[start]:ends[end - 1]])
+            lengths.append(ends[start:end] - starts[start:end])
+            keys.append(result.keys[start:end])
+
+    # (position, 0, added) inserts before the position, (position, 1, -1)
+    # removes the position
+    changes = sorted(
+        [(int(p), 0, n) for n, p in enumerate(insert_before)]
+            + [(p, 1, -1) for p in removed],
+    )
+    position = 0
+    for change_position, removal, n in changes:
+        copy_run(position, change_position)
+        position = max(position, change_position)
+        if removal:
+            position += 1
+        else:
+            item = added[added_order[n]]._serialise_json().encode()
+            items.append(item)
+            lengths.append(np.array([len(item)], dtype=np.int64))
+            keys.append(added_keys[n:n + 1])
+    copy_run(position, len(result))
+
+    all_lengths = np.concatenate(lengths)
+    return SortedItineraries(
+        token=delta.digest(result.token),
+        sorting_type=result.sorting_type,
+        items=b",".join(items),
+        ends=np.cumsum(all_lengths)
+            + np.arange(len(all_lengths), dtype=np.int64),
+        keys=np.concatenate(keys),
+        profile=result.profile,
+        rates_version=result.rates_version,
+    )
+
+
+def update_sorted_cached(
+    token: str,
+    delta: Delta,
+    cursor: Cursor | None = None,
+    memory_cache: MemoryCache[SortedItineraries] | None = None,
+) -> SortedItineraries | None:
+    """
+    Update cached sorted itineraries, or load the updated ones from the caches.
+
+    The updated sorted itineraries are cached under a token derived from the
+    token of the sorted itineraries and the changes.
+
+    :param str token: token of the sorted itineraries to be updated
+    :param Delta delta: changes of the sorted itineraries
+    :param Cursor | None cursor: database cursor, defaults to None
+    :param MemoryCache[SortedItineraries] | None memory_cache: in-memory cache
+        of sorted itineraries, defaults to None
+    :return SortedItineraries | None: updated sorted itineraries, None if the
+        sorted itineraries are not cached (anymore) or their prices were
+        converted by other EUR rates
+    :raises ParsingError: if the sorted itineraries cannot be updated or a
+        removed itinerary is not among them
+    """
+    result = load_sorted(delta.digest(token), cursor, memory_cache)
+    if result is not None:
+        return result
+
+    result = load_sorted(token, cursor, memory_cache)
+    # prices of the sorted and the added itineraries have to be comparable
+    if result is None or result.rates_version not in (
+        None, delta.rates.version,
+    ):
+        return None
+
+    with stage("update"):
+        result = update_sorted(result, delta)
+    __store_sorted(result, cursor, memory_cache)
+
+    return result
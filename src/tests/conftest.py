@@ -0,0 +1,26 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Fixtures shared by the tests."""
+
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from pytest import MonkeyPatch
+
+from ..db import close_connections
+
+
+@pytest.fixture(autouse=True)
+def requests_db(tmp_path: Path, monkeypatch: MonkeyPatch) -> Iterator[Path]:
+    """
+    Keep the database of each test in its temporary directory.
+
+    :param Path tmp_path: temporary directory
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    :yield Iterator[Path]: the database file
+    """
+    db_file = tmp_path / "requests.db"
+    monkeypatch.setenv("REQUESTS_DB", str(db_file))
+    yield db_file
+    close_connections()
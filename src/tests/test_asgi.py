@@ -0,0 +1,351 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the ASGI entry point of the REST API."""
+
+import asyncio
+import gzip
+import json
+from threading import Thread
+from threading import enumerate as threads
+from time import sleep
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+from pytest import MonkeyPatch
+
+from .. import index, workers
+from ..asgi import Headers, app
+from ..benchmarks.generator import generate_body
+from ..metrics import record, render, reset, stage
+from ..negotiation import WireFormat
+from ..parallel import parallel_argsort
+from ..service import Condition, iter_response, sort_body
+
+
+def __serve(
+    method: str, path: str, body: bytes = b"", headers: Headers | None = None,
+) -> Tuple[int, Dict[str, str], bytes]:
+    """
+    Serve an HTTP request by the ASGI application.
+
+    :param str method: method of the HTTP request
+    :param str path: path of the HTTP request
+    :param bytes body: body of the HTTP request, defaults to b""
+    :param Headers | None headers: other headers of the HTTP request,
+        defaults to None
+    :return Tuple[int, Dict[str, str], bytes]: status, headers, and body of
+        the HTTP response
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-length", str(len(body)).encode()), *(headers or []),
+        ],
+        "server": ("localhost", 5000),
+    }
+    events = [
+        {"type": "http.request", "body": body[:1], "more_body": True},
+        {"type": "http.request", "body": body[1:], "more_body": False},
+    ]
+    sent: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        return events.pop(0) if events else {"type": "http.disconnect"}
+
+    async def send(event: Dict[str, Any]) -> None:
+        sent.append(event)
+
+    asyncio.run(app(scope, receive, send))
+
+    return (
+        sent[0]["status"],
+        {n.decode(): v.decode() for n, v in sent[0]["headers"]},
+        b"".join(e.get("body", b"") for e in sent[1:]),
+    )
+
+
+def __call(
+    method: str, path: str, body: bytes = b"",
+) -> Tuple[int, bytes]:
+    """
+    Serve an HTTP request by the ASGI application.
+
+    :param str method: method of the HTTP request
+    :param str path: path of the HTTP request
+    :param bytes body: body of the HTTP request, defaults to b""
+    :return Tuple[int, bytes]: status and body of the HTTP response
+    """
+    status, _, response_body = __serve(method, path, body)
+    return status, response_body
+
+
+def test_sort_itineraries() -> None:
+    """Test sorting itineraries through the ASGI application."""
+
+    status, _ = __call("POST", "/sort_itineraries", b"{")
+    assert status == 400
+
+    status, _ = __call("POST", "/sort_itineraries", b'{"sorting_type": 1}')
+    assert status == 400
+
+    # too deeply nested for the decoder
+    status, _ = __call("POST", "/sort_itineraries", b"[" * 100_000)
+    assert status == 400
+
+
+def test_lifespan() -> None:
+    """Test starting and stopping the background threads with the server."""
+
+    def names() -> Set[str]:
+        return {thread.name for thread in threads()}
+
+    background = {"rates-refresher", "requests-db-sweeper"}
+    assert not background & names()  # nothing is started by imports
+
+    events = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent: List[str] = []
+    running: List[Set[str]] = []
+
+    async def receive() -> Dict[str, Any]:
+        running.append(names())
+        return events.pop(0)
+
+    async def send(event: Dict[str, Any]) -> None:
+        sent.append(event["type"])
+
+    asyncio.run(app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert background <= running[1]
+    assert not background & names()
+
+
+def test_flask_fallback() -> None:
+    """Test serving other end-points by the Flask application."""
+
+    status, body = __call("GET", "/cache_stats")
+    assert status == 200
+    assert "hits" in json.loads(body)
+
+
+def test_update_sorted_itineraries() -> None:
+    """Test updating sorted itineraries through the ASGI application."""
+
+    itineraries = [
+        {
+            "id": f"asgi_update_{n}",
+            "duration_minutes": 100 - n,
+            "price": {"amount": 100, "currency": "EUR"},
+        }
+        for n in range(3)
+    ]
+    status, body = __call("POST", "/sort_itineraries", json.dumps({
+        "sorting_type": "fastest", "itineraries": itineraries,
+    }).encode())
+    assert status == 200
+    token = json.loads(body)["token"]
+
+    status, body = __call(
+        "PATCH",
+        f"/sorted_itineraries/{token}",
+        json.dumps({
+            "added": [{**itineraries[0], "id": "asgi_update_added"}],
+            "removed": ["asgi_update_1"],
+        }).encode(),
+    )
+    assert status == 200
+    updated = json.loads(body)
+    assert updated["token"] != token
+    assert [i["id"] for i in updated["sorted_itineraries"]] == [
+        "asgi_update_2", "asgi_update_0", "asgi_update_added",
+    ]
+
+    status, body = __call("GET", f"/sorted_itineraries/{updated['token']}")
+    assert status == 200
+    assert json.loads(body) == updated
+
+    for invalid in (b"[]", b"[" * 100_000):
+        status, _ = __call("PATCH", f"/sorted_itineraries/{token}", invalid)
+        assert status == 400
+    status, _ = __call("PATCH", "/sorted_itineraries/unknown", b"{}")
+    assert status == 404
+
+
+def test_conditional_sort_itineraries() -> None:
+    """Test entity tags and compression through the ASGI application."""
+
+    body = json.dumps({
+        "sorting_type": "cheapest",
+        "itineraries": [
+            {
+                "id": f"asgi_conditional_{n}",
+                "duration_minutes": n,
+                "price": {"amount": 1000 - n, "currency": "EUR"},
+            }
+            for n in range(100)
+        ],
+    }).encode()
+    status, headers, plain = __serve("POST", "/sort_itineraries", body)
+    assert status == 200
+    etag = headers["etag"]
+    assert etag == f'"{json.loads(plain)["token"]}"'
+
+    status, headers, compressed = __serve(
+        "POST", "/sort_itineraries", body, [(b"accept-encoding", b"gzip")],
+    )
+    assert status == 200
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(compressed) == plain
+
+    status, headers, response_body = __serve(
+        "POST", "/sort_itineraries", body, [(b"if-none-match", etag.encode())],
+    )
+    assert status == 304
+    assert headers["etag"] == etag
+    assert response_body == b""
+
+
+def test_inline_processing(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test processing small sorting requests without blocking the event loop.
+
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    original_sort_body = workers.sort_body
+
+    def sort_slowly(
+        body: bytes, wire_format: WireFormat, condition: Condition | None,
+    ) -> Any:
+        sleep(0.5)  # e.g., waiting for a locked database
+        return original_sort_body(body, wire_format, condition)
+
+    monkeypatch.setattr(workers, "sort_body", sort_slowly)
+
+    async def sort_ticking() -> Tuple[Any, int, str]:
+        ticks = 0
+        with record() as recording:
+            sorting = asyncio.ensure_future(
+                workers.sort_async(generate_body(10, seed=12)),
+            )
+            while not sorting.done():
+                await asyncio.sleep(0.01)
+                ticks += 1
+        return sorting.result(), ticks, recording.server_timing()
+
+    response, ticks, server_timing = asyncio.run(sort_ticking())
+    assert len(response) == 10
+    # the event loop is not blocked, and the metrics are recorded
+    assert ticks >= 10
+    assert "decode" in server_timing
+
+
+def test_offloading(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test processing large sorting requests in the worker pool.
+
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    monkeypatch.setattr(workers, "__THRESHOLD", 0)
+    workers.shutdown()
+    try:
+        body = generate_body(50, seed=10)
+        expected = json.loads(b"".join(iter_response(sort_body(body))))
+
+        reset()
+        status, _, response_body = __serve("POST", "/sort_itineraries", body)
+        assert status == 200
+        assert json.loads(response_body) == expected
+        # metrics recorded by the worker are merged by the server
+        assert 'sorting_stage_seconds_count{stage="decode"} 1\n' in render()
+
+        response = index.app.test_client().post("/sort_itineraries", data=body)
+        assert response.status_code == 200
+        assert response.get_json() == expected
+
+        # conditional requests are answered by the worker before sorting
+        etag = f'"{expected["token"]}"'
+        status, headers, response_body = __serve(
+            "POST",
+            "/sort_itineraries",
+            body,
+            [(b"if-none-match", etag.encode())],
+        )
+        assert status == 304
+        assert headers["etag"] == etag
+        assert response_body == b""
+    finally:
+        workers.shutdown()
+
+
+def test_shutdown_after_parallel_sorting() -> None:
+    """Test shutting down worker processes which have sorted in parallel."""
+
+    workers.shutdown()
+    keys = np.random.default_rng(3).random(20_000)
+    try:
+        assert np.array_equal(
+            workers.executor().submit(parallel_argsort, keys, 3).result(),
+            np.argsort(keys, kind="stable"),
+        )
+    finally:
+        # the processes sorting in parallel do not keep the workers alive
+        stopping = Thread(target=workers.shutdown, daemon=True)
+        stopping.start()
+        stopping.join(30)
+        assert not stopping.is_alive()
+
+
+def test_timeout(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test timing out processing in the worker pool without holding workers.
+
+    Worker threads are used, so the slow processing is patched in them.
+
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    original_sort_body = workers.sort_body
+    aborted: List[bool] = []
+
+    def sort_slowly(
+        body: bytes, wire_format: WireFormat, condition: Condition | None,
+    ) -> Any:
+        if body == b"slow":
+            try:
+                for _ in range(1200):
+                    with stage("slow"):
+                        sleep(0.05)
+            except TimeoutError:
+                aborted.append(True)
+                raise
+        return original_sort_body(body, wire_format, condition)
+
+    monkeypatch.setattr(workers, "sort_body", sort_slowly)
+    monkeypatch.setattr(workers, "__POOL", "thread")
+    monkeypatch.setattr(workers, "__THRESHOLD", 0)
+    monkeypatch.setattr(workers, "__POOL_SIZE", 1)
+    monkeypatch.setattr(workers, "__TIMEOUT", 0.5)
+    workers.shutdown()
+    try:
+        status, _, _ = __serve("POST", "/sort_itineraries", b"slow")
+        assert status == 503
+        response = index.app.test_client().post(
+            "/sort_itineraries", data=b"slow",
+        )
+        assert response.status_code == 503
+
+        # the only worker is not held by the timed out requests, which are
+        # aborted between stages
+        status, _, _ = __serve(
+            "POST", "/sort_itineraries", generate_body(10, seed=11),
+        )
+        assert status == 200
+        assert aborted == [True, True]
+    finally:
+        workers.shutdown()
@@ -0,0 +1,36 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the benchmarks helpers."""
+
+from ..benchmarks.generator import CURRENCIES, generate_request
+from ..benchmarks.stages import compare
+from ..parsing import Request
+
+
+def test_generator() -> None:
+    """Test generating synthetic sorting requests."""
+
+    request_json = generate_request(1000, "cheapest", seed=1)
+    assert request_json == generate_request(1000, "cheapest", seed=1)
+    assert request_json != generate_request(1000, "cheapest", seed=2)
+
+    request = Request(request_json)
+    assert len(request.itineraries) == 1000
+    assert {i.price.currency for i in request.itineraries} == set(CURRENCIES)
+    # duplicate prices
+    assert len({i.price for i in request.itineraries}) < 1000
+
+
+def test_compare() -> None:
+    """Test comparing benchmark results against a baseline."""
+
+    baseline = {"10": {"parse": 1.0, "sort_best": 2.0}}
+    results = {"10": {"parse": 1.1, "sort_best": 1.0}}
+    assert compare(results, baseline, 0.2) == []
+    assert compare({"100": {"parse": 5.0}}, baseline, 0.2) == []
+
+    regressions = compare(
+        {"10": {"parse": 1.5, "sort_best": 2.0}}, baseline, 0.2,
+    )
+    assert len(regressions) == 1
+    assert regressions[0].startswith("parse (10 itineraries)")
@@ -0,0 +1,96 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the in-memory cache of sorting requests."""
+
+from threading import Event, Thread
+from time import sleep
+from typing import List, Tuple
+
+import pytest
+
+from ..cache import MemoryCache, SingleFlight
+
+
+def test_lru_eviction() -> None:
+    """Test evicting the least recently used values."""
+
+    # limited number of values
+    cache: MemoryCache[str] = MemoryCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.stats() == {
+        "hits": 3, "misses": 1, "evictions": 1, "entries": 2, "bytes": 0,
+    }
+
+    # limited size of values
+    cache = MemoryCache(max_bytes=10)
+    cache.put("a", "A", 4)
+    cache.put("b", "B", 4)
+    cache.put("c", "C", 4)
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    cache.put("d", "D", 11)
+    assert cache.get("d") is None
+    assert cache.stats()["bytes"] == 8
+
+
+def test_ttl_expiration() -> None:
+    """Test expiring values."""
+
+    now = 0.0
+    cache: MemoryCache[str] = MemoryCache(ttl=10, clock=lambda: now)
+    cache.put("a", "A")
+    now = 9.0
+    assert cache.get("a") == "A"
+    now = 10.0
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.stats()["evictions"] == 1
+
+
+def test_single_flight() -> None:
+    """Test coalescing concurrent identical computations."""
+
+    flight: SingleFlight[str] = SingleFlight()
+    started, release = Event(), Event()
+    computed: List[str] = []
+    results: List[Tuple[str, bool]] = []
+
+    def compute() -> str:
+        computed.append("a")
+        started.set()
+        release.wait()
+        return "A"
+
+    leader = Thread(target=lambda: results.append(flight.do("a", compute)))
+    leader.start()
+    started.wait()
+    followers = [
+        Thread(target=lambda: results.append(flight.do("a", compute)))
+        for _ in range(3)
+    ]
+    for follower in followers:
+        follower.start()
+    # another key is not coalesced
+    assert flight.do("b", lambda: "B") == ("B", False)
+
+    sleep(0.1)  # the followers are waiting
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+    assert computed == ["a"]
+    assert sorted(results) == [("A", False)] + [("A", True)] * 3
+    assert len(flight) == 0
+
+    # nothing is cached after the computation
+    assert flight.do("a", lambda: "A2") == ("A2", False)
+
+    # exceptions are raised by the computation
+    with pytest.raises(ValueError):
+        flight.do("a", lambda: int("x"))
+    assert len(flight) == 0
@@ -0,0 +1,242 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the SQLite3 database of sorting requests."""
+
+from contextlib import closing
+from pathlib import Path
+from sqlite3 import connect
+from threading import Thread
+from time import sleep, time
+
+from ..db import (
+    close_connections,
+    connection,
+    convert,
+    database,
+    start_sweeper,
+    stop_sweeper,
+    sweep,
+    touch,
+)
+from ..metrics import render, reset
+from ..parsing import Request
+from ..sorting import load_variant, sort_request_cached, store_variant
+
+
+def test_connection_pool(tmp_path: Path) -> None:
+    """Test pooling of database connections."""
+
+    db_file = str(tmp_path / "requests.db")
+
+    # the same connection within nested blocks of a thread
+    with database(db_file) as cursor1, database(db_file) as cursor2:
+        assert cursor1.connection is cursor2.connection
+        assert cursor1.execute(
+            "PRAGMA journal_mode",
+        ).fetchone()[0] == "wal"
+        held = cursor1.connection
+
+        # another connection for another thread at the same time
+        connections = []
+
+        def hold() -> None:
+            with connection(db_file) as pooled:
+                connections.append(pooled)
+
+        thread = Thread(target=hold)
+        thread.start()
+        thread.join()
+        assert connections[0] is not held
+
+    # connections are reused by other threads, with the schema migrated once
+    with closing(connect(db_file)) as other_connection:
+        other_connection.execute("DROP TABLE variant")
+    thread = Thread(target=hold)
+    thread.start()
+    thread.join()
+    assert connections[1] in (held, connections[0])
+    with connection(db_file) as pooled:
+        assert pooled in (held, connections[0])
+        assert pooled.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'variant'",
+        ).fetchone() is None
+
+    # the pool is bounded, connections of many threads are reused
+    opened = []
+
+    def hold_many() -> None:
+        with connection(db_file) as pooled:
+            opened.append(pooled)
+            sleep(0.05)
+
+    threads = [Thread(target=hold_many) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == 20
+    assert len({id(c) for c in opened}) <= 8
+
+    # an unfinished transaction is rolled back when returned
+    with connection(db_file) as pooled:
+        pooled.execute("UPDATE result SET size = size")
+        assert pooled.in_transaction
+    with connection(db_file) as pooled:
+        assert not pooled.in_transaction
+
+    # a new pool after closing the pools
+    with connection(db_file) as old_connection:
+        pass
+    close_connections()
+    with connection(db_file) as new_connection:
+        assert old_connection is not new_connection
+        assert new_connection.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'variant'",
+        ).fetchone() is not None
+    close_connections()
+
+
+def test_sweep(tmp_path: Path) -> None:
+    """
+    Test evicting cached results from the database.
+
+    :param Path tmp_path: temporary directory
+    """
+    db_file = str(tmp_path / "requests.db")
+    now = time()
+
+    with database(db_file) as cursor:
+        tokens = [
+            sort_request_cached(Request({
+                "sorting_type": "fastest",
+                "itineraries": [{
+                    "id": f"sweep_{n}",
+                    "duration_minutes": n,
+                    "price": {"amount": n, "currency": "EUR"},
+                }],
+            }), cursor).token
+            for n in range(6)
+        ]
+        assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        sizes = dict(cursor.execute("SELECT hash, size FROM result"))
+        assert len(sizes) == 6 and all(sizes.values())
+
+        # the first ones are not accessed for an hour, the last ones later
+        for n, token in enumerate(tokens):
+            cursor.execute(
+                "UPDATE result SET accessed = ? WHERE hash = ?",
+                (now - 3600 + n, token),
+            )
+        cursor.connection.commit()
+
+        # accesses are only written by the sweep
+        start_sweeper(db_file, interval=3600)
+        try:
+            touch(tokens[0])
+            assert sweep(cursor, ttl=3600 - 2.5, max_bytes=0) == 2
+        finally:
+            stop_sweeper()
+        remaining = [r[0] for r in cursor.execute("SELECT hash FROM result")]
+        assert sorted(remaining) == sorted([tokens[0], *tokens[3:]])
+
+        # the least recently accessed ones over the size cap
+        reset()
+        max_bytes = sizes[tokens[0]] + sizes[tokens[5]]
+        assert sweep(cursor, ttl=0, max_bytes=max_bytes) == 2
+        remaining = [r[0] for r in cursor.execute("SELECT hash FROM result")]
+        assert sorted(remaining) == sorted([tokens[0], tokens[5]])
+        assert (
+            'sorting_cache_evictions_total{reason="size"} 2\n' in render()
+        )
+
+        # no accesses are recorded without the sweeper
+        touch(tokens[5])
+        assert sweep(cursor, ttl=0, max_bytes=sizes[tokens[0]]) == 1
+        remaining = [r[0] for r in cursor.execute("SELECT hash FROM result")]
+        assert remaining == [tokens[0]]
+
+
+def test_variants(tmp_path: Path) -> None:
+    """
+    Test storing variants of responses with their cached results.
+
+    :param Path tmp_path: temporary directory
+    """
+    db_file = str(tmp_path / "requests.db")
+    with database(db_file) as cursor:
+        tokens = [
+            sort_request_cached(Request({
+                "sorting_type": "fastest",
+                "itineraries": [{
+                    "id": f"variant_{n}",
+                    "duration_minutes": n,
+                    "price": {"amount": n, "currency": "EUR"},
+                }],
+            }), cursor).token
+            for n in range(2)
+        ]
+        sizes = dict(cursor.execute("SELECT hash, size FROM result"))
+
+        # counted into the size of their result, stored only once
+        for _ in range(2):
+            store_variant(tokens[0], '"etag"', b"variant", cursor)
+        assert load_variant(tokens[0], '"etag"', cursor) == b"variant"
+        assert load_variant(tokens[1], '"etag"', cursor) is None
+        assert dict(cursor.execute("SELECT hash, size FROM result")) == {
+            tokens[0]: sizes[tokens[0]] + len(b"variant"),
+            tokens[1]: sizes[tokens[1]],
+        }
+
+        # not stored without their result
+        store_variant("unknown", '"etag"', b"variant", cursor)
+        assert load_variant("unknown", '"etag"', cursor) is None
+
+        # evicted with their result
+        cursor.execute(
+            "UPDATE result SET accessed = 0 WHERE hash = ?", (tokens[0],),
+        )
+        cursor.connection.commit()
+        assert sweep(cursor, ttl=3600, max_bytes=0) == 1
+        assert cursor.execute("SELECT count(*) FROM variant").fetchone() == (
+            0,
+        )
+    close_connections()
+
+
+def test_migration(tmp_path: Path) -> None:
+    """
+    Test migrating a database of an older schema.
+
+    :param Path tmp_path: temporary directory
+    """
+    db_file = str(tmp_path / "requests.db")
+    with closing(connect(db_file)) as old_connection:
+        old_connection.execute(
+            "CREATE TABLE result (hash TEXT PRIMARY KEY, version INTEGER " +
+            "NOT NULL, sorting_type TEXT NOT NULL, items BLOB NOT NULL, " +
+            "ends BLOB NOT NULL)",
+        )
+        old_connection.execute(
+            "INSERT INTO result VALUES ('old', 1, 'fastest', 'abc', 'de')",
+        )
+        old_connection.commit()
+
+    with database(db_file) as cursor:
+        assert cursor.execute(
+            "SELECT size, accessed IS NOT NULL FROM result",
+        ).fetchone() == (5, 1)
+        assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+        # not converted to incremental vacuuming (locking it) by the sweep
+        assert sweep(cursor, ttl=0, max_bytes=0) == 0
+        assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    # converted offline once
+    assert convert(db_file)
+    assert not convert(db_file)
+    with database(db_file) as cursor:
+        assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert cursor.execute("SELECT hash FROM result").fetchall() == [
+            ("old",),
+        ]
+    close_connections()
@@ -0,0 +1,110 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the external sorting of streams of itineraries."""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+from pytest import MonkeyPatch
+
+from .. import index
+from ..benchmarks.generator import generate_request
+from ..external import sort_stream
+from ..metrics import render, reset
+from ..parsing import ParsingError, Request
+from ..sorting import sort_request_cached
+
+
+def __sorted_lines(request_json: Dict[str, Any]) -> List[str]:
+    """
+    Sort itineraries of a sorting request at once in memory.
+
+    :param Dict[str, Any] request_json: sorting request in the JSON format
+    :return List[str]: the sorted itineraries in the compact JSON format
+    """
+    request = Request(request_json)
+    sorted_json = json.loads(sort_request_cached(request).to_json())
+    return [
+        json.dumps(i, separators=(",", ":"))
+        for i in sorted_json["sorted_itineraries"]
+    ]
+
+
+def test_sort_stream(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Test sorting streams spilled to runs the same as in memory.
+
+    :param Path tmp_path: temporary directory
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr("tempfile.tempdir", None)
+    itineraries = generate_request(500, seed=25)["itineraries"]
+    lines = [json.dumps(i).encode() + b"\n" for i in itineraries]
+
+    for header in (
+        {"sorting_type": "cheapest"},
+        {"sorting_type": "fastest"},
+        {"sorting_type": "best"},
+        {"sorting_type": "best", "scoring_profile": "quick"},
+        {"sorting_type": "cheapest", "limit": 7},
+    ):
+        expected = __sorted_lines({**header, "itineraries": itineraries})
+        request = Request({**header, "itineraries": []})
+        reset()
+
+        # many small runs merged in several passes
+        chunks = sort_stream(lines, request, memory=4096, fan_in=3)
+        assert list(tmp_path.iterdir())  # the spilled runs
+        assert b"".join(chunks).decode().splitlines() == expected
+        assert "sorting_spilled_runs_total" in render()
+
+        # a single run
+        chunks = sort_stream(lines, request, chunk_size=1)
+        assert b"".join(chunks).decode().splitlines() == expected
+
+    # the temporary files are removed
+    assert list(tmp_path.iterdir()) == []
+
+    request = Request({"sorting_type": "fastest", "itineraries": []})
+    assert list(sort_stream([b"\n"], request)) == []
+    for invalid in (b"{", b"[]", b'{"id": "x"}', b"[" * 100_000):
+        with pytest.raises(ParsingError) as e:
+            sort_stream([lines[0], b"\n", invalid], request, memory=1)
+        assert "itinerary 1 " in e.value.message
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sort_stream_end_point() -> None:
+    """Test the sorting stream end-point."""
+
+    client = index.app.test_client()
+    itineraries = generate_request(50, seed=26)["itineraries"]
+    body = b"\n".join(json.dumps(i).encode() for i in itineraries)
+
+    response = client.post(
+        "/sort_itineraries/stream?sorting_type=best&limit=10", data=body,
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.get_data(as_text=True).splitlines() == __sorted_lines({
+        "sorting_type": "best", "limit": 10, "itineraries": itineraries,
+    })
+
+    for query in (
+        "",
+        "sorting_type=all",
+        "sorting_type=best&scoring_profile=unknown",
+        "sorting_type=best&limit=-1",
+        "sorting_type=best&limit=%C2%B2",
+    ):
+        response = client.post(f"/sort_itineraries/stream?{query}", data=body)
+        assert response.status_code == 400
+
+    response = client.post(
+        "/sort_itineraries/stream?sorting_type=best", data=body + b"\n1\n",
+    )
+    assert response.status_code == 400
+    assert b"itinerary 50 " in response.get_data()
@@ -0,0 +1,102 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the metrics of processing of sorting requests."""
+
+import json
+from time import time
+
+import pytest
+from pytest import MonkeyPatch
+
+from .. import index
+from ..metrics import count, deadline, observe, record, render, reset, stage
+
+
+def test_metrics() -> None:
+    """Test recording and rendering metrics."""
+
+    reset()
+    count("sorting_cache_hits_total", cache="memory")
+    observe("sorting_request_bytes", 2000)
+    with record() as recording:
+        count("sorting_cache_hits_total", 2, cache="memory")
+        with stage("sort"):
+            pass
+        with record(merge=False) as nested:
+            count("sorting_cache_misses_total", cache="db")
+        nested.merge()  # into the enclosing recording
+
+        # not applied to the global metrics yet
+        assert "sorting_cache_hits_total{cache=\"memory\"} 1\n" in render()
+
+    assert len(recording.counters) == 2
+    assert recording.server_timing().startswith("sort;dur=")
+
+    metrics = render()
+    assert "# TYPE sorting_stage_seconds histogram" in metrics
+    assert 'sorting_cache_hits_total{cache="memory"} 3\n' in metrics
+    assert 'sorting_cache_misses_total{cache="db"} 1\n' in metrics
+    assert 'sorting_request_bytes_bucket{le="1024.0"} 0\n' in metrics
+    assert 'sorting_request_bytes_bucket{le="4096.0"} 1\n' in metrics
+    assert 'sorting_request_bytes_bucket{le="+Inf"} 1\n' in metrics
+    assert "sorting_request_bytes_sum 2000.0\n" in metrics
+    assert 'sorting_stage_seconds_count{stage="sort"} 1\n' in metrics
+
+    reset()
+    assert "sorting_stage_seconds_count" not in render()
+
+
+def test_deadline() -> None:
+    """Test aborting processing by a deadline between stages."""
+
+    with deadline(time() + 60):
+        with stage("sort"):
+            pass
+
+    with deadline(time() - 1):
+        with pytest.raises(TimeoutError):
+            with stage("sort"):
+                pass
+
+    # not bounded outside
+    with stage("sort"):
+        pass
+
+
+def test_metrics_end_point(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test the metrics end-point and the Server-Timing header.
+
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    monkeypatch.setattr(index, "SERVER_TIMING", True)
+    reset()
+    client = index.app.test_client()
+    body = json.dumps({
+        "sorting_type": "fastest",
+        "itineraries": [
+            {
+                "id": f"metrics_{n}",
+                "duration_minutes": n,
+                "price": {"amount": n, "currency": "EUR"},
+            }
+            for n in range(3)
+        ],
+    })
+
+    response = client.post("/sort_itineraries", data=body)
+    assert response.status_code == 200
+    size = len(response.get_data())
+    stages = [
+        timing.split(";")[0]
+        for timing in response.headers["Server-Timing"].split(", ")
+    ]
+    assert {"decode", "validate", "hash", "convert", "total"} <= set(stages)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    metrics = response.get_data(as_text=True)
+    assert 'sorting_stage_seconds_count{stage="total"} 1\n' in metrics
+    assert 'sorting_cache_misses_total{cache="memory"}' in metrics
+    assert f"sorting_response_bytes_total {size}\n" in metrics
@@ -0,0 +1,295 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the conditional and compressed representations of responses."""
+
+import gzip
+import json
+
+from .. import index
+from ..db import database
+from ..metrics import render, reset
+from ..negotiation import (
+    CODINGS,
+    WireFormat,
+    accept_format,
+    content_format,
+    decode,
+    encode,
+    entity_tag,
+    negotiate,
+    not_modified,
+    strong_etag,
+)
+from ..service import memory_cache
+from ..sorting import sort_request
+
+
+def test_negotiation() -> None:
+    """Test negotiating content codings and matching entity tags."""
+
+    assert CODINGS[-1] == "gzip"
+    assert negotiate(None) is None
+    assert negotiate("identity") is None
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("deflate, gzip;q=0.5") == "gzip"
+    assert negotiate("*") == CODINGS[0]
+    assert negotiate("*, gzip;q=0") == (
+        CODINGS[0] if len(CODINGS) > 1 else None
+    )
+
+    assert entity_tag(["token"]) == "token"
+    assert entity_tag(["token"], "pretty") != "token"
+    assert entity_tag(["token"], 0, None) != entity_tag(["token"], 0, 10)
+    assert entity_tag(["a", "b"]) != entity_tag(["b", "a"])
+
+    etag = strong_etag("token", "gzip")
+    assert etag == '"token-gzip"'
+    assert not_modified(etag, etag)
+    assert not_modified(f'"other", W/{etag}', etag)
+    assert not_modified("*", etag)
+    assert not not_modified(None, etag)
+    assert not not_modified('"token"', etag)
+
+    assert content_format(None) == WireFormat.JSON
+    assert content_format("text/plain") == WireFormat.JSON
+    assert content_format("application/x-msgpack") == WireFormat.MSGPACK
+    assert accept_format(None) == WireFormat.JSON
+    assert accept_format("*/*") == WireFormat.JSON
+    assert accept_format("application/json;q=0") == WireFormat.JSON
+    assert accept_format("application/msgpack, application/json;q=0.9") == (
+        WireFormat.MSGPACK
+    )
+
+
+def test_conditional_responses() -> None:
+    """Test entity tags, not modified responses, and compression."""
+
+    reset()
+    client = index.app.test_client()
+    body = json.dumps({
+        "sorting_type": "fastest",
+        "itineraries": [
+            {
+                "id": f"negotiation_{n}",
+                "duration_minutes": n,
+                "price": {"amount": n, "currency": "EUR"},
+            }
+            for n in range(100)
+        ],
+    })
+
+    response = client.post("/sort_itineraries", data=body)
+    assert response.status_code == 200
+    token = response.get_json()["token"]
+    assert response.headers["ETag"] == f'"{token}"'
+    assert "Content-Encoding" not in response.headers
+    plain = response.get_data()
+
+    # nothing is sent again for the same entity tag
+    response = client.post(
+        "/sort_itineraries",
+        data=body,
+        headers={"If-None-Match": f'"{token}"'},
+    )
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    # compressed bodies have their own entity tags and they are stored with
+    # the cached sorted itineraries
+    for _ in range(2):
+        response = client.post(
+            "/sort_itineraries",
+            data=body,
+            headers={"Accept-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["ETag"] == f'"{token}-gzip"'
+        assert response.headers["Vary"] == "Accept, Accept-Encoding"
+        assert gzip.decompress(response.get_data()) == plain
+    with database() as cursor:
+        assert cursor.execute("SELECT hash, etag FROM variant").fetchall() == [
+            (token, f'"{token}-gzip"'),
+        ]
+    assert 'sorting_compressed_total{coding="gzip"} 1\n' in render()
+
+    response = client.post(
+        "/sort_itineraries",
+        data=body,
+        headers={
+            "Accept-Encoding": "gzip", "If-None-Match": f'"{token}-gzip"',
+        },
+    )
+    assert response.status_code == 304
+
+    # answered before sorting, even if the sorted itineraries were evicted
+    memory_cache.clear()
+    with database() as cursor:
+        cursor.execute("DELETE FROM result")
+        cursor.connection.commit()
+        assert cursor.execute("SELECT count(*) FROM variant").fetchone() == (
+            0,
+        )
+    sorted_count = sort_request.sorted_count
+    for if_none_match in (f'"{token}"', f'"{token}-gzip"'):
+        response = client.post(
+            "/sort_itineraries",
+            data=body,
+            headers={
+                "Accept-Encoding": "gzip", "If-None-Match": if_none_match,
+            },
+        )
+        assert response.status_code == 304
+        assert response.headers["ETag"] == if_none_match
+    response = client.post(
+        "/sort_itineraries",
+        data=body,
+        headers={"If-None-Match": f'"{token}-gzip"'},
+    )
+    assert response.status_code == 200
+    assert sort_request.sorted_count == sorted_count + 1
+
+    # pages have different entity tags
+    response = client.get(f"/sorted_itineraries/{token}?limit=1")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert etag != f'"{token}"'
+    response = client.get(
+        f"/sorted_itineraries/{token}?limit=1",
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    response = client.get(
+        f"/sorted_itineraries/{token}?limit=2",
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert "sorting_not_modified_total 5\n" in render()
+
+    # invalid pages
+    for query in ("offset=-1", "limit=x", "limit=%C2%B2"):
+        response = client.get(f"/sorted_itineraries/{token}?{query}")
+        assert response.status_code == 400
+
+
+def test_permuted_ties() -> None:
+    """Test that permuted itineraries with equal keys share their bodies."""
+
+    client = index.app.test_client()
+    itineraries = [
+        {
+            "id": f"tie_{n}",
+            "duration_minutes": 100,
+            "price": {"amount": 100, "currency": "EUR"},
+        }
+        for n in range(2)
+    ]
+    for sorting_type in ("cheapest", "fastest", "best"):
+        responses = [
+            client.post("/sort_itineraries", json={
+                "sorting_type": sorting_type, "itineraries": order,
+            })
+            for order in (itineraries, itineraries[::-1])
+        ]
+        # the second one is sorted again, not loaded from the caches
+        memory_cache.clear()
+        with database() as cursor:
+            cursor.execute("DELETE FROM result")
+            cursor.connection.commit()
+        responses.append(client.post("/sort_itineraries", json={
+            "sorting_type": sorting_type, "itineraries": itineraries[::-1],
+        }))
+        for response in responses[1:]:
+            assert response.headers["ETag"] == responses[0].headers["ETag"]
+            assert response.get_data() == responses[0].get_data()
+
+
+def test_msgpack() -> None:
+    """Test sorting requests and responses in the MessagePack format."""
+
+    client = index.app.test_client()
+    request_json = {
+        "sorting_type": "cheapest",
+        "itineraries": [
+            {
+                "id": f"msgpack_{n}",
+                "duration_minutes": n + 1,
+                "price": {"amount": 100 - n, "currency": "EUR"},
+            }
+            for n in range(3)
+        ],
+    }
+    msgpack_headers = {
+        "Content-Type": WireFormat.MSGPACK.value,
+        "Accept": WireFormat.MSGPACK.value,
+    }
+
+    response = client.post("/sort_itineraries", json=request_json)
+    assert response.status_code == 200
+    sorted_json = response.get_json()
+
+    # the same sorted itineraries, from the same cache entry
+    response = client.post(
+        "/sort_itineraries",
+        data=encode(request_json, WireFormat.MSGPACK),
+        headers=msgpack_headers,
+    )
+    assert response.status_code == 200
+    assert response.content_type == WireFormat.MSGPACK.value
+    assert decode(response.get_data(), WireFormat.MSGPACK) == sorted_json
+    assert response.headers["ETag"] != f'"{sorted_json["token"]}"'
+
+    response = client.get(
+        f"/sorted_itineraries/{sorted_json['token']}?offset=1&limit=1",
+        headers=msgpack_headers,
+    )
+    assert response.status_code == 200
+    page = decode(response.get_data(), WireFormat.MSGPACK)
+    assert page["sorted_itineraries"] == sorted_json["sorted_itineraries"][1:2]
+
+    # encoded once and cached with the sorted itineraries, not as a variant
+    token = sorted_json["token"]
+    assert memory_cache.get(token).msgpack_items is not None
+    memory_cache.clear()
+    with database() as cursor:
+        assert cursor.execute(
+            "SELECT COUNT(*) FROM variant",
+        ).fetchone()[0] == 0
+    response = client.get(
+        f"/sorted_itineraries/{token}", headers=msgpack_headers,
+    )
+    assert decode(response.get_data(), WireFormat.MSGPACK) == sorted_json
+    assert memory_cache.get(token).msgpack_items is not None
+
+    # the same validation as of JSON requests
+    invalid_json = {**request_json, "itineraries": [{"id": 1}]}
+    json_response = client.post("/sort_itineraries", json=invalid_json)
+    response = client.post(
+        "/sort_itineraries",
+        data=encode(invalid_json, WireFormat.MSGPACK),
+        headers=msgpack_headers,
+    )
+    assert response.status_code == 400
+    assert response.get_data() == json_response.get_data()
+    for amount in (2 ** 64, -2 ** 63 - 1, 10 ** 30):
+        invalid_json = {
+            **request_json,
+            "itineraries": [{
+                "id": "msgpack_overflow",
+                "duration_minutes": 1,
+                "price": {"amount": amount, "currency": "EUR"},
+            }],
+        }
+        json_response = client.post("/sort_itineraries", json=invalid_json)
+        response = client.post(
+            "/sort_itineraries",
+            json=invalid_json,
+            headers={"Accept": WireFormat.MSGPACK.value},
+        )
+        assert json_response.status_code == 400
+        assert response.status_code == 400
+    for body in (b"\xc1", b"\x81\x01\x02", b"{}"):
+        response = client.post(
+            "/sort_itineraries", data=body, headers=msgpack_headers,
+        )
+        assert response.status_code == 400
@@ -0,0 +1,66 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the parallel sorting of itineraries."""
+
+from threading import Thread
+from typing import List
+
+import numpy as np
+
+from ..parallel import parallel_argsort, parallel_workers, set_parallel_workers
+
+
+def test_parallel_argsort() -> None:
+    """Test that parallel sorting matches stable sequential sorting."""
+
+    rng = np.random.default_rng(0)
+    for keys in (
+        rng.integers(0, 50, 10_001),  # a lot of equal keys
+        rng.integers(-5, 5, 10_000) * 2 ** 40,
+        np.zeros(3_000),  # only equal keys
+        np.repeat(rng.random(100), 30)[::-1],
+        rng.random(10_000),
+        rng.random(5),
+        np.array([1.0]),
+        np.array([], dtype=np.float64),
+    ):
+        expected = np.argsort(keys, kind="stable")
+        for workers in (1, 2, 3, 8):
+            assert np.array_equal(parallel_argsort(keys, workers), expected)
+
+
+def test_parallel_workers() -> None:
+    """Test sharing the processes sorting in parallel."""
+
+    workers = parallel_workers()
+    try:
+        set_parallel_workers(0)
+        assert parallel_workers() == 1
+        set_parallel_workers(3)
+        keys = np.random.default_rng(1).random(1000)
+        assert np.array_equal(
+            parallel_argsort(keys), np.argsort(keys, kind="stable"),
+        )
+    finally:
+        set_parallel_workers(workers)
+
+
+def test_concurrent_parallel_argsort() -> None:
+    """Test sorting in parallel by multiple threads at the same time."""
+
+    keys = np.random.default_rng(2).random(20_000)
+    expected = np.argsort(keys, kind="stable")
+    results: List[np.ndarray] = []
+
+    # threads needing more processes do not restart the pool being used
+    threads = [
+        Thread(target=lambda w=w: results.append(parallel_argsort(keys, w)))
+        for w in range(9, 15)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == len(threads)
+    assert all(np.array_equal(result, expected) for result in results)
@@ -3,10 +3,23 @@
 """Testing the itineraries sorting requests parsing."""
 
 import json
+from random import Random
+from typing import Any
 
 import pytest
+from pytest import MonkeyPatch
 
-from ..parsing import ParsingError, Request, SortingType
+from .. import parsing
+from ..parsing import (
+    Itinerary,
+    ParsingError,
+    Price,
+    RateTable,
+    Request,
+    SortingType,
+    parse_request,
+)
+from ..rates import RateSnapshot, snapshot
 
 
 def test_invalid_requests() -> None:
@@ -56,6 +69,55 @@ def test_invalid_requests() -> None:
             }],
         })
 
+    # durations out of the range of sorted durations
+    for duration in (2 ** 63, -2 ** 63, 10 ** 30):
+        with pytest.raises(ParsingError):
+            Request({
+                "sorting_type": "fastest",
+                "itineraries": [{
+                    "id": "sunny_beach_bliss",
+                    "duration_minutes": duration,
+                    "price": {"amount": 620, "currency": "CZK"},
+                }],
+            })
+        with pytest.raises(ParsingError, match="itinerary 0 "):
+            parse_request(json.dumps({
+                "sorting_type": "fastest",
+                "itineraries": [{
+                    "id": "sunny_beach_bliss",
+                    "duration_minutes": duration,
+                    "price": {"amount": 620, "currency": "CZK"},
+                }],
+            }).encode())
+
+    # amounts out of the range of encoded amounts
+    for amount in (2 ** 64, -2 ** 63 - 1, 10 ** 30):
+        with pytest.raises(ParsingError):
+            Request({
+                "sorting_type": "cheapest",
+                "itineraries": [{
+                    "id": "sunny_beach_bliss",
+                    "duration_minutes": 275,
+                    "price": {"amount": amount, "currency": "CZK"},
+                }],
+            })
+        with pytest.raises(ParsingError, match="itinerary 0 "):
+            parse_request(json.dumps({
+                "sorting_type": "cheapest",
+                "itineraries": [{
+                    "id": "sunny_beach_bliss",
+                    "duration_minutes": 275,
+                    "price": {"amount": amount, "currency": "CZK"},
+                }],
+            }).encode())
+
+    # invalid limits
+    for limit in (-1, "10", 1.5, True, False):
+        with pytest.raises(ParsingError):
+            Request({
+                "sorting_type": "cheapest", "itineraries": [], "limit": limit,
+            })
+
     # unknown currency
     with pytest.raises(ParsingError):
         Request({
@@ -125,3 +187,291 @@ def test_request_to_json() -> None:
     }, sort_keys=True)
     json2 = json.dumps(json.loads(request.to_json()), sort_keys=True)
     assert json1 == json2
+
+
+def test_rate_table() -> None:
+    """Test converting prices using a table of EUR rates."""
+
+    rates = RateTable()
+    assert rates.rate("EUR") == 1
+    assert 0 < rates.rate("CZK") < 1
+
+    price = Price(620, "CZK", rates)
+    assert price.amount_eur == pytest.approx(620 * rates.rate("CZK"))
+    assert price.amount_eur == pytest.approx(Price(620, "CZK").amount_eur)
+
+    # unknown currency
+    with pytest.raises(ParsingError):
+        rates.rate("FOO")
+    with pytest.raises(ParsingError):
+        Price(620, "FOO", rates)
+
+
+def test_lean_itineraries() -> None:
+    """Test that itineraries are slotted and share their currencies."""
+
+    request = Request(json.loads(json.dumps({
+        "sorting_type": "cheapest",
+        "itineraries": [
+            {
+                "id": f"itinerary_{n}",
+                "duration_minutes": 100,
+                "price": {"amount": 620 + n, "currency": "CZK"},
+            }
+            for n in range(2)
+        ],
+    })))
+    first, second = request.itineraries
+    assert not hasattr(first, "__dict__")
+    assert not hasattr(first.price, "__dict__")
+    assert first.price.currency is second.price.currency
+    assert first.price.rate is second.price.rate
+    assert first.price.amount_eur == 620 * first.price.rate
+
+
+def test_request_digest(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test generating stable digests of requests.
+
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+
+    foo = {
+        "id": "foo",
+        "duration_minutes": 300,
+        "price": {
+            "amount": 100,
+            "currency": "EUR",
+        },
+    }
+    bar = {
+        "id": "bar",
+        "duration_minutes": 150,
+        "price": {
+            "amount": 200,
+            "currency": "CZK",
+        },
+    }
+    digest = Request({
+        "sorting_type": "cheapest", "itineraries": [foo, bar],
+    }).digest()
+
+    # independent of the process
+    assert Request({
+        "sorting_type": "fastest", "itineraries": [foo, bar],
+    }).digest() == (
+        "9ec97ecbc8203f4edd94a965b3255a22cc96e1c11e47b96429962e9bd5c774b0"
+    )
+
+    # dependent on the limit
+    assert digest != Request({
+        "sorting_type": "cheapest", "itineraries": [foo, bar], "limit": 1,
+    }).digest()
+
+    # independent of the order of itineraries
+    assert digest == Request({
+        "sorting_type": "cheapest", "itineraries": [bar, foo],
+    }).digest()
+
+    # different sorting type or itineraries
+    assert digest != Request({
+        "sorting_type": "fastest", "itineraries": [foo, bar],
+    }).digest()
+    assert digest != Request({
+        "sorting_type": "cheapest", "itineraries": [foo],
+    }).digest()
+    assert digest != Request({
+        "sorting_type": "cheapest", "itineraries": [foo, bar, bar],
+    }).digest()
+
+    # dependent on the version of EUR rates, unless prices are ignored
+    def digests() -> dict:
+        return {
+            sorting_type: Request({
+                "sorting_type": sorting_type, "itineraries": [foo, bar],
+            }).digest()
+            for sorting_type in ("cheapest", "fastest", "best")
+        }
+
+    current_digests = digests()
+    rates = snapshot()
+    with monkeypatch.context() as patch:
+        patch.setattr(
+            parsing, "snapshot", lambda: RateSnapshot("other", rates.rates),
+        )
+        other_digests = digests()
+    assert other_digests["fastest"] == current_digests["fastest"]
+    assert other_digests["cheapest"] != current_digests["cheapest"]
+    assert other_digests["best"] != current_digests["best"]
+
+
+def test_multiple_sorting_types() -> None:
+    """Test parsing requests with multiple sorting criteria."""
+
+    itineraries = [{
+        "id": "sunny_beach_bliss",
+        "duration_minutes": 275,
+        "price": {
+            "amount": 620,
+            "currency": "CZK",
+        },
+    }]
+
+    assert not Request.is_many({
+        "sorting_type": "cheapest", "itineraries": itineraries,
+    })
+    assert Request.is_many({"sorting_type": "all", "itineraries": itineraries})
+
+    requests = Request.many({"sorting_type": "all", "itineraries": itineraries})
+    assert [r.sorting_type for r in requests] == list(SortingType)
+    assert all(r.itineraries is requests[0].itineraries for r in requests)
+
+    requests = Request.many({
+        "sorting_type": ["fastest", "cheapest", "fastest"],
+        "itineraries": itineraries,
+    })
+    assert [r.sorting_type for r in requests] == [
+        SortingType.FASTEST, SortingType.CHEAPEST,
+    ]
+
+    # invalid sorting types
+    for sorting_types in ([], ["fastest", "xxx"], "xxx", [["fastest"]]):
+        with pytest.raises(ParsingError):
+            Request.many({
+                "sorting_type": sorting_types, "itineraries": itineraries,
+            })
+
+
+def __reference_accepts(body: bytes) -> bool:
+    """
+    Decide whether a body of a sorting request is valid.
+
+    It is a straightforward implementation validating the decoded request
+    and then constructing itineraries one by one.
+
+    :param bytes body: body of the sorting request
+    :return bool: True if the sorting request is valid
+    """
+    values = [t.value for t in SortingType]
+    try:
+        request_json = json.loads(body)
+        if not isinstance(request_json, dict):
+            return False
+
+        sorting_types = [request_json.get("sorting_type")]
+        if Request.is_many(request_json):
+            sorting_types = request_json["sorting_type"]
+            if sorting_types == "all":
+                sorting_types = values
+            if not sorting_types or not all(t in values for t in sorting_types):
+                return False
+
+        for sorting_type in sorting_types:
+            if (
+                sorting_type not in values
+                or "itineraries" not in request_json
+                or not isinstance(request_json["itineraries"], list)
+                or (
+                    "limit" in request_json
+                    and (
+                        not isinstance(request_json["limit"], int)
+                        or isinstance(request_json["limit"], bool)
+                        or request_json["limit"] < 0
+                    )
+                )
+            ):
+                return False
+
+            rates = RateTable()
+            for itinerary_json in request_json["itineraries"]:
+                Itinerary(itinerary_json, rates)
+
+    except Exception:
+        return False
+
+    return True
+
+
+def __mutate(rnd: Random, value: Any) -> Any:
+    """
+    Randomly mutate a part of a sorting request in the JSON format.
+
+    :param Random rnd: random generator
+    :param Any value: the mutated part of the sorting request
+    :return Any: mutated copy of the part of the sorting request
+    """
+    replacements = [
+        None, True, False, 0, -1, 7, 1.5, "", "EUR", "FOO", "cheapest",
+        "all", [], ["fastest"], {}, {"amount": 1, "currency": "CZK"},
+    ]
+    if rnd.random() < 0.1:
+        return rnd.choice(replacements)
+
+    if isinstance(value, dict):
+        value = dict(value)
+        key = rnd.choice([*value, "id", "limit", "price", "extra"])
+        action = rnd.random()
+        if action < 0.3:
+            value.pop(key, None)
+        elif action < 0.6:
+            value[key] = rnd.choice(replacements)
+        elif key in value:
+            value[key] = __mutate(rnd, value[key])
+        return value
+
+    if isinstance(value, list) and value:
+        value = list(value)
+        n = rnd.randrange(len(value))
+        value[n] = __mutate(rnd, value[n])
+        return value
+
+    return value
+
+
+def test_parse_request() -> None:
+    """Test parsing bodies of sorting requests against a reference."""
+
+    rnd = Random(0)
+    request_json = {
+        "sorting_type": "cheapest",
+        "limit": 2,
+        "itineraries": [
+            {
+                "id": f"itinerary_{n}",
+                "duration_minutes": 100 + n,
+                "price": {"amount": 10 * n, "currency": "CZK"},
+            }
+            for n in range(3)
+        ],
+    }
+
+    accepted = rejected = 0
+    for _ in range(3000):
+        mutated = request_json
+        for _ in range(rnd.randint(0, 3)):
+            mutated = __mutate(rnd, mutated)
+        body = json.dumps(mutated).encode()
+        if rnd.random() < 0.1:  # corrupt the JSON format
+            n = rnd.randrange(len(body))
+            body = body[:n] + rnd.choice([b"", b"}", b'"', b","]) + body[n:]
+
+        try:
+            parsed = parse_request(body)
+        except ParsingError:
+            assert not __reference_accepts(body), body
+            rejected += 1
+            continue
+
+        assert __reference_accepts(body), body
+        accepted += 1
+        for request in parsed if isinstance(parsed, list) else [parsed]:
+            assert request.itineraries == [
+                Itinerary(i) for i in json.loads(body)["itineraries"]
+            ]
+
+    assert accepted > 100 and rejected > 100
+
+    # the index of an invalid itinerary is reported
+    request_json["itineraries"][1]["price"]["currency"] = "FOO"
+    with pytest.raises(ParsingError, match="itinerary 1 "):
+        parse_request(json.dumps(request_json).encode())
@@ -0,0 +1,118 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the snapshots of EUR rates."""
+
+from os import utime
+from pathlib import Path
+from time import monotonic, sleep
+
+import pytest
+
+from ..parsing import ParsingError, RateTable
+from ..rates import (
+    RATES_FILE,
+    RateSnapshot,
+    reload,
+    snapshot,
+    start_refresher,
+    stop_refresher,
+)
+
+
+def test_snapshot() -> None:
+    """Test the bundled snapshot of EUR rates."""
+
+    rates = RateSnapshot.load(RATES_FILE)
+    assert rates.version.startswith(f"{rates.date}-")
+    assert rates.rates["EUR"] == 1
+    assert 0 < rates.rates["CZK"] < 1
+    assert snapshot().rates == rates.rates
+
+    table = RateTable(RateSnapshot("test", {"EUR": 1.0, "FOO": 2.0}))
+    assert table.rate("FOO") == 2
+    with pytest.raises(ParsingError):
+        table.rate("CZK")
+
+    # versioned by the rates too, not only by their date
+    assert RateSnapshot("test", {"EUR": 1.0, "FOO": 2.0}).version == (
+        RateSnapshot("test", {"FOO": 2.0, "EUR": 1.0}).version
+    )
+    assert RateSnapshot("test", {"EUR": 1.0, "FOO": 2.0}).version != (
+        RateSnapshot("test", {"EUR": 1.0, "FOO": 2.5}).version
+    )
+
+
+def test_reload(tmp_path: Path) -> None:
+    """
+    Test reloading a changed snapshot of EUR rates.
+
+    :param Path tmp_path: temporary directory
+    """
+    rates_file = str(tmp_path / "rates.json")
+    RateSnapshot("v1", {"EUR": 1.0}).save(rates_file)
+    try:
+        assert reload(rates_file).date == "v1"
+        table = RateTable()
+
+        RateSnapshot("v2", {"EUR": 1.0, "FOO": 2.0}).save(rates_file)
+        utime(rates_file, (1, 1))
+        assert reload(rates_file).date == "v2"
+        assert RateTable().rate("FOO") == 2
+        # tables keep the snapshot they started with
+        with pytest.raises(ParsingError):
+            table.rate("FOO")
+
+        # rates changed without changing their date
+        RateSnapshot("v2", {"EUR": 1.0, "FOO": 3.0}).save(rates_file)
+        utime(rates_file, (2, 2))
+        assert reload(rates_file).version != (
+            RateSnapshot("v2", {"EUR": 1.0, "FOO": 2.0}).version
+        )
+        assert RateTable().rate("FOO") == 3
+
+        # snapshots naming their date a version
+        with open(rates_file, "w") as f:
+            f.write('{"version": "v2", "rates": {"EUR": 1.0, "FOO": 2.0}}')
+        utime(rates_file, (3, 3))
+        assert reload(rates_file) == RateSnapshot(
+            "v2", {"EUR": 1.0, "FOO": 2.0},
+        )
+
+        # invalid snapshots are ignored
+        with open(rates_file, "w") as f:
+            f.write('{"date": "v3"}')
+        utime(rates_file, (4, 4))
+        assert reload(rates_file).date == "v2"
+
+    finally:
+        reload(RATES_FILE)
+
+    assert snapshot().version == RateSnapshot.load(RATES_FILE).version
+
+
+def test_refresher(tmp_path: Path) -> None:
+    """
+    Test refreshing the snapshot of EUR rates in the background.
+
+    :param Path tmp_path: temporary directory
+    """
+    rates_file = str(tmp_path / "rates.json")
+    RateSnapshot("v1", {"EUR": 1.0}).save(rates_file)
+    stop_refresher()
+    try:
+        assert reload(rates_file).date == "v1"
+        start_refresher(rates_file, interval=0.01)
+        RateSnapshot("v2", {"EUR": 1.0}).save(rates_file)
+        utime(rates_file, (1, 1))
+
+        # swapped in without any request reloading it
+        deadline = monotonic() + 5
+        while snapshot().date != "v2" and monotonic() < deadline:
+            sleep(0.01)
+        assert snapshot().date == "v2"
+
+    finally:
+        stop_refresher()
+        reload(RATES_FILE)
+
+    assert snapshot().version == RateSnapshot.load(RATES_FILE).version
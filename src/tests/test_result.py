@@ -0,0 +1,102 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the serialised sorted itineraries."""
+
+import json
+from typing import List
+
+import msgpack
+
+from ..parsing import Request
+from ..result import SortedItineraries
+from ..sorting import sort_request
+
+
+def test_pages() -> None:
+    """Test serialising pages of sorted itineraries."""
+
+    itineraries = [
+        {
+            "id": f"itinerary_{n}",
+            "duration_minutes": 100 - n,
+            "price": {
+                "amount": 100,
+                "currency": "EUR",
+            },
+        }
+        for n in range(5)
+    ]
+    result = SortedItineraries.from_request(sort_request(Request({
+        "sorting_type": "fastest", "itineraries": itineraries,
+    })))
+    assert len(result) == 5
+
+    def page(offset: int = 0, limit: int | None = None) -> List[str]:
+        page = json.loads(result.to_json(offset, limit))
+        assert page["sorting_type"] == "fastest"
+        assert page["token"] == result.token
+        assert page["offset"] == offset
+        assert page["total"] == 5
+        return [i["id"] for i in page["sorted_itineraries"]]
+
+    ids = [i["id"] for i in reversed(itineraries)]
+    assert page() == ids
+    assert page(0, 2) == ids[:2]
+    assert page(2, 2) == ids[2:4]
+    assert page(4, 2) == ids[4:]
+    assert page(3) == ids[3:]
+    assert page(5) == []
+    assert page(1, 0) == []
+
+    # the same pages in the MessagePack format
+    encoded = result.with_msgpack()
+    assert encoded.with_msgpack() is encoded
+    assert encoded.size() > result.size()
+    for offset, limit in (
+        (0, None), (0, 2), (2, 2), (4, 2), (5, None), (1, 0),
+    ):
+        assert msgpack.unpackb(encoded.to_msgpack(offset, limit)) == (
+            json.loads(result.to_json(offset, limit))
+        )
+
+    # no itineraries
+    result = SortedItineraries.from_request(sort_request(Request({
+        "sorting_type": "best", "itineraries": [],
+    })))
+    assert json.loads(result.to_json()) == {
+        "sorting_type": "best",
+        "token": result.token,
+        "offset": 0,
+        "total": 0,
+        "sorted_itineraries": [],
+    }
+    assert msgpack.unpackb(result.to_msgpack()) == json.loads(result.to_json())
+
+
+def test_find() -> None:
+    """Test finding sorted itineraries by their identifiers."""
+
+    ids = [
+        "foo", 'bar,"duration_minutes":1', '{"id":"foo"', "foo", "ěšč",
+    ]
+    result = SortedItineraries.from_request(sort_request(Request({
+        "sorting_type": "fastest",
+        "itineraries": [
+            {
+                "id": itinerary_id,
+                "duration_minutes": 100 + n,
+                "price": {"amount": 100, "currency": "EUR"},
+            }
+            for n, itinerary_id in enumerate(ids)
+        ],
+    })))
+
+    found = result.find(["foo", *ids[1:3], "ěšč", "baz"])
+    assert [f.tolist() for f in found] == [[0, 3], [1], [2], [4], []]
+    assert result.find([]) == []
+
+    # no itineraries
+    result = SortedItineraries.from_request(sort_request(Request({
+        "sorting_type": "fastest", "itineraries": [],
+    })))
+    assert [f.tolist() for f in result.find(["foo"])] == [[]]
@@ -0,0 +1,139 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Testing the scoring profiles of the best itineraries."""
+
+import json
+import pickle
+from pathlib import Path
+from random import Random
+
+import pytest
+
+from ..db import database
+from ..parsing import ParsingError, Request
+from ..scoring import PROFILES, ScoringProfile, load, profile, register
+from ..sorting import load_sorted, sort_request_cached
+
+
+def test_scoring_profiles() -> None:
+    """Test validating, pickling, and loading scoring profiles."""
+
+    default = profile()
+    assert default.order == ("score", "price", "duration", "id")
+    assert pickle.loads(pickle.dumps(default)) == default
+    assert ScoringProfile.from_json(
+        "default", json.loads(default.to_json()),
+    ) == default
+
+    for invalid in (
+        {"order": []},
+        {"order": ["id", "score"]},
+        {"order": ["score", "score"]},
+        {"order": ["unknown"]},
+        {"price_weight": "5"},
+        [],
+    ):
+        with pytest.raises(ValueError):
+            ScoringProfile.from_json("invalid", invalid)
+
+
+def test_load_profiles(tmp_path: Path) -> None:
+    """
+    Test registering scoring profiles from a file.
+
+    :param Path tmp_path: temporary directory
+    """
+    profiles_file = tmp_path / "profiles.json"
+    profiles_file.write_text(json.dumps({
+        "test_price_first": {"price_weight": 1, "order": ["price", "score"]},
+    }))
+    try:
+        (loaded,) = load(str(profiles_file))
+        assert profile("test_price_first") is loaded
+        assert loaded.duration_weight == 1
+        assert loaded.order == ("price", "score")
+    finally:
+        PROFILES.pop("test_price_first", None)
+
+    profiles_file.write_text("[]")
+    with pytest.raises(ValueError):
+        load(str(profiles_file))
+
+
+def test_sort_by_profiles(tmp_path: Path) -> None:
+    """
+    Test sorting the best itineraries by scoring profiles.
+
+    :param Path tmp_path: temporary directory
+    """
+    rnd = Random(0)
+    itineraries = [
+        {
+            "id": f"itinerary_{n}",
+            "duration_minutes": rnd.choice([30, 60, 90]),
+            "price": {"amount": rnd.choice([10, 20]), "currency": "EUR"},
+        }
+        for n in range(100)
+    ]
+
+    def sort_ids(request_json: dict) -> list:
+        request = Request({"sorting_type": "best", **request_json})
+        sorted_json = json.loads(sort_request_cached(request).to_json())
+        return [i["id"] for i in sorted_json["sorted_itineraries"]]
+
+    # equal scores are ordered by the other keys, not by the given order
+    sorted_ids = sort_ids({"itineraries": itineraries})
+    assert sort_ids({"itineraries": itineraries[::-1]}) == sorted_ids
+    assert sort_ids({"itineraries": itineraries[::-1], "limit": 10}) == (
+        sorted_ids[:10]
+    )
+
+    # the profile changes both the order and the digest
+    register(ScoringProfile("test_slow", duration_weight=-1, price_weight=0))
+    try:
+        request_json = {
+            "itineraries": itineraries, "scoring_profile": "test_slow",
+        }
+        slow_ids = sort_ids(request_json)
+        assert slow_ids != sorted_ids
+        durations = {i["id"]: i["duration_minutes"] for i in itineraries}
+        assert durations[slow_ids[0]] == 90
+        assert durations[slow_ids[-1]] == 30
+        request = Request({"sorting_type": "best", **request_json})
+        assert request.digest() != Request({
+            "sorting_type": "best", "itineraries": itineraries,
+        }).digest()
+
+        # a redefined profile is not answered from the cache
+        with database(str(tmp_path / "requests.db")) as cursor:
+            result = sort_request_cached(request, cursor)
+            assert load_sorted(result.token, cursor).profile == profile(
+                "test_slow",
+            )
+            register(ScoringProfile("test_slow", duration_weight=1))
+            request = Request({"sorting_type": "best", **request_json})
+            assert load_sorted(request.digest(), cursor) is None
+    finally:
+        PROFILES.pop("test_slow", None)
+
+    # scores of large durations do not overflow
+    long_itineraries = [
+        {
+            "id": f"long_{n}",
+            "duration_minutes": duration,
+            "price": {"amount": 10, "currency": "EUR"},
+        }
+        for n, duration in enumerate((2 ** 62, 10, 2 ** 63 - 1))
+    ]
+    assert sort_ids({
+        "itineraries": long_itineraries, "scoring_profile": "quick",
+    }) == ["long_1", "long_0", "long_2"]
+
+    # unknown profiles
+    for scoring_profile in ("unknown", ["default"], None):
+        with pytest.raises(ParsingError):
+            Request({
+                "sorting_type": "best",
+                "itineraries": itineraries,
+                "scoring_profile": scoring_profile,
+            })
@@ -2,9 +2,59 @@
 
 """Testing the itineraries sorting."""
 
+import json
+from pathlib import Path
+from random import Random
+from threading import Thread
+from time import sleep
+from typing import Any, List
+
+import pytest
+from pytest import MonkeyPatch
+
+from .. import parsing, sorting
+from ..batch import ItineraryBatch
+from ..cache import MemoryCache
 from ..db import database
-from ..parsing import Request
-from ..sorting import sort_request
+from ..metrics import render, reset
+from ..parsing import Delta, Itineraries, ParsingError, Request, SortingType
+from ..rates import RateSnapshot, snapshot
+from ..result import SortedItineraries
+from ..sorting import (
+    RECORD_VERSION,
+    load_sorted,
+    sort_permutation,
+    sort_request,
+    sort_request_cached,
+    sort_requests_cached,
+    update_sorted,
+    update_sorted_cached,
+)
+
+
+def __random_itineraries(count: int, seed: int = 0) -> Itineraries:
+    """
+    Generate random itineraries with a lot of equal durations and prices.
+
+    :param int count: number of itineraries to be generated
+    :param int seed: seed of the random generator, defaults to 0
+    :return Itineraries: generated itineraries
+    """
+    rnd = Random(seed)
+    return Request({
+        "sorting_type": "best",
+        "itineraries": [
+            {
+                "id": f"itinerary_{n}",
+                "duration_minutes": rnd.randint(30, 60),
+                "price": {
+                    "amount": rnd.randint(10, 30),
+                    "currency": rnd.choice(["EUR", "CZK", "USD"]),
+                },
+            }
+            for n in range(count)
+        ],
+    }).itineraries
 
 
 def test_sort_cheapest() -> None:
@@ -241,12 +291,14 @@ def test_sort_best() -> None:
     assert request1.to_json() == request2.to_json()
 
 
-def test_caching() -> None:
+def test_caching(tmp_path: Path) -> None:
     """Test caching of sorting requests."""
 
+    db_file = str(tmp_path / "requests.db")
+
     # same request again
-    with database() as cursor:
-        sort_request(Request({
+    with database(db_file) as cursor:
+        sort_request_cached(Request({
             "sorting_type": "fastest",
             "itineraries": [
                 {
@@ -268,7 +320,7 @@ def test_caching() -> None:
             ],
         }), cursor)
         old_sorted_count = getattr(sort_request, "sorted_count", 0)
-        sort_request(Request({
+        sort_request_cached(Request({
             "sorting_type": "fastest",
             "itineraries": [
                 {
@@ -291,9 +343,38 @@ def test_caching() -> None:
         }), cursor)
         assert old_sorted_count == getattr(sort_request, "sorted_count", 0)
 
+    # same request with permuted itineraries
+    with database(db_file) as cursor:
+        old_sorted_count = getattr(sort_request, "sorted_count", 0)
+        result = sort_request_cached(Request({
+            "sorting_type": "fastest",
+            "itineraries": [
+                {
+                    "id": "bar",
+                    "duration_minutes": 150,
+                    "price": {
+                        "amount": 200,
+                        "currency": "EUR",
+                    },
+                },
+                {
+                    "id": "foo",
+                    "duration_minutes": 300,
+                    "price": {
+                        "amount": 100,
+                        "currency": "EUR",
+                    },
+                },
+            ],
+        }), cursor)
+        assert old_sorted_count == getattr(sort_request, "sorted_count", 0)
+        assert [
+            i["id"] for i in json.loads(result.to_json())["sorted_itineraries"]
+        ] == ["bar", "foo"]
+
     # different requests
-    with database() as cursor:
-        sort_request(Request({
+    with database(db_file) as cursor:
+        sort_request_cached(Request({
             "sorting_type": "fastest",
             "itineraries": [
                 {
@@ -315,7 +396,7 @@ def test_caching() -> None:
             ],
         }), cursor)
         old_sorted_count = getattr(sort_request, "sorted_count", 0)
-        sort_request(Request({
+        sort_request_cached(Request({
             "sorting_type": "fastest",
             "itineraries": [
                 {
@@ -337,3 +418,386 @@ def test_caching() -> None:
             ],
         }), cursor)
         assert old_sorted_count + 1 == getattr(sort_request, "sorted_count", 0)
+
+
+def test_sort_permutation_parity() -> None:
+    """Test that columnar sorting matches sorting lists of itineraries."""
+
+    itineraries = __random_itineraries(1000)
+    batch = ItineraryBatch.from_itineraries(itineraries)
+    keys = {
+        SortingType.CHEAPEST: lambda i: i.price.amount_eur,
+        SortingType.FASTEST: lambda i: i.duration,
+        # ordered by price, duration, and identifier if the score is equal
+        SortingType.BEST: lambda i: (
+            i.duration + 5 * i.price.amount_eur,
+            i.price.amount_eur,
+            i.duration,
+            i.id,
+        ),
+    }
+
+    for sorting_type, key in keys.items():
+        expected = sorted(itineraries, key=key)
+        permutation = sort_permutation(batch, sorting_type)
+        assert [itineraries[i] for i in permutation] == expected
+
+        # partial selection
+        for limit in (0, 1, 10, 500, 999, 1000, 2000):
+            permutation = sort_permutation(batch, sorting_type, limit)
+            assert [itineraries[i] for i in permutation] == expected[:limit]
+
+    # empty itineraries
+    batch = ItineraryBatch.from_itineraries([])
+    for sorting_type in SortingType:
+        assert len(sort_permutation(batch, sorting_type)) == 0
+        assert len(sort_permutation(batch, sorting_type, 10)) == 0
+
+
+def test_sort_limit() -> None:
+    """Test sorting only the first itineraries."""
+
+    request = sort_request(Request({
+        "sorting_type": "fastest",
+        "limit": 1,
+        "itineraries": [
+            {
+                "id": "foo",
+                "duration_minutes": 300,
+                "price": {
+                    "amount": 100,
+                    "currency": "EUR",
+                },
+            },
+            {
+                "id": "bar",
+                "duration_minutes": 150,
+                "price": {
+                    "amount": 200,
+                    "currency": "EUR",
+                },
+            },
+        ],
+    }))
+    sorted_itineraries = json.loads(request.to_json())["sorted_itineraries"]
+    assert [i["id"] for i in sorted_itineraries] == ["bar"]
+
+
+def test_memory_caching(tmp_path: Path) -> None:
+    """Test caching of sorting requests in memory in front of the database."""
+
+    request_json = {
+        "sorting_type": "cheapest",
+        "itineraries": [
+            {
+                "id": "foo",
+                "duration_minutes": 300,
+                "price": {
+                    "amount": 100,
+                    "currency": "EUR",
+                },
+            },
+            {
+                "id": "bar",
+                "duration_minutes": 150,
+                "price": {
+                    "amount": 200,
+                    "currency": "CZK",
+                },
+            },
+        ],
+    }
+    memory_cache: MemoryCache[SortedItineraries] = MemoryCache()
+
+    with database(str(tmp_path / "requests.db")) as cursor:
+        # sorted and written through to both caches
+        old_sorted_count = getattr(sort_request, "sorted_count", 0)
+        result = sort_request_cached(
+            Request(request_json), cursor, memory_cache,
+        )
+        assert old_sorted_count + 1 == getattr(sort_request, "sorted_count", 0)
+
+        # answered from memory
+        cached_result = sort_request_cached(
+            Request(request_json), cursor, memory_cache,
+        )
+        assert cached_result is result
+        assert memory_cache.stats()["hits"] == 1
+
+        # answered from the database and populated to memory
+        memory_cache.clear()
+        result = sort_request_cached(
+            Request(request_json), cursor, memory_cache,
+        )
+        assert old_sorted_count + 1 == getattr(sort_request, "sorted_count", 0)
+        assert memory_cache.stats()["misses"] == 1
+        cached_result = sort_request_cached(
+            Request(request_json), cursor, memory_cache,
+        )
+        assert cached_result is result
+
+
+def test_cache_record_versions(tmp_path: Path) -> None:
+    """Test ignoring cached records of other versions."""
+
+    request_json = {
+        "sorting_type": "fastest",
+        "itineraries": [{
+            "id": "foo",
+            "duration_minutes": 300,
+            "price": {
+                "amount": 100,
+                "currency": "EUR",
+            },
+        }],
+    }
+    request_digest = Request(request_json).digest()
+
+    with database(str(tmp_path / "requests.db")) as cursor:
+        cursor.execute(
+            "INSERT INTO result (hash, version, sorting_type, items, ends) " +
+            "VALUES (?, ?, ?, ?, ?)",
+            (request_digest, RECORD_VERSION - 1, "fastest", b"obsolete", b""),
+        )
+        assert load_sorted(request_digest, cursor) is None
+        result = sort_request_cached(Request(request_json), cursor).to_json()
+        sorted_itineraries = json.loads(result)["sorted_itineraries"]
+        assert sorted_itineraries == request_json["itineraries"]
+        assert load_sorted(request_digest, cursor).to_json() == result
+
+
+def test_multiple_sorting_types(tmp_path: Path) -> None:
+    """Test sorting itineraries using multiple sorting criteria at once."""
+
+    request_json = {
+        "sorting_type": "all",
+        "itineraries": [
+            {
+                "id": "foo",
+                "duration_minutes": 300,
+                "price": {
+                    "amount": 100,
+                    "currency": "EUR",
+                },
+            },
+            {
+                "id": "bar",
+                "duration_minutes": 150,
+                "price": {
+                    "amount": 2000,
+                    "currency": "CZK",
+                },
+            },
+        ],
+    }
+
+    with database(str(tmp_path / "requests.db")) as cursor:
+        old_sorted_count = getattr(sort_request, "sorted_count", 0)
+        results = sort_requests_cached(Request.many(request_json), cursor)
+        assert old_sorted_count + 3 == getattr(sort_request, "sorted_count", 0)
+        assert [r.sorting_type for r in results] == list(SortingType)
+
+        # each sorting type cached on its own
+        old_sorted_count = getattr(sort_request, "sorted_count", 0)
+        for sorting_type, result in zip(SortingType, results):
+            request = Request({
+                **request_json, "sorting_type": sorting_type.value,
+            })
+            cached_result = sort_request_cached(request, cursor)
+            assert cached_result.token == result.token
+            assert cached_result.to_json() == result.to_json()
+        assert old_sorted_count == getattr(sort_request, "sorted_count", 0)
+
+    # same orderings as sorting by a single sorting type
+    for sorting_type, result in zip(SortingType, results):
+        request = sort_request(Request({
+            **request_json, "sorting_type": sorting_type.value,
+        }))
+        expected = SortedItineraries.from_request(request)
+        assert result.to_json() == expected.to_json()
+
+
+def test_update_sorted(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Test updating sorted itineraries by adding and removing itineraries.
+
+    :param Path tmp_path: temporary directory
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    itineraries = __random_itineraries(300, seed=1)
+    for sorting_type in SortingType:
+        current = [i._serialise() for i in itineraries[:200]]
+        result = sort_request_cached(Request({
+            "sorting_type": sorting_type.value, "itineraries": current,
+        }))
+        for step in range(5):
+            removed = [i["id"] for i in current[step::7]]
+            added = [
+                {**i._serialise(), "id": f"added_{step}_{n}"}
+                for n, i in enumerate(itineraries[200 + 20 * step:][:20])
+            ]
+            result = update_sorted(
+                result, Delta({"added": added, "removed": removed}),
+            )
+
+            # the same as sorting the remaining and the added ones
+            current = [i for i in current if i["id"] not in removed] + added
+            expected = SortedItineraries.from_request(sort_request(Request({
+                "sorting_type": sorting_type.value, "itineraries": current,
+            })))
+            assert result.items == expected.items
+            assert (result.ends == expected.ends).all()
+            assert len(result.keys) == len(current)
+
+    # removing all the itineraries with the same identifier
+    result = sort_request_cached(Request({
+        "sorting_type": "fastest",
+        "itineraries": [
+            {**i._serialise(), "id": "same"} for i in itineraries[:3]
+        ],
+    }))
+    assert len(update_sorted(result, Delta({"removed": ["same"]}))) == 0
+
+    # unknown itinerary
+    with pytest.raises(ParsingError):
+        update_sorted(result, Delta({"removed": ["unknown"]}))
+
+    # limited sorted itineraries
+    with pytest.raises(ParsingError):
+        update_sorted(
+            sort_request_cached(Request({
+                "sorting_type": "fastest",
+                "limit": 1,
+                "itineraries": [i._serialise() for i in itineraries[:3]],
+            })),
+            Delta({}),
+        )
+
+    # cached updates
+    with database(str(tmp_path / "requests.db")) as cursor:
+        memory_cache: MemoryCache[SortedItineraries] = MemoryCache()
+        result = sort_request_cached(Request({
+            "sorting_type": "best",
+            "itineraries": [i._serialise() for i in itineraries[:10]],
+        }), cursor)
+        delta = Delta({"removed": ["itinerary_0"]})
+        updated = update_sorted_cached(result.token, delta, cursor)
+        assert updated is not None
+        assert updated.token == delta.digest(result.token) != result.token
+        assert len(updated) == 9
+
+        loaded = load_sorted(updated.token, cursor, memory_cache)
+        assert loaded is not None
+        assert loaded.to_json() == updated.to_json()
+        assert (loaded.keys == updated.keys).all()
+        assert update_sorted_cached("unknown", delta, cursor) is None
+
+        # large durations are kept exactly, not rounded to equal keys
+        long_itineraries = [
+            {
+                "id": itinerary_id,
+                "duration_minutes": 2 ** 62 + n,
+                "price": {"amount": 10, "currency": "EUR"},
+            }
+            for itinerary_id, n in (
+                ("long_b", 1), ("long_a", 2), ("long_c", 3),
+            )
+        ]
+        result = sort_request_cached(Request({
+            "sorting_type": "fastest",
+            "itineraries": [long_itineraries[0], long_itineraries[2]],
+        }), cursor)
+        memory_cache.clear()
+        loaded = load_sorted(result.token, cursor, memory_cache)
+        assert loaded is not None
+        assert loaded.keys.tolist() == [2 ** 62 + 1, 2 ** 62 + 3]
+        updated = update_sorted(
+            loaded, Delta({"added": [long_itineraries[1]]}),
+        )
+        assert updated.items == SortedItineraries.from_request(sort_request(
+            Request({
+                "sorting_type": "fastest", "itineraries": long_itineraries,
+            }),
+        )).items
+        assert [i["id"] for i in json.loads(updated.to_json())[
+            "sorted_itineraries"
+        ]] == ["long_b", "long_a", "long_c"]
+
+        # prices converted by other EUR rates cannot be compared
+        rates = snapshot()
+        with monkeypatch.context() as patch:
+            patch.setattr(
+                parsing,
+                "snapshot",
+                lambda: RateSnapshot("other", rates.rates),
+            )
+            result = sort_request_cached(Request({
+                "sorting_type": "cheapest",
+                "itineraries": [i._serialise() for i in itineraries[:10]],
+            }), cursor)
+            assert result.rates_version.startswith("other-")
+        assert update_sorted_cached(result.token, delta, cursor) is None
+
+
+def test_coalescing(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Test sorting concurrent identical sorting requests only once.
+
+    :param Path tmp_path: temporary directory
+    :param MonkeyPatch monkeypatch: monkey-patching fixture
+    """
+    db_file = str(tmp_path / "requests.db")
+    request_json = {
+        "sorting_type": "cheapest",
+        "itineraries": [i._serialise() for i in __random_itineraries(100)],
+    }
+    memory_cache: MemoryCache[SortedItineraries] = MemoryCache()
+
+    # sorting takes long enough for the requests to meet
+    sorted_requests: List[Request] = []
+
+    def slow_sort_request(request: Request, *args: Any) -> Request:
+        sleep(0.2)
+        sorted_requests.append(request)
+        return sort_request(request, *args)
+
+    monkeypatch.setattr(sorting, "sort_request", slow_sort_request)
+
+    def sort() -> None:
+        with database(db_file) as cursor:
+            results.append(sort_request_cached(
+                Request(request_json), cursor, memory_cache,
+            ))
+
+    reset()
+    results: List[SortedItineraries] = []
+    threads = [Thread(target=sort) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sorted_requests) == 1
+    assert all(result is results[0] for result in results)
+    assert "sorting_coalesced_total 7\n" in render()
+
+    # storing again does not conflict
+    with database(db_file) as cursor:
+        memory_cache.clear()
+        cursor.execute("UPDATE result SET version = 0")
+        result = sort_request_cached(Request(request_json), cursor)
+        assert result.to_json() == results[0].to_json()
+        assert cursor.execute("SELECT count(*) FROM result").fetchone() == (1,)
+
+    # a sort succeeds even if it cannot be stored (e.g., a locked database)
+    with database(db_file) as cursor:
+        cursor.execute("PRAGMA query_only = ON")
+        try:
+            result = sort_request_cached(
+                Request({**request_json, "limit": 5}), cursor,
+            )
+            assert len(result) == 5
+            assert not cursor.connection.in_transaction
+        finally:
+            cursor.execute("PRAGMA query_only = OFF")
+        assert cursor.execute("SELECT count(*) FROM result").fetchone() == (1,)
@@ -0,0 +1,337 @@
+# Author: Dominik Harmim <harmim6@gmail.com>
+
+"""Module offloading processing of large sorting requests to a worker pool."""
+
+from asyncio import Future, get_running_loop, shield, to_thread, wait_for
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import blake2b
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.util import Finalize
+from os import getenv
+from time import time
+from typing import Dict, Iterator, Tuple
+
+from .cache import SingleFlight
+from .db import touch
+from .metrics import Recording, count, record
+from .metrics import deadline as stages_deadline
+from .negotiation import WireFormat
+from .parallel import PARALLEL_WORKERS, process_context, set_parallel_workers
+from .parallel import shutdown as shutdown_parallel
+from .rates import warm_up
+from .service import Condition, Representation, SortedResponse, sort_body
+
+__POOL = getenv("WORKER_POOL", "process")  # "process" or "thread"
+__POOL_SIZE = int(getenv("WORKER_POOL_SIZE", "0")) or None  # None means CPUs
+__THRESHOLD = int(getenv("WORKER_THRESHOLD", str(1024 * 1024)))  # in bytes
+__TIMEOUT = float(getenv("REQUEST_TIMEOUT", "30")) or None  # in seconds
+
+__executor: Executor | None = None  # lazily started worker pool
+__busy: Synchronized | None = None  # number of busy worker processes
+
+Sorted = SortedResponse | Representation
+"""sorted itineraries of a response, or its not modified representation"""
+
+Processed = Tuple[Sorted, Recording]
+"""sorted itineraries of a response and metrics recorded by a worker"""
+
+# identical bodies being processed in the worker pool, by their digests
+__in_flight: SingleFlight[Processed] = SingleFlight()
+__in_flight_async: Dict[str, Future[Processed]] = {}
+
+
+def __start_worker(busy: Synchronized) -> None:
+    """
+    Prepare a worker process before its first request.
+
+    The processes sorting in parallel of the worker process are shut down
+    when it exits, before it waits for its child processes and before the
+    queues of their pool are closed (by finalizers of priority 10).
+
+    :param Synchronized busy: number of busy worker processes, shared by all
+        of them
+    """
+    global __busy
+    warm_up()
+    __busy = busy
+    Finalize(None, shutdown_parallel, exitpriority=20)
+
+
+@contextmanager
+def __sharing_cpus() -> Iterator[None]:
+    """
+    Share the processes sorting in parallel among busy worker processes.
+
+    Very large requests are sorted by an equal share of the processes sorting
+    in parallel of each busy worker process, taken when processing starts.
+    So, a single request on an idle server is sorted by all of them, and the
+    busy worker processes together do not sort by many more processes than
+    there are CPUs. Worker threads share the processes of the server.
+
+    :yield Iterator[None]: processing with the share of the processes
+    """
+    if __busy is None:
+        yield
+        return
+
+    with __busy.get_lock():
+        __busy.value += 1
+        busy = __busy.value
+    set_parallel_workers(PARALLEL_WORKERS // busy)
+    try:
+        yield
+    finally:
+        with __busy.get_lock():
+            __busy.value -= 1
+
+
+def executor() -> Executor:
+    """
+    Get the worker pool, which is started on the first use.
+
+    :return Executor: the worker pool
+    """
+    global __executor
+    if __executor is None:
+        if __POOL == "thread":
+            __executor = ThreadPoolExecutor(__POOL_SIZE)
+        else:
+            context = process_context()
+            __executor = ProcessPoolExecutor(
+                __POOL_SIZE,
+                mp_context=context,
+                initializer=__start_worker,
+                initargs=(context.Value("i", 0),),
+            )
+
+    return __executor
+
+
+def shutdown() -> None:
+    """
+    Shut down the worker pool, if it has been started.
+
+    The processes sorting in parallel of the server (used by inline
+    processing and worker threads) are shut down too.
+    """
+    global __executor
+    if __executor is not None:
+        __executor.shutdown(cancel_futures=True)
+        __executor = None
+    shutdown_parallel()
+
+
+@contextmanager
+def __deadline(deadline: float | None) -> Iterator[None]:
+    """
+    Bound processing in the worker pool by a deadline.
+
+    A request that waited in the queue until its deadline is not processed at
+    all. Otherwise, the deadline is checked whenever a stage of processing
+    starts, so the worker is freed for other requests soon after the
+    deadline. Processing is never aborted within a stage, so it never leaves
+    a database transaction open or a coalesced request unresolved.
+
+    :param float | None deadline: time by which the processing has to finish,
+        None if unlimited
+    :yield Iterator[None]: the bounded processing
+    :raises TimeoutError: if the deadline has passed
+    """
+    if deadline is None:
+        yield
+        return
+
+    if deadline <= time():
+        raise TimeoutError
+
+    with stages_deadline(deadline):
+        yield
+
+
+def __sort_recorded(
+    body: bytes,
+    wire_format: WireFormat,
+    deadline: float | None,
+    condition: Condition | None,
+) -> Processed:
+    """
+    Process a body of a sorting request in the worker pool.
+
+    Metrics of the processing are recorded and returned, so they can be
+    merged by the server.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body
+    :param float | None deadline: time by which the processing has to finish,
+        None if unlimited
+    :param Condition | None condition: condition of the sorting request,
+        None if unconditional
+    :return Processed: sorted itineraries of the response (or its not
+        modified representation) and the recorded metrics
+    :raises ParsingError: if parsing of the sorting request failed
+    :raises TimeoutError: if the deadline has passed
+    """
+    with (
+        __deadline(deadline),
+        __sharing_cpus(),
+        record(merge=False) as recording,
+    ):
+        return sort_body(body, wire_format, condition), recording
+
+
+def __deadline_of_now() -> float | None:
+    """
+    Get the deadline of a request submitted to the worker pool now.
+
+    :return float | None: time by which the processing has to finish, None
+        if unlimited
+    """
+    return None if __TIMEOUT is None else time() + __TIMEOUT
+
+
+def __touch(response: Sorted) -> Sorted:
+    """
+    Record accesses of sorted itineraries processed in the worker pool.
+
+    Worker processes do not record them on their own, so they are recorded
+    by the server.
+
+    :param Sorted response: sorted itineraries of the response, or its not
+        modified representation
+    :return Sorted: the same sorted itineraries or representation
+    """
+    if isinstance(response, Representation):
+        return response
+
+    for result in response if isinstance(response, list) else [response]:
+        touch(result.token)
+
+    return response
+
+
+def __body_digest(
+    body: bytes, wire_format: WireFormat, condition: Condition | None,
+) -> str:
+    """
+    Generate a digest of a body of a conditional sorting request.
+
+    Bodies processed in the worker pool are not parsed by the server, so
+    identical bodies are coalesced by their digests instead of digests of
+    sorting requests. Only bodies with the same condition are coalesced,
+    since it may be answered without the sorted itineraries.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body
+    :param Condition | None condition: condition of the sorting request,
+        None if unconditional
+    :return str: hexadecimal digest
+    """
+    digest = blake2b(wire_format.value.encode(), digest_size=32)
+    digest.update(f"\n{condition!r}\n".encode())
+    digest.update(body)
+
+    return digest.hexdigest()
+
+
+def sort(
+    body: bytes,
+    wire_format: WireFormat = WireFormat.JSON,
+    condition: Condition | None = None,
+) -> Sorted:
+    """
+    Process a body of a sorting request, large ones in the worker pool.
+
+    Bodies smaller than the threshold are processed inline. Identical large
+    bodies processed at the same time are processed only once. Processing
+    which times out is aborted, so it does not hold a worker. A conditional
+    request is answered before sorting if the client has the current
+    representation of its response already.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :param Condition | None condition: condition of the sorting request,
+        defaults to None (unconditional)
+    :return Sorted: sorted itineraries of the response, or its not modified
+        representation
+    :raises ParsingError: if parsing of the sorting request failed
+    :raises TimeoutError: if processing in the worker pool timed out
+    """
+    if len(body) < __THRESHOLD:
+        return sort_body(body, wire_format, condition)
+
+    (response, recording), shared = __in_flight.do(
+        __body_digest(body, wire_format, condition),
+        lambda: executor().submit(
+            __sort_recorded,
+            body,
+            wire_format,
+            __deadline_of_now(),
+            condition,
+        ).result(__TIMEOUT),
+    )
+    if shared:
+        count("sorting_coalesced_total")
+    else:
+        recording.merge()
+
+    return __touch(response)
+
+
+async def sort_async(
+    body: bytes,
+    wire_format: WireFormat = WireFormat.JSON,
+    condition: Condition | None = None,
+) -> Sorted:
+    """
+    Process a body of a sorting request, large ones in the worker pool.
+
+    Bodies smaller than the threshold are processed in a thread of the
+    default executor of the event loop (they might wait for the database),
+    large ones in the worker pool, so the event loop is never blocked.
+    Identical large bodies processed at the same time are processed only
+    once. Processing which times out is aborted, so it does not hold a
+    worker. A conditional request is answered before sorting if the client
+    has the current representation of its response already.
+
+    :param bytes body: body of the sorting request
+    :param WireFormat wire_format: format of the body,
+        defaults to WireFormat.JSON
+    :param Condition | None condition: condition of the sorting request,
+        defaults to None (unconditional)
+    :return Sorted: sorted itineraries of the response, or its not modified
+        representation
+    :raises ParsingError: if parsing of the sorting request failed
+    :raises TimeoutError: if processing in the worker pool timed out
+    """
+    if len(body) < __THRESHOLD:
+        # metrics are recorded into the recording of the context
+        return await to_thread(sort_body, body, wire_format, condition)
+
+    digest = __body_digest(body, wire_format, condition)
+    future = __in_flight_async.get(digest)
+    shared = future is not None
+    if future is None:
+        loop = get_running_loop()
+        future = loop.run_in_executor(
+            executor(),
+            __sort_recorded,
+            body,
+            wire_format,
+            __deadline_of_now(),
+            condition,
+        )
+        __in_flight_async[digest] = future
+        future.add_done_callback(
+            lambda _: __in_flight_async.pop(digest, None),
+        )
+
+    # a timed out request does not cancel processing shared by others
+    response, recording = await wait_for(shield(future), __TIMEOUT)
+    if shared:
+        count("sorting_coalesced_total")
+    else:
+        recording.merge()
+
+    return __touch(response)